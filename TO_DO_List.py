@@ -1,17 +1,575 @@
+import argparse
+import array
+import bisect
 import time
 import datetime
+import itertools
+import json
+import mmap
 import pickle
 import os
+import struct
+import sys
+import threading
+
+# Written by the "save" command before the journal existed, and read once
+# to start the journal from
+CURRENT_FILE = 'current.pickle'
+HISTORY_FILE = 'history.pickle'
+# Tasks and history as of some event, and the events since then
+SNAPSHOT_FILE = 'snapshot.pickle'
+HISTORY_SNAPSHOT_FILE = 'snapshot-history.bin'
+JOURNAL_FILE = 'journal.log'
+# Used instead of the two above with --backend=sqlite
+DATABASE_FILE = 'todo.sqlite3'
+# History entries shown at a time
+HISTORY_PAGE_SIZE = 20
+
+
+class Journal:
+    # Append-only log of the add/rmv events, one JSON line each. Every
+    # event is written to the file as it happens, so it survives the
+    # program crashing; fsync, which makes it survive the machine
+    # crashing, is batched every sync_every events, and a timer makes sure
+    # that no event waits more than sync_interval seconds for it, even if
+    # the program then sits at its prompt.
+    def __init__(self, path, sync_every=64, sync_interval=1.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.seq = 0
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self.fd = None
+        # The timer thread syncs too
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def open(self, after_seq=0):
+        # Return the events logged after event number after_seq, and get
+        # ready to append. A torn last line, from a crash in the middle of
+        # a write, is cut off.
+        events = []
+        end = 0
+        self.seq = after_seq
+
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    end += len(line)
+                    if record['seq'] > after_seq:
+                        self.seq = record['seq']
+                        events.append((
+                            record['item'],
+                            datetime.datetime.fromisoformat(record['time']),
+                            record['mode'],
+                        ))
+
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0o644)
+        if os.fstat(self.fd).st_size > end:
+            os.ftruncate(self.fd, end)
+        return events
+
+    def append(self, item, timestamp, mode):
+        self.seq += 1
+        record = {
+            'seq': self.seq,
+            'time': timestamp.isoformat(),
+            'mode': mode,
+            'item': item,
+        }
+        os.write(self.fd, (json.dumps(record) + '\n').encode('utf-8'))
+        with self.lock:
+            self.pending += 1
+            due = self.last_sync + self.sync_interval - time.monotonic()
+            if self.pending < self.sync_every and due > 0:
+                if self.timer is None:
+                    self.timer = threading.Timer(due, self.sync)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+
+        self.sync()
+
+    def sync(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.pending and self.fd is not None:
+                os.fsync(self.fd)
+                self.pending = 0
+            self.last_sync = time.monotonic()
+
+    def clear(self):
+        # Every event so far is in a snapshot; numbering carries on
+        with self.lock:
+            os.ftruncate(self.fd, 0)
+            os.fsync(self.fd)
+            self.pending = 0
+
+    def close(self):
+        if self.fd is not None:
+            self.sync()
+            with self.lock:
+                os.close(self.fd)
+                self.fd = None
+
+
+class JournalStorage:
+    # Keeps the tasks and their history on disk: each event is appended to
+    # the journal, and every snapshot_every events (or on "save") the whole
+    # state is written to a snapshot and the journal is emptied. Loading
+    # reads the snapshot and replays the journal after it.
+    # The history is kept in memory, in TimeStampedToDoList
+    keeps_history = False
+
+    def __init__(self, directory='.', snapshot_every=1000):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.journal = Journal(os.path.join(directory, JOURNAL_FILE))
+        self.since_snapshot = 0
+        self.to_do_list = None
+        self.history = None
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self, to_do_list, history):
+        # Only the tasks are loaded now; the history is loaded by
+        # load_history the first time it is used
+        self.to_do_list = to_do_list
+        self.history = history
+        snapshot = None
+        seq = 0
+
+        if os.path.exists(self.path(SNAPSHOT_FILE)):
+            with open(self.path(SNAPSHOT_FILE), 'rb') as f:
+                snapshot = pickle.load(f)
+            seq = snapshot['seq']
+            to_do_list.to_do_list = TaskStore(snapshot['current'])
+        elif os.path.exists(self.path(CURRENT_FILE)):
+            with open(self.path(CURRENT_FILE), 'rb') as f:
+                to_do_list.to_do_list = TaskStore(pickle.load(f))
+
+        events = self.journal.open(seq)
+        for item, timestamp, mode in events:
+            if mode == "add":
+                to_do_list.to_do_list.add(item)
+            elif mode == "rmv":
+                to_do_list.to_do_list.remove(item)
+        self.since_snapshot = len(events)
+        history.load_history = lambda: self.load_history(snapshot, events)
+
+    def load_history(self, snapshot, events):
+        # The history as of the snapshot (or the old pickles), with the
+        # events of the journal after it
+        if snapshot is None:
+            history = History()
+            if os.path.exists(self.path(HISTORY_FILE)):
+                with open(self.path(HISTORY_FILE), 'rb') as f:
+                    history = History(pickle.load(f))
+        elif 'history' in snapshot:
+            # Written before the history had a file of its own
+            history = History(snapshot['history'])
+        else:
+            # The file may be newer, with more events after these
+            history = History.open(self.path(snapshot['history_file']),
+                                   snapshot['history_count'])
+        for event in events:
+            history.append(event)
+        return history
+
+    def record(self, item, timestamp, mode):
+        self.journal.append(item, timestamp, mode)
+        self.since_snapshot += 1
+
+        if self.since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        history = self.history.to_do_list
+        # The history goes first: until the snapshot is replaced too, the
+        # old one only reads as many events from it as it had
+        self.write_atomically(HISTORY_SNAPSHOT_FILE, history.save)
+        snapshot = {
+            'seq': self.journal.seq,
+            'current': list(self.to_do_list.to_do_list),
+            'history_file': HISTORY_SNAPSHOT_FILE,
+            'history_count': len(history),
+        }
+        self.write_atomically(SNAPSHOT_FILE,
+                              lambda f: pickle.dump(snapshot, f))
+        # A crash before this is harmless: replaying skips the events that
+        # the snapshot already has
+        self.journal.clear()
+        self.since_snapshot = 0
+
+    def write_atomically(self, name, write):
+        temp_path = self.path(name + '.tmp')
+        with open(temp_path, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path(name))
+
+    def close(self):
+        self.journal.close()
+
+
+class SqliteStorage:
+    # Keeps the tasks and their history in an SQLite database, with the
+    # history indexed so that it can be queried by time, mode and item
+    # without loading it. The first time, whatever JournalStorage would
+    # load is imported.
+    keeps_history = True
+
+    def __init__(self, directory='.'):
+        import sqlite3
+
+        self.directory = directory
+        self.db = sqlite3.connect(os.path.join(directory, DATABASE_FILE))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Still durable against the program crashing, and only syncs at
+        # checkpoints rather than on every event
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY, item TEXT NOT NULL,
+                    time REAL NOT NULL, mode TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS events_time ON events (time);
+                CREATE INDEX IF NOT EXISTS events_mode_time
+                    ON events (mode, time);
+                CREATE INDEX IF NOT EXISTS events_item ON events (item);
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY, item TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS tasks_item ON tasks (item);
+            """)
+
+    def load(self, to_do_list, history):
+        migrated = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+        if migrated is None:
+            self.migrate()
+        to_do_list.to_do_list = TaskStore(
+            item for (item,) in
+            self.db.execute("SELECT item FROM tasks ORDER BY id")
+        )
+
+    def migrate(self):
+        # One shot: the pickles and journal are left alone, but not read
+        # again
+        old = JournalStorage(self.directory)
+        old_history = TimeStampedToDoList()
+        old_tasks = ToDoList(old_history)
+        old.load(old_tasks, old_history)
+        old.close()
+
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO events (item, time, mode) VALUES (?, ?, ?)",
+                ((item, timestamp.timestamp(), mode)
+                 for item, timestamp, mode in old_history.to_do_list))
+            self.db.executemany(
+                "INSERT INTO tasks (item) VALUES (?)",
+                ((item,) for item in old_tasks.to_do_list))
+            self.db.execute(
+                "INSERT INTO meta (key, value) VALUES ('migrated', ?)",
+                (str(len(old_history.to_do_list)),))
+
+    def record(self, item, timestamp, mode):
+        with self.db:
+            self.db.execute(
+                "INSERT INTO events (item, time, mode) VALUES (?, ?, ?)",
+                (item, timestamp.timestamp(), mode))
+            if mode == "add":
+                self.db.execute("INSERT INTO tasks (item) VALUES (?)",
+                                (item,))
+            elif mode == "rmv":
+                # Like list.remove(), the first one
+                self.db.execute(
+                    "DELETE FROM tasks WHERE id = "
+                    "(SELECT min(id) FROM tasks WHERE item = ?)", (item,))
+
+    def query_history(self, mode=None, start=None, end=None):
+        # Yield the (item, timestamp, mode) entries in time order, mode
+        # being "add" or "rmv" and start and end datetimes, reading them a
+        # page at a time: the cost is that of the entries actually used
+        conditions = []
+        parameters = []
+        if mode is not None:
+            conditions.append("mode = ?")
+            parameters.append(mode)
+        if start is not None:
+            conditions.append("time >= ?")
+            parameters.append(start.timestamp())
+        if end is not None:
+            conditions.append("time < ?")
+            parameters.append(end.timestamp())
+        where = " AND ".join(conditions) or "1"
+        cursor = self.db.execute(
+            "SELECT item, time, mode FROM events WHERE " + where
+            + " ORDER BY time, id", parameters)
+        while True:
+            rows = cursor.fetchmany(HISTORY_PAGE_SIZE)
+            if not rows:
+                break
+            for item, timestamp, mode in rows:
+                yield item, datetime.datetime.fromtimestamp(timestamp), mode
+
+    def snapshot(self):
+        # Everything is committed already; fold the write-ahead log back
+        # into the database
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        self.db.close()
+
+
+class TaskStore:
+    # The tasks in the order they were added, with duplicates allowed, and
+    # adding, removing and checking for a task in constant time: tasks are
+    # numbered, kept by number in a dict (which keeps insertion order), and
+    # each name maps to its numbers, in order too. Removing a name removes
+    # its first occurrence, like list.remove().
+    def __init__(self, items=()):
+        self.tasks = {}
+        self.ids = {}
+        self.next_id = 0
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        task_id = self.next_id
+        self.next_id += 1
+        self.tasks[task_id] = item
+        self.ids.setdefault(item, {})[task_id] = None
+        return task_id
+
+    def remove(self, item):
+        # Return whether there was such a task
+        ids = self.ids.get(item)
+        if not ids:
+            return False
+        task_id = next(iter(ids))
+        del ids[task_id]
+        if not ids:
+            del self.ids[item]
+        del self.tasks[task_id]
+        return True
+
+    def __contains__(self, item):
+        return item in self.ids
+
+    def __iter__(self):
+        return iter(self.tasks.values())
+
+    def __len__(self):
+        return len(self.tasks)
+
+
+class History:
+    # The history of events, stored by column rather than as a list of
+    # (item, datetime, mode) tuples, which it still behaves like: times
+    # as seconds since the epoch in an array of doubles, modes as one byte
+    # each, and items as indexes into the names, which are UTF-8 bytes
+    # one after the other with an array of where each starts. There are
+    # no Python objects per event or per name. It is saved as a flat
+    # binary file that can be memory-mapped back; the columns are only
+    # copied into memory once something is appended.
+    MODES = ("add", "rmv")
+    MAGIC = b'TDLH'
+    VERSION = 1
+    # Magic, version, whether little-endian, events, names, size of the
+    # names. Then come, in this order so that each is aligned: the times,
+    # the offsets of the names (one more than there are names), the item
+    # of each event, the modes and the UTF-8 names.
+    HEADER = struct.Struct('=4sHBxQQQ')
+
+    def __init__(self, entries=()):
+        self.times = array.array('d')
+        self.modes = bytearray()
+        self.item_ids = array.array('I')
+        self.name_offsets = array.array('Q', [0])
+        self.name_data = bytearray()
+        self.mode_codes = {mode: i for i, mode in enumerate(self.MODES)}
+        # Names of the tasks still to do -> [their index, how many], so
+        # that removing a task refers to the name its adding stored. None
+        # until found from the columns, for a history opened from a file.
+        self.open_names = {}
+        # When mapped from a file: the mmap and the views of it
+        self.mapped = None
+        for entry in entries:
+            self.append(entry)
+
+    @classmethod
+    def open(cls, path, count=None):
+        # Map the history saved at path, or only its first count events
+        history = cls()
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, little, events, names,
+         names_size) = cls.HEADER.unpack_from(mapped)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            mapped.close()
+            raise ValueError('%s is not a history file' % path)
+
+        view = memoryview(mapped)
+        offset = cls.HEADER.size
+        columns = []
+        for (typecode, length) in (('d', 8 * events),
+                                   ('Q', 8 * (names + 1)),
+                                   ('I', 4 * events),
+                                   ('B', events),
+                                   ('B', names_size)):
+            columns.append(view[offset:offset + length].cast(typecode))
+            offset += length
+        (times, offsets, item_ids, modes, data) = columns
+
+        if count is not None:
+            times = times[:count]
+            item_ids = item_ids[:count]
+            modes = modes[:count]
+
+        history.times = times
+        history.name_offsets = offsets
+        history.item_ids = item_ids
+        history.modes = modes
+        history.name_data = data
+        history.mapped = (mapped, view, columns)
+        history.open_names = None
+
+        if little != (sys.byteorder == 'little'):
+            # Written on a machine of the other endianness
+            history.unmap()
+            for column in (history.times, history.name_offsets,
+                           history.item_ids):
+                column.byteswap()
+        return history
+
+    def unmap(self):
+        # Copy the columns into memory, so that they can grow
+        if self.mapped is None:
+            return
+        views = [self.times, self.name_offsets, self.item_ids, self.modes,
+                 self.name_data]
+        self.times = array.array('d', self.times)
+        self.name_offsets = array.array('Q', self.name_offsets)
+        self.item_ids = array.array('I', self.item_ids)
+        self.modes = bytearray(self.modes)
+        self.name_data = bytearray(self.name_data)
+        (mapped, view, columns) = self.mapped
+        self.mapped = None
+        # The mmap can only be closed once nothing refers to it
+        for column in views + columns + [view]:
+            column.release()
+        mapped.close()
+
+    def find_open_names(self):
+        # Walk the history once to find which names were added more times
+        # than they were removed
+        counts = {}
+        add = self.mode_codes["add"]
+        for item_id, mode in zip(self.item_ids, self.modes):
+            if mode == add:
+                counts[item_id] = counts.get(item_id, 0) + 1
+            elif counts.get(item_id):
+                counts[item_id] -= 1
+        self.open_names = {}
+        for item_id, count in counts.items():
+            if count:
+                name = self.open_names.setdefault(self.name(item_id),
+                                                  [item_id, 0])
+                # Older files can have a name more than once: go on with
+                # the latest
+                name[0] = max(name[0], item_id)
+                name[1] += count
+
+    def save(self, f):
+        # Write the history to the binary file f
+        f.write(self.HEADER.pack(
+            self.MAGIC, self.VERSION, sys.byteorder == 'little',
+            len(self.times), len(self.name_offsets) - 1,
+            len(self.name_data)))
+        for column in (self.times, self.name_offsets, self.item_ids,
+                       self.modes, self.name_data):
+            f.write(column)
+
+    def name(self, i):
+        return str(self.name_data[self.name_offsets[i]:
+                                  self.name_offsets[i + 1]], 'utf-8')
+
+    def append(self, entry):
+        item, timestamp, mode = entry
+        self.unmap()
+        if self.open_names is None:
+            self.find_open_names()
+        code = self.mode_codes[mode]
+        name = self.open_names.get(item)
+        if name is None:
+            name = [len(self.name_offsets) - 1, 0]
+            self.name_data += item.encode('utf-8')
+            self.name_offsets.append(len(self.name_data))
+        if mode == "add":
+            name[1] += 1
+            self.open_names[item] = name
+        elif name[1] > 1:
+            name[1] -= 1
+        else:
+            self.open_names.pop(item, None)
+        self.times.append(timestamp.timestamp())
+        self.modes.append(code)
+        self.item_ids.append(name[0])
+
+    def select(self, mode=None, start=None, end=None):
+        # The entries between the datetimes start (included) and end
+        # (excluded), of the given mode if any. The times are in order, so
+        # the range is found by bisection.
+        lo = 0 if start is None else \
+            bisect.bisect_left(self.times, start.timestamp())
+        hi = len(self.times) if end is None else \
+            bisect.bisect_left(self.times, end.timestamp(), lo)
+        code = None if mode is None else self.mode_codes[mode]
+        modes = self.modes
+        for i in range(lo, hi):
+            if code is None or modes[i] == code:
+                yield self[i]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.times)
+        return (self.name(self.item_ids[i]),
+                datetime.datetime.fromtimestamp(self.times[i]),
+                self.MODES[self.modes[i]])
+
+    def __iter__(self):
+        for i in range(len(self.times)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.times)
+
+
 class ToDoList:
     def __init__(self, TDL):
-        self.to_do_list = []
+        self.to_do_list = TaskStore()
         self.TimeStampedTDL = TDL
 
     def add_to_list(self, item):
         # print(datetime.datetime.now())
         # print(time.time())
         v_time = time.time()
-        self.to_do_list.append(item)
+        self.to_do_list.add(item)
         print("Task added to To Do List")
         
         self.TimeStampedTDL.add_to_list(item, "add")
@@ -31,59 +589,149 @@ class ToDoList:
         print(f"  Total tasks : {len(self.to_do_list)}")
 
 class TimeStampedToDoList(ToDoList):
-    def __init__(self):
-        self.to_do_list = []
+    def __init__(self, storage=None):
+        self.history = None
+        # Called the first time the history is needed: most sessions
+        # never look at it, and it can be far bigger than the tasks
+        self.load_history = History
+        self.storage = storage
+
+    @property
+    def to_do_list(self):
+        if self.history is None:
+            self.history = self.load_history()
+        return self.history
+
+    @to_do_list.setter
+    def to_do_list(self, history):
+        self.history = history
+
     def add_to_list(self, item, mode):
-        
-        self.to_do_list.append( (item,datetime.datetime.now(),mode) )
+        timestamp = datetime.datetime.now()
+        # A storage that keeps the history is where it is read from: don't
+        # load or grow a second copy of it in memory
+        if self.storage is None or not self.storage.keeps_history:
+            self.to_do_list.append( (item,timestamp,mode) )
+        if self.storage is not None:
+            self.storage.record(item, timestamp, mode)
         # print("Item added to To Do List")
 
     
-    def view_list_with_timestamps(self):
+    def entries(self, mode=None, start=None, end=None):
+        # The history entries between the datetimes start (included) and
+        # end (excluded), of the given mode if any
+        if self.storage is not None and self.storage.keeps_history:
+            return self.storage.query_history(mode, start, end)
+        return self.scan(mode, start, end)
+
+    def scan(self, mode=None, start=None, end=None):
+        return self.to_do_list.select(mode, start, end)
+
+    def view_list_with_timestamps(self, mode=None, start=None, end=None,
+                                  page_size=None):
         print("Here are the tasks in your To Do List:")
-        for item, timestamp, mode in self.to_do_list:
-            if mode == "add":
-                print(f"  Task {item} was added on - {timestamp.strftime('%a %d-%b %Y %H:%M')}")
-                # print(f"  {timestamp")
-            elif mode == "rmv":
-                print(f"  Task {item} was comleted on - {timestamp.day}")
+        entries = self.entries(mode, start, end)
+        shown = 0
+        # Taken from the entries and printed a chunk at a time, rather
+        # than all of them at once
+        while True:
+            chunk = list(itertools.islice(entries,
+                                          page_size or HISTORY_PAGE_SIZE))
+            if not chunk:
+                break
+            if page_size and shown:
+                if input("Press return for more, or q to stop ") == "q":
+                    break
+            shown += len(chunk)
+            lines = []
+            for item, timestamp, mode in chunk:
+                if mode == "add":
+                    lines.append(f"  Task {item} was added on - {timestamp.strftime('%a %d-%b %Y %H:%M')}")
+                    # print(f"  {timestamp")
+                elif mode == "rmv":
+                    lines.append(f"  Task {item} was comleted on - {timestamp.day}")
+            print("\n".join(lines))
 
 
 
-time_stampedTDL = TimeStampedToDoList()
+def parse_history_filter(words, now=None):
+    # "history [add|rmv] [today|week|YYYY-MM-DD|YYYY-MM-DD..YYYY-MM-DD]"
+    # gives (mode, start, end); dates are whole days
+    now = now or datetime.datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    mode = start = end = None
+    for word in words:
+        if word in ("add", "rmv"):
+            mode = word
+        elif word == "today":
+            start = today
+        elif word == "week":
+            start = today - datetime.timedelta(days=7)
+        else:
+            first, _, last = word.partition("..")
+            start = datetime.datetime.strptime(first, "%Y-%m-%d")
+            end = datetime.datetime.strptime(last or first, "%Y-%m-%d")
+            end += datetime.timedelta(days=1)
+    return mode, start, end
 
-to_do_list = ToDoList(time_stampedTDL)
-if os.path.exists('history.pickle'):
-    with open('history.pickle', 'rb') as f:
-        time_stampedTDL.to_do_list = pickle.load(f)
-if os.path.exists('current.pickle'):
-    with open('current.pickle', 'rb') as f:
-        to_do_list.to_do_list = pickle.load(f)
 
-while True:
-    action = input("What would you like to do? (add/remove/view/history/save/quit) ")
+def main():
+    parser = argparse.ArgumentParser(description="To Do List")
+    parser.add_argument(
+        "--backend",
+        choices=("journal", "sqlite"),
+        default=os.environ.get("TODO_BACKEND", "journal"),
+        help="Where to keep the tasks and history: pickles and a journal, "
+        "or an SQLite database queried without loading the history "
+        "(default: $TODO_BACKEND or journal)",
+    )
+    args = parser.parse_args()
 
-    if action == "add" or action == "a" or action == "1":
-        item = input("What task would you like to add to the To Do List? ")
-        to_do_list.add_to_list(item)
+    if args.backend == "sqlite":
+        storage = SqliteStorage()
+    else:
+        storage = JournalStorage()
+    time_stampedTDL = TimeStampedToDoList(storage)
+    to_do_list = ToDoList(time_stampedTDL)
+    storage.load(to_do_list, time_stampedTDL)
 
-    elif action == "remove" or action == "r" or action == "2":
-        item = input("What task would you like to remove from the To Do List? ")
-        
-        to_do_list.remove_from_list(item)
-    elif action == "history" or action == "h" or action == "5":
+    try:
+        while True:
+            action = input("What would you like to do? (add/remove/view/history/save/quit) ")
+            # history can be followed by filters
+            action, *words = action.split() or [""]
+
+            if action == "add" or action == "a" or action == "1":
+                item = input("What task would you like to add to the To Do List? ")
+                to_do_list.add_to_list(item)
+
+            elif action == "remove" or action == "r" or action == "2":
+                item = input("What task would you like to remove from the To Do List? ")
         
-        time_stampedTDL.view_list_with_timestamps()
-    elif action == "view" or action == "v" or action == "3":
-        to_do_list.view_list()
-    elif action == "save" or action == "s" or action == "6":
-        print("Saving current tasks and history to binary")
-        with open('current.pickle', 'wb') as f:
-            pickle.dump(to_do_list.to_do_list, f)
-        with open('history.pickle', 'wb') as f:
-            pickle.dump(time_stampedTDL.to_do_list, f)
-    elif action == "quit" or action == "q" or action == "4":
-        break
+                to_do_list.remove_from_list(item)
+            elif action == "history" or action == "h" or action == "5":
+                try:
+                    mode, start, end = parse_history_filter(words)
+                except ValueError:
+                    print("Usage: history [add|rmv] [today|week|YYYY-MM-DD"
+                          "|YYYY-MM-DD..YYYY-MM-DD]")
+                    continue
+                time_stampedTDL.view_list_with_timestamps(
+                    mode, start, end, HISTORY_PAGE_SIZE)
+            elif action == "view" or action == "v" or action == "3":
+                to_do_list.view_list()
+            elif action == "save" or action == "s" or action == "6":
+                # Every change is already in the journal: this only compacts it
+                print("Saving current tasks and history to binary")
+                storage.snapshot()
+            elif action == "quit" or action == "q" or action == "4":
+                break
 
-    else:
-        print("Invalid input. Please try again.")
\ No newline at end of file
+            else:
+                print("Invalid input. Please try again.")
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    main()
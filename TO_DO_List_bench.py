@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+"""
+    Benchmarks for TO_DO_List.py.
+
+    The journal benchmark compares, for histories of increasing size, what
+    recording one event costs: re-pickling the tasks and the whole history
+    as the "save" command used to, or appending it to the journal. It also
+    measures loading the snapshot and replaying the journal at startup.
+
+    The history benchmark times the first page of filtered history views,
+    such as what was completed in the last week, for histories of
+    increasing size: filtering the whole list, the bisected in-memory
+    history, and the indexed SQLite backend. The last two should not
+    depend on the size of the history.
+
+    The store benchmark adds tasks, with duplicate names, then removes all
+    of them in a shuffled order, with a plain list as ToDoList used to
+    keep them and with TaskStore, and checks that both leave the tasks in
+    the same order along the way.
+
+    The memory benchmark builds histories of millions of events in a fresh
+    interpreter each, as a list of (item, datetime, mode) tuples and as a
+    columnar History, and maps the History back from its binary file,
+    reporting how much memory each takes.
+
+    The startup benchmark measures, for histories of increasing size kept
+    as the old pickles and as a snapshot, how long TO_DO_List.py takes to
+    show its first prompt, and how much of the load is left for the first
+    use of the history.
+
+    Usage: TO_DO_List_bench.py journal [--history N,...] [--ops N]
+           TO_DO_List_bench.py history [--history N,...] [--samples N]
+           TO_DO_List_bench.py store [--tasks N,...] [--list-limit N]
+           TO_DO_List_bench.py memory [--events N,...]
+           TO_DO_List_bench.py startup [--history N,...] [--samples N]
+"""
+
+import argparse
+import contextlib
+import datetime
+import itertools
+import os
+import pickle
+import json
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import TO_DO_List  # noqa: E402
+
+HISTORY_SIZES = (1000, 10000, 100000)
+STORE_SIZES = (1000, 10000, 100000, 1000000)
+MEMORY_SIZES = (1000000, 10000000)
+QUERY_HISTORY_SIZES = (10000, 100000, 1000000)
+STARTUP_SIZES = (0, 10000, 100000, 1000000)
+PROMPT = b"What would you like to do?"
+
+# Runs in the child interpreter: build or map a history, then report how
+# much the peak RSS grew, as JSON
+MEMORY_PROBE = r'''
+import datetime, json, resource, sys, time
+here, kind, events, path = sys.argv[1:]
+sys.path.insert(0, here)
+import TO_DO_List
+events = int(events)
+start = datetime.datetime(2022, 12, 10, 19, 21, 57)
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+began = time.perf_counter()
+
+if kind == 'mapped':
+    history = TO_DO_List.History.open(path)
+    history[-1]
+else:
+    history = [] if kind == 'tuples' else TO_DO_List.History()
+    for i in range(events):
+        history.append((
+            'Task number %d' % (i // 2),
+            start + datetime.timedelta(seconds=60 * i),
+            'add' if i % 2 == 0 else 'rmv',
+        ))
+    if path:
+        with open(path, 'wb') as f:
+            history.save(f)
+
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+json.dump({
+    'events': len(history),
+    'rss_kib': after - before,
+    'seconds': time.perf_counter() - began,
+}, sys.stdout)
+'''
+
+# (name, mode, days ago the range starts, days ago it ends)
+HISTORY_QUERIES = (
+    ('completed this week', 'rmv', 7, None),
+    ('added on a day', 'add', 30, 29),
+    ('everything', None, None, None),
+)
+
+
+def make_state(events, end=None, step=1):
+    # A history of events alternately adding and completing tasks, with
+    # one task in ten left to do, step seconds apart
+    if end is None:
+        start = datetime.datetime(2022, 12, 10, 19, 21, 57)
+    else:
+        start = end - datetime.timedelta(seconds=events * step)
+    history = []
+    current = []
+
+    for i in range(events):
+        item = 'Task number %d' % (i // 2)
+        timestamp = start + datetime.timedelta(seconds=i * step)
+
+        if i % 2 == 0:
+            history.append((item, timestamp, 'add'))
+            current.append(item)
+        elif i % 20 != 1:
+            history.append((item, timestamp, 'rmv'))
+            # The task that was just added
+            current.pop()
+
+    return current, history
+
+
+def write_legacy_state(directory, current, history):
+    with open(os.path.join(directory, TO_DO_List.CURRENT_FILE), 'wb') as f:
+        pickle.dump(current, f)
+    with open(os.path.join(directory, TO_DO_List.HISTORY_FILE), 'wb') as f:
+        pickle.dump(history, f)
+
+
+def open_lists(directory):
+    storage = TO_DO_List.JournalStorage(directory, snapshot_every=10 ** 9)
+    history = TO_DO_List.TimeStampedToDoList(storage)
+    to_do_list = TO_DO_List.ToDoList(history)
+    storage.load(to_do_list, history)
+    return storage, to_do_list
+
+
+def benchmark_journal(args):
+    print('%10s %14s %14s %14s'
+          % ('history', 'pickle us/op', 'journal us/op', 'startup ms'))
+
+    for events in args.history:
+        directory = tempfile.mkdtemp(prefix='todo-bench-')
+
+        try:
+            current, history = make_state(events)
+            write_legacy_state(directory, current, history)
+            storage, to_do_list = open_lists(directory)
+
+            # What "save" after every change used to cost
+            pickle_times = []
+
+            for _ in range(min(args.ops, 20)):
+                start = time.perf_counter()
+                write_legacy_state(directory, current, history)
+                pickle_times.append(time.perf_counter() - start)
+
+            journal_times = []
+
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                for i in range(args.ops):
+                    start = time.perf_counter()
+                    to_do_list.add_to_list('Benchmark task %d' % i)
+                    journal_times.append(time.perf_counter() - start)
+
+            storage.close()
+
+            # Loads the old pickles and replays the journal of the ops
+            start = time.perf_counter()
+            storage, to_do_list = open_lists(directory)
+            startup = time.perf_counter() - start
+            storage.close()
+
+            print('%10d %14.1f %14.1f %14.1f'
+                  % (events,
+                     statistics.median(pickle_times) * 1e6,
+                     statistics.median(journal_times) * 1e6,
+                     startup * 1e3))
+            sys.stdout.flush()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return 0
+
+
+def time_first_page(entries, samples):
+    times = []
+
+    for _ in range(samples):
+        start = time.perf_counter()
+        page = list(itertools.islice(entries(), TO_DO_List.HISTORY_PAGE_SIZE))
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times), page
+
+
+def benchmark_history(args):
+    now = datetime.datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    print('%10s %-20s %10s %10s %10s'
+          % ('history', 'query', 'scan ms', 'list ms', 'sqlite ms'))
+
+    for events in args.history:
+        directory = tempfile.mkdtemp(prefix='todo-bench-')
+
+        try:
+            # One event a minute up to now
+            current, history = make_state(events, now, 60)
+            write_legacy_state(directory, current, history)
+            in_memory = TO_DO_List.TimeStampedToDoList()
+            in_memory.to_do_list = TO_DO_List.History(history)
+            storage = TO_DO_List.SqliteStorage(directory)
+            storage.load(TO_DO_List.ToDoList(None), None)
+
+            for (name, mode, since, until) in HISTORY_QUERIES:
+                start = end = None
+
+                if since is not None:
+                    start = today - datetime.timedelta(days=since)
+                if until is not None:
+                    end = today - datetime.timedelta(days=until)
+
+                def scan():
+                    # Without an index: filter the whole history
+                    return (e for e in [
+                        e for e in history
+                        if (mode is None or e[2] == mode)
+                        and (start is None or e[1] >= start)
+                        and (end is None or e[1] < end)
+                    ])
+
+                scanned, expected = time_first_page(scan, args.samples)
+                bisected, page = time_first_page(
+                    lambda: in_memory.scan(mode, start, end), args.samples)
+                assert page == expected, name
+                queried, page = time_first_page(
+                    lambda: storage.query_history(mode, start, end),
+                    args.samples)
+                assert page == expected, name
+
+                print('%10d %-20s %10.3f %10.3f %10.3f'
+                      % (events, name, scanned * 1e3, bisected * 1e3,
+                         queried * 1e3))
+                sys.stdout.flush()
+
+            storage.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return 0
+
+
+def benchmark_store(args):
+    print('%10s %12s %12s %12s'
+          % ('tasks', 'list ms', 'store ms', 'store us/op'))
+
+    for count in args.tasks:
+        rng = random.Random(count)
+        # About one name in four is used twice
+        items = ['Task number %d' % rng.randrange(count * 3 // 4 or 1)
+                 for _ in range(count)]
+        removals = list(items)
+        rng.shuffle(removals)
+        results = []
+
+        for kind in ('list', 'store'):
+            if kind == 'list' and count > args.list_limit:
+                results.append(None)
+                continue
+
+            tasks = [] if kind == 'list' else TO_DO_List.TaskStore()
+            add = tasks.append if kind == 'list' else tasks.add
+            start = time.perf_counter()
+
+            for item in items:
+                add(item)
+            for item in removals[:count // 2]:
+                if item in tasks:
+                    tasks.remove(item)
+            middle = list(tasks)
+            for item in removals[count // 2:]:
+                if item in tasks:
+                    tasks.remove(item)
+
+            results.append(time.perf_counter() - start)
+            assert not len(tasks)
+
+            if kind == 'list':
+                expected = middle
+            elif results[0] is not None:
+                assert middle == expected
+
+        print('%10d %12s %12.1f %12.3f'
+              % (count,
+                 '-' if results[0] is None else '%.1f' % (results[0] * 1e3),
+                 results[1] * 1e3,
+                 results[1] * 1e6 / (2 * count)))
+        sys.stdout.flush()
+
+    return 0
+
+
+def benchmark_memory(args):
+    print('%10s %-8s %10s %12s %10s'
+          % ('events', 'history', 'MiB', 'bytes/event', 'seconds'))
+    directory = tempfile.mkdtemp(prefix='todo-bench-')
+
+    try:
+        for events in args.events:
+            path = os.path.join(directory, 'history-%d.bin' % events)
+
+            for kind in ('tuples', 'columns', 'mapped'):
+                output = subprocess.check_output([
+                    sys.executable, '-c', MEMORY_PROBE, HERE, kind,
+                    str(events), path if kind != 'tuples' else '',
+                ])
+                result = json.loads(output)
+                assert result['events'] == events
+
+                print('%10d %-8s %10.1f %12.1f %10.2f'
+                      % (events, kind, result['rss_kib'] / 1024,
+                         result['rss_kib'] * 1024 / events,
+                         result['seconds']))
+                sys.stdout.flush()
+
+            print('%10d %-8s %10.1f %12.1f %10s'
+                  % (events, 'file', os.path.getsize(path) / 2 ** 20,
+                     os.path.getsize(path) / events, '-'))
+            os.unlink(path)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return 0
+
+
+def time_to_prompt(directory):
+    # From starting TO_DO_List.py to its first prompt being printed
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'TO_DO_List.py')],
+        cwd=directory, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = b''
+
+    while PROMPT not in output:
+        data = os.read(process.stdout.fileno(), 4096)
+        if not data:
+            raise RuntimeError('TO_DO_List.py exited before prompting')
+        output += data
+
+    elapsed = time.perf_counter() - start
+    process.communicate(b'quit\n')
+    return elapsed
+
+
+def benchmark_startup(args):
+    print('%10s %-9s %10s %10s %12s'
+          % ('history', 'state', 'prompt ms', 'load ms', 'history ms'))
+
+    for events in args.history:
+        directory = tempfile.mkdtemp(prefix='todo-bench-')
+
+        try:
+            current, history = make_state(events)
+            write_legacy_state(directory, current, history)
+
+            for state in ('pickles', 'snapshot'):
+                if state == 'snapshot':
+                    storage, to_do_list = open_lists(directory)
+                    storage.snapshot()
+                    storage.close()
+
+                prompt = statistics.median(
+                    time_to_prompt(directory) for _ in range(args.samples))
+
+                # In this process: loading the tasks, then the history
+                start = time.perf_counter()
+                storage, to_do_list = open_lists(directory)
+                loaded = time.perf_counter() - start
+                len(to_do_list.TimeStampedTDL.to_do_list)
+                history_loaded = time.perf_counter() - start - loaded
+                storage.close()
+
+                print('%10d %-9s %10.1f %10.1f %12.1f'
+                      % (events, state, prompt * 1e3, loaded * 1e3,
+                         history_loaded * 1e3))
+                sys.stdout.flush()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return 0
+
+
+def int_list(text):
+    return [int(n) for n in text.split(',') if n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TO_DO_List')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    journal = subparsers.add_parser(
+        'journal',
+        help="Compare re-pickling everything with appending to the journal",
+    )
+    journal.add_argument(
+        '--history',
+        type=int_list,
+        default=HISTORY_SIZES,
+        help="Comma-separated numbers of history events",
+    )
+    journal.add_argument(
+        '--ops',
+        type=int,
+        default=1000,
+        help="Number of events to record per history size",
+    )
+    journal.set_defaults(function=benchmark_journal)
+
+    history = subparsers.add_parser(
+        'history',
+        help="Time filtered history views with and without indexes",
+    )
+    history.add_argument(
+        '--history',
+        type=int_list,
+        default=QUERY_HISTORY_SIZES,
+        help="Comma-separated numbers of history events",
+    )
+    history.add_argument(
+        '--samples',
+        type=int,
+        default=5,
+        help="Number of times each query is timed",
+    )
+    history.set_defaults(function=benchmark_history)
+
+    store = subparsers.add_parser(
+        'store',
+        help="Compare adding and removing tasks with a list and TaskStore",
+    )
+    store.add_argument(
+        '--tasks',
+        type=int_list,
+        default=STORE_SIZES,
+        help="Comma-separated numbers of tasks",
+    )
+    store.add_argument(
+        '--list-limit',
+        type=int,
+        default=20000,
+        help="Skip the list, which is quadratic, above this many tasks",
+    )
+    store.set_defaults(function=benchmark_store)
+
+    memory = subparsers.add_parser(
+        'memory',
+        help="Compare the memory used by the history representations",
+    )
+    memory.add_argument(
+        '--events',
+        type=int_list,
+        default=MEMORY_SIZES,
+        help="Comma-separated numbers of history events",
+    )
+    memory.set_defaults(function=benchmark_memory)
+
+    startup = subparsers.add_parser(
+        'startup',
+        help="Time TO_DO_List.py to its first prompt",
+    )
+    startup.add_argument(
+        '--history',
+        type=int_list,
+        default=STARTUP_SIZES,
+        help="Comma-separated numbers of history events",
+    )
+    startup.add_argument(
+        '--samples',
+        type=int,
+        default=5,
+        help="Number of times TO_DO_List.py is started per history size",
+    )
+    startup.set_defaults(function=benchmark_startup)
+
+    args = parser.parse_args()
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
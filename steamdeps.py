@@ -8,13 +8,21 @@
 """
 
 import argparse
+import contextlib
+import functools
 import glob
+import hashlib
+import json
 import logging
+import mmap
 import os
 import re
 import shlex
+import shutil
 import subprocess
 import sys
+import threading
+import time
 
 from steam_launcher.launcherutils import run_subprocess
 
@@ -29,13 +37,12 @@ try:
 except ImportError:
     pass
 
-try:
-    import apt
-    from aptsources.sourceslist import SourceEntry
-except ImportError:
-    sys.stderr.write("Couldn't import apt, please install python3-apt or "
-                     "update steamdeps for your distribution.\n")
-    sys.exit(3)
+# python-apt is imported on first use by import_apt() and
+# import_aptsources(), so that the runs that never look at the apt cache
+# (re-executing in a terminal, answering from the verdict cache...)
+# don't have to load it
+apt = None
+SourceEntry = None
 
 
 logger = logging.getLogger('steamdeps')
@@ -50,23 +57,279 @@ SUPPORTED_STEAM_DEPENDENCY_VERSION = ['1']
 # under pkexec
 PASS_THROUGH_ENV_VARS = (
     'SL_TEST_NVIDIA_VERSION',
+    'STEAMDEPS_APT_UPDATE_TTL',
+    'STEAMDEPS_BACKEND',
+    'STEAMDEPS_INSTALL_MODE',
+    'STEAMDEPS_PROGRESS',
     'STEAM_LAUNCHER_VERBOSE',
     'XDG_CURRENT_DESKTOP',
 )
 
+# The dpkg database of installed packages, and the list of foreign
+# architectures that dpkg --add-architecture maintains
+DPKG_STATUS_PATH = '/var/lib/dpkg/status'
+DPKG_ARCH_PATH = '/var/lib/dpkg/arch'
+
+# Where apt keeps the downloaded lists of available packages, and the
+# lists of repositories they come from
+APT_LISTS_DIR = '/var/lib/apt/lists'
+APT_SOURCES_LIST = '/etc/apt/sources.list'
+APT_SOURCES_PARTS = '/etc/apt/sources.list.d'
+
+OS_RELEASE_PATHS = ('/etc/os-release', '/usr/lib/os-release')
+
+# The only apt repository whose synchronization we care about
+STEAM_REPO_URI = 'https://repo.steampowered.com/steam'
+APT_SYNC_CACHE_FILE = 'apt-sync.json'
+
+# Size and duration of the last apt-get update of each kind, to estimate
+# how much a skipped or targeted update saved
+APT_UPDATE_CACHE_FILE = 'apt-update.json'
+
+# Compact index of the packages available from the apt lists
+AVAILABLE_INDEX_FILE = 'available-packages.index'
+AVAILABLE_INDEX_VERSION = 2
+
+# With the low-memory backend (--backend=lowmem), installed packages are
+# looked up in the index above instead of apt.Cache() and the dpkg
+# snapshot, so that the peak RSS of an evaluation stays below this
+# ceiling however many packages are installed or available. Rebuilding
+# the index after the lists or the dpkg database changed is included:
+# the lists are read in blocks, not mapped. steamdeps_bench.py memory
+# checks it, with a list larger than those of real distributions.
+LOW_MEMORY_CEILING_MIB = 64
+
+# Deb822 files like the apt lists and the dpkg status are read in blocks
+# of this size
+DEB822_READ_SIZE = 1024 * 1024
+
+# Precompiled form of a dependencies file, stored next to it as
+# .<name>.compiled.json
+PRECOMPILED_DEPENDENCIES_VERSION = 1
+
+# Which option makes gnome-terminal wait for its command, per binary
+TERMINAL_CACHE_FILE = 'terminal.json'
+
+# How long to wait for a startup probe before carrying on with its
+# default answer. Subprocesses started by the probe are killed then.
+PROBE_TIMEOUT = 30
+
+# Bump this when the format or the meaning of the cached verdicts changes
+VERDICT_CACHE_VERSION = 3
+VERDICT_CACHE_FILE = 'verdicts.json'
+
+# Unix socket that --daemon listens on, in $XDG_RUNTIME_DIR or the cache
+# directory
+DAEMON_SOCKET_NAME = 'steamdeps.sock'
+
+# Bump this when the format of the state handed to re-executed children
+# changes
+HANDOFF_STATE_VERSION = 1
+
+# Bump this when the format of the --report=json output changes
+PROFILE_REPORT_VERSION = 2
+PROFILE_REPORT_FILE = 'report.json'
+
 _arch = None
 _foreign_architectures = None
+_apt_session = None
+_dpkg_status = None
+_available_index = None
+_available_index_lock = threading.Lock()
+_glvnd = None
+_remap_table = None
+_glvnd_lock = threading.Lock()
+_xdg_portal_backends = {}   # type: typing.Dict[str, typing.Optional[str]]
+_xdg_portal_backends_lock = threading.Lock()
+_apt_lists_refreshed = False
+_i386_just_enabled = False
+# Probe results handed over by the process that re-executed us
+_handoff_probes = {}        # type: typing.Dict[str, typing.Any]
+# Enabled by --profile or --report
+_profiler = None            # type: typing.Optional[Profiler]
+# When the probe running in this thread, if any, has to be done by
+_probe_deadline = threading.local()
+
+
+class Profiler:
+    """
+    Record the wall time, subprocesses and memory of each phase of a
+    run. Phases nest, and a subprocess counts towards every phase that
+    is open in the thread that started it, so probes that run in worker
+    threads are accounted separately from the main thread.
+
+    The kernel only keeps the peak RSS of the whole process (and of the
+    largest child reaped), so what a phase records is how much it raised
+    that peak: a phase that stays below an earlier peak records 0. The
+    memory is the process's, so phases running at the same time in
+    other threads share the growth.
+    """
 
-
-class OsRelease:
     def __init__(self):
         # type: () -> None
-        self._load_any()
+        self.start_time = time.monotonic()
+        self.phases = []    # type: typing.List[typing.Dict[str, typing.Any]]
+        self.subprocesses = {}      # type: typing.Dict[str, int]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        # subprocess.run(), check_output() and friends all go through
+        # subprocess.Popen, so replacing it catches every fork
+        profiler = self
+
+        class CountingPopen(subprocess.Popen):
+            def __init__(self, args, *rest, **kwargs):
+                profiler.count_subprocess(args)
+                super().__init__(args, *rest, **kwargs)
+
+        subprocess.Popen = CountingPopen    # type: ignore
+
+    def count_subprocess(self, args):
+        # type: (typing.Any) -> None
+        if isinstance(args, (str, bytes)):
+            args = shlex.split(os.fsdecode(args))
+
+        name = os.path.basename(os.fsdecode(args[0])) if args else '?'
+
+        with self._lock:
+            self.subprocesses[name] = self.subprocesses.get(name, 0) + 1
+
+            for record in getattr(self._local, 'stack', []):
+                counts = record['subprocesses']
+                counts[name] = counts.get(name, 0) + 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # type: (str) -> typing.Iterator[None]
+        import resource
+
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+
+        start_time = time.monotonic()
+        # Linux reports these in KiB
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children_peak_rss = resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss
+        record = {
+            'name': name,
+            'thread': threading.current_thread().name,
+            'depth': len(self._local.stack),
+            'start_ms': (start_time - self.start_time) * 1000,
+            'subprocesses': {},
+        }   # type: typing.Dict[str, typing.Any]
+        self._local.stack.append(record)
+
+        try:
+            yield
+        finally:
+            self._local.stack.pop()
+            record['wall_ms'] = (time.monotonic() - start_time) * 1000
+            record['peak_rss_growth_kib'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss - peak_rss
+            record['children_peak_rss_growth_kib'] = resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss - children_peak_rss
+
+            with self._lock:
+                self.phases.append(record)
+
+    def report(self, argv, status):
+        # type: (typing.List[str], typing.Any) -> typing.Dict[str, typing.Any]
+        import resource
+
+        return {
+            'version': PROFILE_REPORT_VERSION,
+            'argv': argv,
+            'exit_status': status,
+            'wall_ms': (time.monotonic() - self.start_time) * 1000,
+            'subprocesses': self.subprocesses,
+            'peak_rss_kib': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+            'children_peak_rss_kib': resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss,
+            'phases': sorted(self.phases, key=lambda p: p['start_ms']),
+        }
+
+
+def profile_phase(name):
+    # type: (str) -> typing.Any
+    """
+    Return a context manager that records name as a phase if profiling
+    is enabled, and does nothing otherwise
+    """
+    if _profiler is None:
+        return contextlib.ExitStack()
+
+    return _profiler.phase(name)
+
+
+def profiled(name):
+    # type: (str) -> typing.Callable
+    """
+    Decorator recording each call of the function as a phase
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile_phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _python_apt_missing():
+    sys.stderr.write("Couldn't import apt, please install python3-apt or "
+                     "update steamdeps for your distribution.\n")
+    sys.exit(3)
+
+
+def import_apt():
+    # type: () -> None
+    """
+    Import the apt module of python-apt, or exit if it is not available
+    """
+    global apt
+
+    if apt is None:
+        try:
+            import apt
+        except ImportError:
+            _python_apt_missing()
+
+
+def import_aptsources():
+    # type: () -> None
+    """
+    Import the aptsources module of python-apt, or exit if it is not
+    available
+    """
+    global SourceEntry
+
+    if SourceEntry is None:
+        try:
+            from aptsources.sourceslist import SourceEntry
+        except ImportError:
+            _python_apt_missing()
+
+
+class OsRelease:
+    def __init__(
+        self,
+        data=None,      # type: typing.Optional[typing.Dict[str, str]]
+    ):
+        # type: (...) -> None
+        if data is None:
+            self._load_any()
+        else:
+            self._data = data
+
         self._is_like = self._data.get('ID_LIKE', '').split()
 
     def _load_any(self):
         # type: () -> None
-        for path in ('/etc/os-release', '/usr/lib/os-release'):
+        for path in OS_RELEASE_PATHS:
             self._data = self._load(path)
 
             if self._data:
@@ -115,6 +378,10 @@ class OsRelease:
     def dump(self):
         print(self._data, file=sys.stderr)
 
+    def to_dict(self):
+        # type: () -> typing.Dict[str, str]
+        return dict(self._data)
+
 
 #
 # Get the current package architecture
@@ -129,7 +396,9 @@ def get_arch():
 
     if _arch is None:
         _arch = subprocess.check_output(
-            ['dpkg', '--print-architecture']).decode("utf-8").strip()
+            ['dpkg', '--print-architecture'],
+            timeout=get_probe_timeout(),
+        ).decode("utf-8").strip()
     return _arch
 
 
@@ -143,306 +412,1441 @@ def get_foreign_architectures():
         _foreign_architectures = subprocess.check_output(
             ['dpkg', '--print-foreign-architectures'],
             universal_newlines=True,
+            timeout=get_probe_timeout(),
         ).splitlines()
     return _foreign_architectures
 
 
-# N.B. Version checks are not supported on virtual packages
-#
-def is_provided(pkgname):
+class AptCacheSession:
     """
-    Check to see if another package Provides this package
+    A python-apt cache that is opened on first use and then shared by
+    every lookup for the rest of the run, because opening it re-reads the
+    whole package database.
     """
-    cache = apt.Cache()
-    pkgs = cache.get_providing_packages(pkgname)
-    for pkg in pkgs:
-        if pkg.is_installed:
+
+    def __init__(self):
+        # type: () -> None
+        self._cache = None      # type: typing.Any
+        # Names provided by installed packages, built on first use
+        self._installed_provides = None     # type: typing.Optional[set]
+        # The cache can be opened by a startup probe in the background
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        # type: () -> typing.Any
+        with self._lock:
+            if self._cache is None:
+                logger.debug('Opening apt cache...')
+
+                with profile_phase('apt.Cache'):
+                    import_apt()
+                    self._cache = apt.Cache()
+            return self._cache
+
+    def invalidate(self):
+        # type: () -> None
+        """
+        Forget the cache, e.g. after the lists of packages were updated
+        """
+        with self._lock:
+            self._cache = None
+            self._installed_provides = None
+
+    def is_installed(self, name):
+        # type: (str) -> bool
+        cache = self.cache
+        return name in cache and cache[name].is_installed
+
+    def is_provided(self, name):
+        # type: (str) -> bool
+        """
+        Return True if an installed package Provides the virtual package
+        called name. Like apt.Cache.get_providing_packages(), only purely
+        virtual packages are considered and only the Provides of the
+        candidate version are taken into account.
+        """
+        if self._installed_provides is None:
+            self._installed_provides = self._index_installed_provides()
+
+        if name not in self._installed_provides:
+            return False
+
+        try:
+            return not self.cache._cache[name].has_versions
+        except KeyError:
             return True
-    return False
 
+    def _index_installed_provides(self):
+        # type: () -> typing.Set[str]
+        # Build the reverse Provides index once, so that each check
+        # afterwards is a set lookup
+        provided = set()    # type: typing.Set[str]
+        get_candidate_ver = self.cache._depcache.get_candidate_ver
 
-###
-class Package:
+        for pkg in self.cache._cache.packages:
+            if pkg.current_ver is None:
+                continue
+
+            candidate = get_candidate_ver(pkg)
+
+            if candidate is None:
+                continue
+
+            for (name, _, _) in candidate.provides_list:
+                provided.add(name)
+                provided.add(name + ':' + pkg.architecture)
+
+        return provided
+
+
+def get_apt_session():
+    # type: () -> AptCacheSession
     """
-    Package definition class
+    Get the apt cache session shared by the whole run
     """
+    global _apt_session
 
-    def __init__(self, name, version_conditions):
-        self.name = name
-        self.version_conditions = version_conditions
-        self.installed = None
+    if _apt_session is None:
+        _apt_session = AptCacheSession()
+    return _apt_session
 
-    def set_installed(self, version):
-        self.installed = version
 
-    def is_available(self):
-        if self.installed is None:
-            # check to see if another package is providing this virtual package
-            return is_provided(self.name)
+def iter_deb822_stanzas(
+    path,       # type: str
+    fields,     # type: typing.Iterable[str]
+):
+    # type: (...) -> typing.Iterator[typing.Dict[str, str]]
+    """
+    Stream the stanzas of a deb822 file like the dpkg status database,
+    yielding the requested single-line fields of each stanza. The file is
+    read DEB822_READ_SIZE bytes at a time, so that the memory used doesn't
+    depend on its size: apt lists can be tens of megabytes.
+    """
+    field_pattern = re.compile(
+        rb"^(" + b"|".join(re.escape(f.encode('ascii')) for f in fields)
+        + rb"):[ \t]*([^\n]*?)[ \t]*$",
+        re.MULTILINE,
+    )
 
-        for (op, version) in self.version_conditions:
-            if subprocess.call(['dpkg', '--compare-versions', self.installed,
-                                op, version]) != 0:
-                return False
+    with open(path, 'rb') as f:
+        # The start of a stanza that continues in the next block
+        rest = b''
 
-        return True
+        while True:
+            block = f.read(DEB822_READ_SIZE)
 
-    def __str__(self):
-        text = self.name
-        for (op, version) in self.version_conditions:
-            text += " (%s %s)" % (op, version)
-        return text
+            if block:
+                data = rest + block
+                end = data.rfind(b'\n\n')
 
+                if end < 0:
+                    rest = data
+                    continue
 
-def is_glvnd():
-    try:
-        with subprocess.Popen(['apt-cache', 'pkgnames', 'libgl1'],
-                              stdout=subprocess.PIPE,) as process:
-            for line in process.stdout:
-                line = line.decode('utf-8').strip()
+                rest = data[end + 2:]
+            else:
+                data = rest
+                end = len(data)
 
-                if line == 'libgl1':
-                    return True
-            return False
-    except (OSError, FileNotFoundError):
-        return False
+            start = 0
 
+            while start < end:
+                stop = data.find(b'\n\n', start, end)
 
-def is_package_available(package_name):
-    try:
-        apt_output = subprocess.check_output(
-            ['apt-cache', '-q', 'show', package_name])
-        # On SteamOS "xdg-desktop-portal-gtk" is recommended by the backported
-        # version of flatpak, even if it is not available in the repositories.
-        # For this reason we also check the apt-cache -q show output before
-        # asserting that a package is really available.
-        return bool(apt_output)
-    except (OSError, FileNotFoundError, subprocess.CalledProcessError):
-        return False
+                if stop < 0:
+                    stop = end
 
+                stanza = {}     # type: typing.Dict[str, str]
 
-def choose_xdg_portal_backend(default_backend="xdg-desktop-portal-gtk"):
-    gtk_desktop = ["Cinnamon", "GNOME", "LXDE", "MATE", "Unity", "XFCE"]
-    kde_desktop = ["KDE"]
-    gtk_backend = "xdg-desktop-portal-gtk"
-    kde_backend = "xdg-desktop-portal-kde"
+                for match in field_pattern.finditer(data, start, stop):
+                    stanza[match.group(1).decode('ascii')] = \
+                        match.group(2).decode('utf-8', 'replace')
 
-    current_desktops = os.environ.get("XDG_CURRENT_DESKTOP", "").split(":")
+                if stanza:
+                    yield stanza
 
-    for c in current_desktops:
-        if c in gtk_desktop:
-            if is_package_available(gtk_backend):
-                return gtk_backend
-        elif c in kde_desktop:
-            if is_package_available(kde_backend):
-                return kde_backend
+                start = stop + 2
 
-    if is_package_available(default_backend):
-        return default_backend
-    else:
-        sys.stderr.write(
-            "There isn't a known XDG portal backend that can be installed\n")
-        return None
+            if not block:
+                break
 
 
-def expected_nvidia_packages():
-    # type: (...) -> typing.Dict[str, Package]
-    # Returns a map like:
-    # {"nvidia-driver-libs:amd64": Package("nvidia-driver-libs:amd64", [])}
-    nvidia_packages_to_check = {}       # type: typing.Dict[str, Package]
-    nvidia_packages_to_expect = {}      # type: typing.Dict[str, Package]
+class DpkgStatus:
+    """
+    Snapshot of the installed packages, read directly from the dpkg
+    status database instead of scraping "dpkg -l"
+    """
 
-    if get_arch() != 'amd64':
-        return nvidia_packages_to_expect
+    @profiled('read dpkg status')
+    def __init__(
+        self,
+        path=None,      # type: typing.Optional[str]
+    ):
+        # type: (...) -> None
+        if path is None:
+            path = DPKG_STATUS_PATH
 
-    try:
-        nvidia_version = os.environ.get("SL_TEST_NVIDIA_VERSION")
-        if not nvidia_version:
-            with open('/sys/module/nvidia/version') as f:
-                nvidia_version = f.read()
-        nvidia_major_version = nvidia_version.split('.')[0]
-    except OSError:
-        # If the Nvidia module is not loaded, it's safe to assume that the
-        # Nvidia drivers are not in use. No need to install anything else.
-        return nvidia_packages_to_expect
+        self.path = path
+        self.stamp = file_stamp(path)
+        # name -> {architecture: version}
+        self._installed = {}    # type: typing.Dict[str, typing.Dict[str, str]]
 
-    for name in (
-        # Debian packages
-        "nvidia-driver-libs:amd64",
-        "nvidia-legacy-{}xx-driver-libs:amd64".format(nvidia_major_version),
-        "nvidia-tesla-{}-driver-libs:amd64".format(nvidia_major_version),
-        "nvidia-alternative",
-        "nvidia-legacy-{}xx-alternative".format(nvidia_major_version),
-        "nvidia-tesla-{}-alternative".format(nvidia_major_version),
+        try:
+            stanzas = iter_deb822_stanzas(
+                path, ('Package', 'Status', 'Architecture', 'Version'),
+            )
 
-        # Ubuntu 18.04+ packages
-        "libnvidia-gl-{}:amd64".format(nvidia_major_version),
-        "libnvidia-gl-{}-server:amd64".format(nvidia_major_version),
-    ):
-        nvidia_packages_to_check[name] = Package(name, [])
+            for stanza in stanzas:
+                if not stanza.get('Status', '').endswith(' installed'):
+                    continue
 
-    update_installed_packages(nvidia_packages_to_check)
+                self._installed.setdefault(stanza['Package'], {})[
+                    stanza.get('Architecture', '')
+                ] = stanza.get('Version', '')
+        except (OSError, KeyError) as e:
+            logger.warning('Unable to read %s: %s', path, e)
 
-    for pkg_name in nvidia_packages_to_check:
-        if nvidia_packages_to_check[pkg_name].installed:
-            if pkg_name.endswith("-alternative"):
-                # If we have a Nvidia kernel module and the "*-alternative"
-                # package is installed, we want to ensure that the related
-                # user-space "*-driver-libs" are also installed, in both
-                # amd64 and i386 architectures
-                driver_libs = pkg_name.replace("-alternative", "-driver-libs")
-                nvidia_packages_to_expect[driver_libs + ":amd64"] = Package(
-                    driver_libs + ":amd64", []
-                )
-                nvidia_packages_to_expect[driver_libs + ":i386"] = Package(
-                    driver_libs + ":i386", []
-                )
-            else:
-                # Ensure that the i386 variant is installed too
-                assert pkg_name.endswith(":amd64")
-                name_i386 = pkg_name.replace(":amd64", ":i386")
-                nvidia_packages_to_expect[name_i386] = Package(name_i386, [])
+    def get_installed_version(self, name):
+        # type: (str) -> typing.Optional[str]
+        """
+        Return the installed version of "name" or "name:arch", or None.
+        Like dpkg, a name without architecture matches any architecture,
+        preferring the native one.
+        """
+        if ':' in name:
+            name, arch = name.rsplit(':', 1)
+            return self._installed.get(name, {}).get(arch)
 
-    if len(nvidia_packages_to_expect) == 0:
-        print("Unable to determine whether the expected Nvidia drivers "
-              "are available.")
-        print("The Steam client may have limited functionality.")
+        versions = self._installed.get(name)
 
-    return nvidia_packages_to_expect
+        if not versions:
+            return None
 
+        for arch in (get_arch(), 'all'):
+            if arch in versions:
+                return versions[arch]
 
-def remap_package(name):
-    if name in (
-            'python-apt',
-    ):
-        # Steam claims it needs python-apt, but it doesn't really
-        return None
+        return next(iter(versions.values()))
 
-    # Ubuntu 12.04.2, 12.04.3, and 12.04.4 introduce new X stacks which require
-    # different sets of incompatible glx packages depending on which X
-    # is currently installed.
 
-    cache = apt.Cache()
-    for lts in ('quantal', 'raring', 'saucy', 'trusty', 'xenial'):
-        xserver = 'xserver-xorg-core-lts-' + lts
-        if xserver in cache and cache[xserver].is_installed:
-            if name in (
-                    'libegl1-mesa',
-                    'libgbm1',
-                    'libgl1-mesa-glx',
-                    'libgl1-mesa-dri',
-            ):
-                return name + '-lts-' + lts
+def file_stamp(path):
+    # type: (str) -> typing.Optional[typing.List[int]]
+    """
+    Return something that changes whenever the file or directory at path
+    is modified, or None if it doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
 
-            if name in (
-                    'libegl1',
-            ):
-                return name + '-mesa-lts-' + lts
+    return [st.st_mtime_ns, st.st_size]
 
-    if name in ('libegl1', 'libegl1-mesa'):
-        if is_glvnd():
-            return 'libegl1'
-        else:
-            return 'libegl1-mesa'
 
-    if name == 'libgl1-mesa-glx':
-        if is_glvnd():
-            return 'libgl1'
+def get_dpkg_status():
+    # type: () -> DpkgStatus
+    """
+    Get the snapshot of installed packages, reading the dpkg status
+    database again only if it was modified since the last time
+    """
+    global _dpkg_status
 
-    return name
+    if (
+        _dpkg_status is None
+        or _dpkg_status.stamp != file_stamp(_dpkg_status.path)
+    ):
+        _dpkg_status = DpkgStatus()
+    return _dpkg_status
 
 
-###
-def create_package(description):
+class _SortedLines:
     """
-    Create a package object based on a description.
-    This can return None if the package isn't meaningful on this platform.
+    Tab-separated records that are written out sorted and without
+    duplicates. Sorted runs are spilled to temporary files and merged at
+    the end, so that indexing large apt lists takes bounded memory.
     """
-    # Look for architecture conditions, e.g. foo [i386]
-    match = re.match(r"(.*) \[([^\]]+)\]", description)
-    if match is not None:
-        description = match.group(1).strip()
-        condition = match.group(2)
-        if condition[0] == '!':
-            if get_arch() == condition[1:]:
-                return None
-        else:
-            if get_arch() != condition:
-                return None
 
-    # Look for version requirements, e.g. foo (>= 1.0)
-    version_conditions = []
-    while True:
-        match = re.search(r"\s*\(\s*([<>=]+)\s*([\w\-.:]+)\s*\)\s*",
-                          description)
-        if match is None:
-            break
+    RUN_LENGTH = 16384
 
-        version_conditions.append((match.group(1), match.group(2)))
-        description = description[:match.start()] + description[match.end():]
+    def __init__(self, directory):
+        # type: (str) -> None
+        self._directory = directory
+        self._lines = []    # type: typing.List[bytes]
+        self._runs = []     # type: typing.List[typing.Any]
 
-    description = description.strip()
+    def add(self, *fields):
+        # type: (*str) -> None
+        self._lines.append('\t'.join(fields).encode('utf-8') + b'\n')
 
-    if ':' in description:
-        name, multiarch = description.rsplit(':', 1)
-    else:
-        name = description
-        multiarch = None
+        if len(self._lines) >= self.RUN_LENGTH:
+            self._spill()
 
-    name = remap_package(name)
+    def _spill(self):
+        # type: () -> None
+        import tempfile
 
-    if name in (
-            "xdg-desktop-portal-gtk",
-            "xdg-desktop-portal-kde",
-    ):
-        name = choose_xdg_portal_backend(name)
-        # Skip version conditions for portal backends because we don't know
-        # in advance which backend we will need to install.
-        # In the future, if necessary, we can enhance this check and, for
-        # example, embed a minimum version for each possible backed.
-        version_conditions = []
+        run = tempfile.TemporaryFile(dir=self._directory)
+        self._lines.sort()
+        run.writelines(self._lines)
+        run.seek(0)
+        self._runs.append(run)
+        self._lines = []
 
-    if name is None:
-        return None
-    elif multiarch is not None:
-        description = name + ':' + multiarch
-    else:
-        description = name
+    def write_to(self, writer):
+        # type: (typing.Any) -> None
+        import heapq
+
+        self._lines.sort()
+        previous = None
 
-    return Package(description, version_conditions)
+        try:
+            for line in heapq.merge(self._lines, *self._runs):
+                if line != previous:
+                    writer.write(line)
+                    previous = line
+        finally:
+            for run in self._runs:
+                run.close()
 
+            self._lines = []
+            self._runs = []
 
-###
-def get_terminal(
-    title       # type: str
-):
-    # type: (...) -> typing.List[str]
+
+class AvailablePackagesIndex:
     """
-    Function to find a useful terminal like xterm or compatible
+    Compact index of the packages that apt knows about, built from the
+    Packages lists in /var/lib/apt/lists and the dpkg status database.
+    It is stored in the cache directory and memory-mapped, so that
+    checking whether a package is available doesn't need apt-cache.
+
+    The file starts with a one-line JSON header, followed by sections
+    of tab-separated lines sorted by their first field, searched by
+    bisection:
+
+        packages:           name    arch    version    provides,...
+        provides:           virtual    provider    arch
+        installed:          name    arch    version
+        installed-provides: virtual    provider    arch
     """
-    if "DISPLAY" in os.environ:
-        gnome_wait_option = None
+
+    def __init__(self, path, data, header, body_offset):
+        # type: (str, typing.Any, typing.Dict[str, typing.Any], int) -> None
+        self.path = path
+        self._data = data
+        self._sections = {
+            name: (start + body_offset, end + body_offset)
+            for (name, (start, end)) in header['sections'].items()
+        }
+        self.stamp = header['stamp']
+
+    @classmethod
+    def open(cls, path, signature):
+        # type: (str, typing.Any) -> typing.Optional[AvailablePackagesIndex]
+        """
+        Open the index at path if it was built from the lists described
+        by signature
+        """
         try:
-            # Use the new '--wait' option if available
-            terminal_out = subprocess.check_output(
-                ["gnome-terminal", "--help-terminal-options"]).decode("utf-8")
-            if "--wait" in terminal_out:
-                gnome_wait_option = "--wait"
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                body_offset = f.tell()
+
+                if (
+                    header.get('version') != AVAILABLE_INDEX_VERSION
+                    or header.get('signature') != signature
+                ):
+                    return None
+
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        return cls(path, data, header, body_offset)
+
+    @classmethod
+    @profiled('build available packages index')
+    def build(cls, path, signature, stamp):
+        # type: (str, typing.Any, typing.Any) -> AvailablePackagesIndex
+        import tempfile
+
+        logger.debug('Building index of available packages...')
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        packages = _SortedLines(directory)
+        provides = _SortedLines(directory)
+        installed = _SortedLines(directory)
+        installed_provides = _SortedLines(directory)
+        fields = ('Package', 'Architecture', 'Version', 'Provides')
+
+        for list_path in signature['lists'] + [[DPKG_STATUS_PATH, None]]:
+            list_path = list_path[0]
+            installed_only = (list_path == DPKG_STATUS_PATH)
+
+            try:
+                stanzas = iter_deb822_stanzas(
+                    list_path,
+                    fields + (('Status',) if installed_only else ()),
+                )
+
+                for stanza in stanzas:
+                    if installed_only and not stanza.get(
+                        'Status', ''
+                    ).endswith(' installed'):
+                        continue
+
+                    name = stanza['Package']
+                    arch = stanza.get('Architecture', '')
+                    provided = [
+                        p.strip().split(' ', 1)[0].split(':', 1)[0]
+                        for p in stanza.get('Provides', '').split(',')
+                        if p.strip()
+                    ]
+                    version = stanza.get('Version', '')
+                    packages.add(name, arch, version, ','.join(provided))
+
+                    for virtual in provided:
+                        provides.add(virtual, name, arch)
+
+                    if installed_only:
+                        installed.add(name, arch, version)
+
+                        for virtual in provided:
+                            installed_provides.add(virtual, name, arch)
+            except (OSError, KeyError) as e:
+                logger.warning('Unable to index %s: %s', list_path, e)
+
+        sections = {}   # type: typing.Dict[str, typing.List[int]]
+
+        # Section offsets are relative to the end of the header line, which
+        # can only be written once they are known
+        with tempfile.TemporaryFile(dir=directory) as body:
+            for (section, lines) in (
+                ('packages', packages),
+                ('provides', provides),
+                ('installed', installed),
+                ('installed-provides', installed_provides),
+            ):
+                start = body.tell()
+                lines.write_to(body)
+                sections[section] = [start, body.tell()]
+
+            header = json.dumps({
+                'version': AVAILABLE_INDEX_VERSION,
+                'signature': signature,
+                'stamp': stamp,
+                'sections': sections,
+            }).encode('utf-8')
+
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+
+            try:
+                with open(fd, 'wb') as writer:
+                    writer.write(header + b'\n')
+                    body.seek(0)
+                    shutil.copyfileobj(body, writer)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+        index = cls.open(path, signature)
+        assert index is not None
+        return index
+
+    def _lookup(self, section, key):
+        # type: (str, str) -> typing.List[typing.List[str]]
+        data = self._data
+        start, end = self._sections[section]
+        wanted = key.encode('utf-8')
+        lo, hi = start, end
+
+        # Find the first line whose first field is not less than key. lo
+        # and hi are always at the start of a line.
+        while lo < hi:
+            mid = (lo + hi) // 2
+            line_start = data.rfind(b'\n', lo, mid) + 1 or lo
+            line_end = data.find(b'\n', line_start, hi)
+
+            if data[line_start:data.find(b'\t', line_start, line_end)] \
+                    < wanted:
+                lo = line_end + 1
             else:
-                # If the old '--disable-factory' is supported we use it
-                terminal_out = subprocess.check_output(
-                    ["gnome-terminal", "--help"]).decode("utf-8")
-                if "--disable-factory" in terminal_out:
-                    gnome_wait_option = "--disable-factory"
-
-            if gnome_wait_option is not None:
-                # If 'gnome-terminal' with the right options is available, we
-                # just use it
-                return ["gnome-terminal", gnome_wait_option, "-t", title, "--"]
-        except FileNotFoundError:
-            pass
+                hi = line_start
 
-        programs = [
+        records = []    # type: typing.List[typing.List[str]]
+
+        while lo < end:
+            line_end = data.find(b'\n', lo, end)
+            fields = data[lo:line_end].decode('utf-8').split('\t')
+
+            if fields[0] != key:
+                break
+
+            records.append(fields)
+            lo = line_end + 1
+
+        return records
+
+    def get_versions(self, name):
+        # type: (str) -> typing.List[typing.Tuple[str, str]]
+        """
+        Return the (architecture, version) pairs available for "name" or
+        "name:arch". Like apt, a name without architecture means the
+        native architecture, or failing that any architecture.
+        """
+        if ':' in name:
+            name, arch = name.rsplit(':', 1)
+        else:
+            arch = None
+
+        records = self._lookup('packages', name)
+        native = get_arch()
+
+        if arch is None:
+            preferred = [r for r in records if r[1] in (native, 'all')]
+            records = preferred or records
+        else:
+            records = [
+                r for r in records
+                if r[1] == arch or (r[1] == 'all' and arch == native)
+            ]
+
+        return [(r[1], r[2]) for r in records]
+
+    def has_package(self, name):
+        # type: (str) -> bool
+        return bool(self.get_versions(name))
+
+    def has_name(self, name):
+        # type: (str) -> bool
+        """
+        Return True if any architecture of the package is available
+        """
+        return bool(self._lookup('packages', name))
+
+    def get_providers(self, virtual):
+        # type: (str) -> typing.List[typing.Tuple[str, str]]
+        """
+        Return the (name, architecture) of packages that provide virtual
+        """
+        return [(r[1], r[2]) for r in self._lookup('provides', virtual)]
+
+    def get_installed_version(self, name):
+        # type: (str) -> typing.Optional[str]
+        """
+        Return the installed version of "name" or "name:arch", or None,
+        like DpkgStatus.get_installed_version()
+        """
+        if ':' in name:
+            name, arch = name.rsplit(':', 1)
+
+            for record in self._lookup('installed', name):
+                if record[1] == arch:
+                    return record[2]
+
+            return None
+
+        records = self._lookup('installed', name)
+
+        if not records:
+            return None
+
+        for arch in (get_arch(), 'all'):
+            for record in records:
+                if record[1] == arch:
+                    return record[2]
+
+        return records[0][2]
+
+    def is_provided(self, name):
+        # type: (str) -> bool
+        """
+        Return True if an installed package Provides the purely virtual
+        package "name" or "name:arch", like AptCacheSession.is_provided()
+        except that the Provides of the installed version are used
+        """
+        if ':' in name:
+            virtual, arch = name.rsplit(':', 1)
+        else:
+            virtual, arch = name, None
+
+        native = get_arch()
+
+        for record in self._lookup('installed-provides', virtual):
+            provider_arch = native if record[2] == 'all' else record[2]
+
+            if arch is None or arch == provider_arch:
+                return not self.has_package(name)
+
+        return False
+
+
+def get_available_index():
+    # type: () -> typing.Optional[AvailablePackagesIndex]
+    """
+    Get the index of available packages, rebuilding it if the apt lists or
+    the dpkg status changed. Return None if the lists can't be indexed,
+    in which case callers ask apt-cache instead.
+    """
+    global _available_index
+
+    # Probes and the main thread can all need it at once: build it once
+    with _available_index_lock:
+        stamp = [file_stamp(APT_LISTS_DIR), file_stamp(DPKG_STATUS_PATH)]
+
+        if _available_index is not None and _available_index.stamp == stamp:
+            return _available_index
+
+        lists = sorted(glob.glob(os.path.join(APT_LISTS_DIR, '*_Packages*')))
+
+        if any(not path.endswith('_Packages') for path in lists):
+            # Compressed lists (Acquire::GzipIndexes) are not indexed
+            logger.debug('Compressed apt lists, not using the index')
+            return None
+
+        signature = {
+            'lists': [[path, file_stamp(path)] for path in lists],
+            'dpkg_status': file_stamp(DPKG_STATUS_PATH),
+        }
+        path = os.path.join(get_cache_dir(), AVAILABLE_INDEX_FILE)
+        index = AvailablePackagesIndex.open(path, signature)
+
+        if index is None:
+            try:
+                index = AvailablePackagesIndex.build(path, signature, stamp)
+            except OSError as e:
+                logger.debug('Unable to build the index of packages: %s', e)
+                return None
+
+        _available_index = index
+        return index
+
+
+def is_low_memory_backend():
+    # type: () -> bool
+    return os.environ.get('STEAMDEPS_BACKEND') == 'lowmem'
+
+
+def get_installed_packages():
+    # type: () -> typing.Any
+    """
+    Return what to look the installed packages up in: the index of
+    packages with the low-memory backend, the dpkg snapshot otherwise.
+    Both have get_installed_version().
+    """
+    if is_low_memory_backend():
+        index = get_available_index()
+
+        if index is not None:
+            return index
+
+    return get_dpkg_status()
+
+
+# N.B. Version checks are not supported on virtual packages
+#
+def is_provided(pkgname):
+    """
+    Check to see if another package Provides this package
+    """
+    if is_low_memory_backend():
+        index = get_available_index()
+
+        if index is not None:
+            return index.is_provided(pkgname)
+
+    return get_apt_session().is_provided(pkgname)
+
+
+#
+# Debian version comparison, equivalent to "dpkg --compare-versions" but
+# without forking a dpkg process for every version condition.
+#
+_version_fragment_pattern = re.compile(r"(\D*)(\d*)")
+
+# Relation operators understood by dpkg. "<" and ">" are the obsolete
+# spellings of "<=" and ">=", dpkg still accepts them with a warning.
+_VERSION_RELATIONS = {
+    '<<': lambda c: c < 0,
+    '<=': lambda c: c <= 0,
+    '=': lambda c: c == 0,
+    '>=': lambda c: c >= 0,
+    '>>': lambda c: c > 0,
+    '<': lambda c: c <= 0,
+    '>': lambda c: c >= 0,
+}
+
+# Pairs of versions with the expected result of comparing them, as
+# reported by "dpkg --compare-versions". Used by
+# --debug-check-version-comparison to verify that the native comparison
+# still agrees with dpkg.
+_VERSION_COMPARISON_CORPUS = (
+    ('1.0', '1.0', 0),
+    ('1.0', '1.00', 0),
+    ('01', '1', 0),
+    ('0:1.0', '1.0', 0),
+    ('1.0', '1.0-0', 0),
+    ('1.', '1.0', 0),
+    ('1.0', '1.1', -1),
+    ('1.2', '1.10', -1),
+    ('1.0', '1.0.0', -1),
+    ('1.0~rc1', '1.0', -1),
+    ('1.0~rc1', '1.0~rc2', -1),
+    ('1.0~~', '1.0~', -1),
+    ('1.0~~a', '1.0~~', 1),
+    ('1.0~', '1.0', -1),
+    ('1.0+b1', '1.0', 1),
+    ('1.0+dfsg', '1.0.0', -1),
+    ('1.0a', '1.0', 1),
+    ('1.0.', '1.0+', 1),
+    ('1.0a', '1.0.', -1),
+    ('1.0-1', '1.0', 1),
+    ('1.0-1', '1.0-2', -1),
+    ('1.0-1.1', '1.0-1', 1),
+    ('1.0-1ubuntu1', '1.0-1', 1),
+    ('1.0-1~bpo1', '1.0-1', -1),
+    ('1.0-1+deb9u1', '1.0-1+deb10u1', -1),
+    ('1:0', '2.0', 1),
+    ('1:1.0', '2:0.1', -1),
+    ('2.30-0ubuntu1', '2.30-0ubuntu10', -1),
+    ('2.28-10+deb10u1', '2.28-10', 1),
+    ('470.57.02-1', '470.103.01-1', -1),
+    ('1.2.3-4-5', '1.2.3-4', 1),
+    ('a', 'b', -1),
+    ('a1', '1', 1),
+    ('Z', 'a', -1),
+    ('1.0-~', '1.0', -1),
+    ('1.0-a', '1.0-1', 1),
+    ('7.4.2~rc1-2', '7.4.2-1', -1),
+    ('10.0.0+git20220101', '10.0.0', 1),
+    ('1:2.3.4-5', '1:2.3.4-5', 0),
+)
+
+
+def _version_order(char):
+    # type: (str) -> int
+    # Letters sort before every other character, "~" sorts before
+    # everything including the end of the string
+    if char == '~':
+        return -1
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+def _version_fragment_key(fragment):
+    # type: (str) -> typing.Tuple[int, ...]
+    """
+    Turn an upstream version or revision into a tuple that sorts the same
+    way dpkg's verrevcmp() does.
+    """
+    key = []        # type: typing.List[int]
+
+    for (non_digits, digits) in _version_fragment_pattern.findall(fragment):
+        if key and not non_digits and not digits:
+            continue
+
+        key.extend(_version_order(c) for c in non_digits)
+        # The end of a non-digit part sorts after "~" and before anything
+        # else
+        key.append(0)
+        key.append(int(digits) if digits else 0)
+
+    # Terminator, so that "1.0" sorts after "1.0~" but before "1.0.1"
+    key.append(0)
+    return tuple(key)
+
+
+@functools.lru_cache(maxsize=None)
+def version_sort_key(version):
+    # type: (str) -> typing.Tuple[int, typing.Any, typing.Any]
+    """
+    Parse a Debian version into a key that can be compared directly.
+    Raises ValueError for the versions that dpkg refuses to compare.
+    """
+    if not version:
+        raise ValueError('version string is empty')
+
+    if any(c.isspace() for c in version):
+        raise ValueError('version string has embedded spaces')
+
+    epoch = 0
+    upstream = version
+
+    if ':' in upstream:
+        epoch_text, upstream = upstream.split(':', 1)
+
+        if not epoch_text:
+            raise ValueError('epoch in version is empty')
+
+        if not epoch_text.isdigit():
+            raise ValueError('epoch in version is not number')
+
+        if not upstream:
+            raise ValueError('nothing after colon in version number')
+
+        epoch = int(epoch_text)
+
+    revision = ''
+
+    if '-' in upstream:
+        upstream, revision = upstream.rsplit('-', 1)
+
+        if not revision:
+            raise ValueError('revision number is empty')
+
+    if not upstream:
+        raise ValueError('version number is empty')
+
+    return (
+        epoch,
+        _version_fragment_key(upstream),
+        _version_fragment_key(revision),
+    )
+
+
+def compare_versions(a, b):
+    # type: (str, str) -> int
+    """
+    Compare two Debian versions, returning a negative number, zero or a
+    positive number like dpkg's own comparison
+    """
+    key_a = version_sort_key(a)
+    key_b = version_sort_key(b)
+
+    return (key_a > key_b) - (key_a < key_b)
+
+
+def check_version_condition(installed, op, version):
+    # type: (str, str, str) -> bool
+    """
+    Check whether an installed version satisfies a condition like ">= 1.0".
+    A condition that dpkg would reject is never satisfied.
+    """
+    try:
+        if op not in _VERSION_RELATIONS:
+            raise ValueError('bad relation')
+
+        return _VERSION_RELATIONS[op](compare_versions(installed, version))
+    except ValueError as e:
+        logger.warning(
+            'Unable to evaluate version condition %r %s %r: %s',
+            installed, op, version, e,
+        )
+        return False
+
+
+def check_version_comparison():
+    # type: () -> int
+    """
+    Verify that the native version comparison agrees with
+    "dpkg --compare-versions" on the conformance corpus
+    """
+    mismatches = 0
+
+    for (a, b, expected) in _VERSION_COMPARISON_CORPUS:
+        for op in sorted(_VERSION_RELATIONS):
+            native = check_version_condition(a, op, b)
+            dpkg = subprocess.call(
+                ['dpkg', '--compare-versions', a, op, b],
+                stderr=subprocess.DEVNULL,
+            ) == 0
+
+            if native != dpkg:
+                mismatches += 1
+                print('Mismatch: %s %s %s: native %s, dpkg %s'
+                      % (a, op, b, native, dpkg), file=sys.stderr)
+
+        if compare_versions(a, b) != expected:
+            mismatches += 1
+            print('Mismatch: %s vs. %s: expected %d, got %d'
+                  % (a, b, expected, compare_versions(a, b)),
+                  file=sys.stderr)
+
+    print('%d version comparisons checked, %d mismatches'
+          % (len(_VERSION_COMPARISON_CORPUS) * (len(_VERSION_RELATIONS) + 1),
+             mismatches), file=sys.stderr)
+
+    if mismatches:
+        return 1
+
+    return 0
+
+
+###
+class Package:
+    """
+    Package definition class
+    """
+
+    def __init__(self, name, version_conditions):
+        self.name = name
+        self.version_conditions = version_conditions
+        self.installed = None
+
+    def set_installed(self, version):
+        self.installed = version
+
+    def is_available(self):
+        if self.installed is None:
+            # check to see if another package is providing this virtual package
+            return is_provided(self.name)
+
+        return all(
+            check_version_condition(self.installed, op, version)
+            for (op, version) in self.version_conditions
+        )
+
+    def __str__(self):
+        text = self.name
+        for (op, version) in self.version_conditions:
+            text += " (%s %s)" % (op, version)
+        return text
+
+
+def is_glvnd():
+    global _glvnd
+
+    # Callers wait for a startup probe that is already checking
+    with _glvnd_lock:
+        if _glvnd is None:
+            _glvnd = _check_glvnd()
+        return _glvnd
+
+
+def _check_glvnd():
+    index = get_available_index()
+
+    if index is not None:
+        return index.has_name('libgl1')
+
+    try:
+        cp = subprocess.run(['apt-cache', 'pkgnames', 'libgl1'],
+                            stdout=subprocess.PIPE,
+                            timeout=get_probe_timeout())
+    except (OSError, FileNotFoundError, subprocess.TimeoutExpired):
+        return False
+
+    return 'libgl1' in cp.stdout.decode('utf-8').split()
+
+
+def is_package_available(package_name):
+    # On SteamOS "xdg-desktop-portal-gtk" is recommended by the backported
+    # version of flatpak, even if it is not available in the repositories.
+    # For this reason we check for an actual version of the package,
+    # either in the index or in the apt-cache -q show output.
+    index = get_available_index()
+
+    if index is not None:
+        return index.has_package(package_name)
+
+    try:
+        apt_output = subprocess.check_output(
+            ['apt-cache', '-q', 'show', package_name],
+            timeout=get_probe_timeout(),
+        )
+        return bool(apt_output)
+    except (OSError, FileNotFoundError, subprocess.CalledProcessError,
+            subprocess.TimeoutExpired):
+        return False
+
+
+def choose_xdg_portal_backend(default_backend="xdg-desktop-portal-gtk"):
+    with _xdg_portal_backends_lock:
+        if default_backend not in _xdg_portal_backends:
+            _xdg_portal_backends[default_backend] = \
+                _choose_xdg_portal_backend(default_backend)
+        return _xdg_portal_backends[default_backend]
+
+
+def _choose_xdg_portal_backend(default_backend):
+    gtk_desktop = ["Cinnamon", "GNOME", "LXDE", "MATE", "Unity", "XFCE"]
+    kde_desktop = ["KDE"]
+    gtk_backend = "xdg-desktop-portal-gtk"
+    kde_backend = "xdg-desktop-portal-kde"
+
+    current_desktops = os.environ.get("XDG_CURRENT_DESKTOP", "").split(":")
+
+    for c in current_desktops:
+        if c in gtk_desktop:
+            if is_package_available(gtk_backend):
+                return gtk_backend
+        elif c in kde_desktop:
+            if is_package_available(kde_backend):
+                return kde_backend
+
+    if is_package_available(default_backend):
+        return default_backend
+    else:
+        sys.stderr.write(
+            "There isn't a known XDG portal backend that can be installed\n")
+        return None
+
+
+def get_nvidia_version():
+    # type: () -> typing.Optional[str]
+    """
+    Get the version of the loaded Nvidia kernel module, or None
+    """
+    nvidia_version = os.environ.get("SL_TEST_NVIDIA_VERSION")
+
+    if nvidia_version:
+        return nvidia_version
+
+    try:
+        with open('/sys/module/nvidia/version') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def expected_nvidia_packages():
+    # type: (...) -> typing.Dict[str, Package]
+    # Returns a map like:
+    # {"nvidia-driver-libs:amd64": Package("nvidia-driver-libs:amd64", [])}
+    nvidia_packages_to_check = {}       # type: typing.Dict[str, Package]
+    nvidia_packages_to_expect = {}      # type: typing.Dict[str, Package]
+
+    if get_arch() != 'amd64':
+        return nvidia_packages_to_expect
+
+    nvidia_version = get_nvidia_version()
+
+    if nvidia_version is None:
+        # If the Nvidia module is not loaded, it's safe to assume that the
+        # Nvidia drivers are not in use. No need to install anything else.
+        return nvidia_packages_to_expect
+
+    nvidia_major_version = nvidia_version.split('.')[0]
+
+    for name in (
+        # Debian packages
+        "nvidia-driver-libs:amd64",
+        "nvidia-legacy-{}xx-driver-libs:amd64".format(nvidia_major_version),
+        "nvidia-tesla-{}-driver-libs:amd64".format(nvidia_major_version),
+        "nvidia-alternative",
+        "nvidia-legacy-{}xx-alternative".format(nvidia_major_version),
+        "nvidia-tesla-{}-alternative".format(nvidia_major_version),
+
+        # Ubuntu 18.04+ packages
+        "libnvidia-gl-{}:amd64".format(nvidia_major_version),
+        "libnvidia-gl-{}-server:amd64".format(nvidia_major_version),
+    ):
+        nvidia_packages_to_check[name] = Package(name, [])
+
+    update_installed_packages(nvidia_packages_to_check)
+
+    for pkg_name in nvidia_packages_to_check:
+        if nvidia_packages_to_check[pkg_name].installed:
+            if pkg_name.endswith("-alternative"):
+                # If we have a Nvidia kernel module and the "*-alternative"
+                # package is installed, we want to ensure that the related
+                # user-space "*-driver-libs" are also installed, in both
+                # amd64 and i386 architectures
+                driver_libs = pkg_name.replace("-alternative", "-driver-libs")
+                nvidia_packages_to_expect[driver_libs + ":amd64"] = Package(
+                    driver_libs + ":amd64", []
+                )
+                nvidia_packages_to_expect[driver_libs + ":i386"] = Package(
+                    driver_libs + ":i386", []
+                )
+            else:
+                # Ensure that the i386 variant is installed too
+                assert pkg_name.endswith(":amd64")
+                name_i386 = pkg_name.replace(":amd64", ":i386")
+                nvidia_packages_to_expect[name_i386] = Package(name_i386, [])
+
+    if len(nvidia_packages_to_expect) == 0:
+        print("Unable to determine whether the expected Nvidia drivers "
+              "are available.")
+        print("The Steam client may have limited functionality.")
+
+    return nvidia_packages_to_expect
+
+
+class RemapTable:
+    """
+    How package names from the dependencies file are remapped on this
+    host. The remapping only depends on the state of the host, so it is
+    computed once per run rather than once per dependency.
+    """
+
+    # Ubuntu 12.04.2, 12.04.3, and 12.04.4 introduce new X stacks which
+    # require different sets of incompatible glx packages depending on
+    # which X is currently installed.
+    LTS_STACKS = ('quantal', 'raring', 'saucy', 'trusty', 'xenial')
+
+    PORTAL_BACKENDS = (
+        "xdg-desktop-portal-gtk",
+        "xdg-desktop-portal-kde",
+    )
+
+    def __init__(self, lts=None, glvnd=False):
+        # type: (typing.Optional[str], bool) -> None
+        self.lts = lts
+        self.glvnd = glvnd
+        self._names = {
+            # Steam claims it needs python-apt, but it doesn't really
+            'python-apt': None,
+        }   # type: typing.Dict[str, typing.Optional[str]]
+
+        if glvnd:
+            self._names['libegl1-mesa'] = 'libegl1'
+            self._names['libgl1-mesa-glx'] = 'libgl1'
+        else:
+            self._names['libegl1'] = 'libegl1-mesa'
+
+        if lts is not None:
+            for name in (
+                    'libegl1-mesa',
+                    'libgbm1',
+                    'libgl1-mesa-glx',
+                    'libgl1-mesa-dri',
+            ):
+                self._names[name] = name + '-lts-' + lts
+
+            self._names['libegl1'] = 'libegl1-mesa-lts-' + lts
+
+    @classmethod
+    def probe(cls):
+        # type: () -> RemapTable
+        installed = get_installed_packages()
+
+        for lts in cls.LTS_STACKS:
+            xserver = 'xserver-xorg-core-lts-' + lts
+
+            if installed.get_installed_version(xserver) is not None:
+                break
+        else:
+            lts = None
+
+        return cls(lts, is_glvnd())
+
+    def remap(self, name):
+        # type: (str) -> typing.Optional[str]
+        return self._names.get(name, name)
+
+    def portal_backend(self, name):
+        # type: (str) -> typing.Optional[str]
+        # The backend is only chosen when a dependency asks for it,
+        # because choosing reports on stderr when there is none
+        return choose_xdg_portal_backend(name)
+
+
+def get_remap_table():
+    # type: () -> RemapTable
+    global _remap_table
+
+    if _remap_table is None:
+        _remap_table = RemapTable.probe()
+        logger.debug('Remapping packages for LTS stack %s, glvnd %s',
+                     _remap_table.lts, _remap_table.glvnd)
+
+    return _remap_table
+
+
+def remap_package(name):
+    return get_remap_table().remap(name)
+
+
+# Configuration variables, e.g. STEAM_RUNTIME=1
+_CONFIG_PATTERN = re.compile(r"(\w+)\s*=\s*(\w+)")
+# Architecture conditions, e.g. foo [i386]
+_ARCH_CONDITION_PATTERN = re.compile(r"(.*) \[([^\]]+)\]")
+# Version requirements, e.g. foo (>= 1.0)
+_VERSION_CONDITION_PATTERN = re.compile(
+    r"\s*\(\s*([<>=]+)\s*([\w\-.:]+)\s*\)\s*")
+
+
+def split_dependency(description):
+    # type: (str) -> typing.List[typing.Any]
+    """
+    Split one alternative of a dependency, e.g. "foo:i386 (>= 1.0) [amd64]",
+    into [name, multiarch, architecture condition, version conditions].
+    This doesn't depend on the host, so the result can be stored.
+    """
+    arch_condition = None
+
+    match = _ARCH_CONDITION_PATTERN.match(description)
+    if match is not None:
+        description = match.group(1).strip()
+        arch_condition = match.group(2)
+
+    version_conditions = []     # type: typing.List[typing.List[str]]
+
+    if '(' in description:
+        version_conditions = [
+            list(c) for c in _VERSION_CONDITION_PATTERN.findall(description)
+        ]
+        description = _VERSION_CONDITION_PATTERN.sub('', description)
+
+    description = description.strip()
+
+    if ':' in description:
+        name, multiarch = description.rsplit(':', 1)
+    else:
+        name = description
+        multiarch = None
+
+    return [name, multiarch, arch_condition, version_conditions]
+
+
+def resolve_dependency(
+    split,          # type: typing.Sequence[typing.Any]
+    arch,           # type: str
+    remap_table,    # type: RemapTable
+):
+    # type: (...) -> typing.Optional[typing.Tuple[str, typing.List[tuple]]]
+    """
+    Turn the result of split_dependency() into the remapped package name
+    and its version conditions. Return None if the package isn't
+    meaningful on this architecture.
+    """
+    name, multiarch, condition, version_conditions = split
+
+    if condition is not None:
+        if condition[0] == '!':
+            if arch == condition[1:]:
+                return None
+        else:
+            if arch != condition:
+                return None
+
+    name = remap_table.remap(name)
+
+    if name in RemapTable.PORTAL_BACKENDS:
+        name = remap_table.portal_backend(name)
+        # Skip version conditions for portal backends because we don't know
+        # in advance which backend we will need to install.
+        # In the future, if necessary, we can enhance this check and, for
+        # example, embed a minimum version for each possible backed.
+        version_conditions = []
+
+    if version_conditions:
+        version_conditions = [tuple(c) for c in version_conditions]
+
+    if name is None:
+        return None
+    elif multiarch is not None:
+        return (name + ':' + multiarch, version_conditions)
+    else:
+        return (name, version_conditions)
+
+
+def parse_dependency(
+    description,    # type: str
+    arch,           # type: str
+    remap_table,    # type: RemapTable
+):
+    # type: (...) -> typing.Optional[typing.Tuple[str, typing.List[tuple]]]
+    """
+    Parse one alternative of a dependency into the remapped package name
+    and its version conditions
+    """
+    return resolve_dependency(
+        split_dependency(description), arch, remap_table,
+    )
+
+
+###
+def create_package(description, remap_table=None):
+    """
+    Create a package object based on a description.
+    This can return None if the package isn't meaningful on this platform.
+    """
+    if remap_table is None:
+        remap_table = get_remap_table()
+
+    parsed = parse_dependency(description, get_arch(), remap_table)
+
+    if parsed is None:
+        return None
+
+    return Package(*parsed)
+
+
+def iter_dependencies(
+    lines,      # type: typing.Iterable[str]
+):
+    # type: (...) -> typing.Iterator[typing.Tuple[str, typing.Any, typing.Any]]
+    """
+    Parse the lines of a dependencies file in a single pass, yielding
+    ('config', key, value) for configuration variables and
+    ('row', alternatives, None) for each dependency, where alternatives
+    is a list of split_dependency() results.
+    """
+    for line in lines:
+        line = line.strip()
+        if line == "" or line[0] == '#':
+            continue
+
+        if '=' in line:
+            match = _CONFIG_PATTERN.match(line)
+            if match is not None:
+                yield ('config', match.group(1), match.group(2))
+                continue
+
+        yield (
+            'row',
+            [split_dependency(section) for section in line.split("|")],
+            None,
+        )
+
+
+def get_precompiled_path(path):
+    # type: (str) -> str
+    (dirname, basename) = os.path.split(os.path.abspath(path))
+    return os.path.join(dirname, '.' + basename + '.compiled.json')
+
+
+@profiled('load dependencies')
+def load_dependencies(
+    path,       # type: str
+):
+    # type: (...) -> typing.Tuple[typing.Dict[str, str], typing.List[list]]
+    """
+    Load the configuration variables and the dependency rows of a
+    dependencies file.
+
+    The parsed form is stored next to the file, and loaded instead of
+    parsing again as long as the file's contents don't change. Failing
+    to read or write it is not an error.
+    """
+    with open(path, 'rb') as reader:
+        data = reader.read()
+
+    digest = hashlib.sha256(data).hexdigest()
+    precompiled_path = get_precompiled_path(path)
+
+    try:
+        with open(precompiled_path, 'r', encoding='utf-8') as reader:
+            precompiled = json.load(reader)
+
+        if (
+            precompiled['version'] == PRECOMPILED_DEPENDENCIES_VERSION
+            and precompiled['sha256'] == digest
+        ):
+            logger.debug('Loaded precompiled %s', precompiled_path)
+            return (precompiled['config'], precompiled['rows'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    config = {}     # type: typing.Dict[str, str]
+    rows = []       # type: typing.List[typing.Any]
+
+    for (kind, first, second) in iter_dependencies(
+        data.decode('utf-8').splitlines()
+    ):
+        if kind == 'config':
+            config[first] = second
+        else:
+            rows.append(first)
+
+    # Don't leave files owned by root in the user's Steam directory
+    if not is_root():
+        import tempfile
+
+        try:
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(precompiled_path),
+                prefix=os.path.basename(precompiled_path) + '.',
+            )
+
+            try:
+                with open(fd, 'w', encoding='utf-8') as writer:
+                    json.dump({
+                        'version': PRECOMPILED_DEPENDENCIES_VERSION,
+                        'sha256': digest,
+                        'config': config,
+                        'rows': rows,
+                    }, writer, separators=(',', ':'))
+                os.replace(temp_path, precompiled_path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError as e:
+            logger.debug('Unable to write %s: %s', precompiled_path, e)
+
+    return (config, rows)
+
+
+###
+def _probe_gnome_terminal_wait_option(path):
+    # type: (str) -> typing.Optional[str]
+    # Raises OSError, CalledProcessError or TimeoutExpired if gnome-terminal
+    # couldn't be asked, for example without a usable D-Bus session
+
+    # Use the new '--wait' option if available
+    terminal_out = subprocess.check_output(
+        [path, "--help-terminal-options"],
+        timeout=get_probe_timeout(),
+    ).decode("utf-8")
+    if "--wait" in terminal_out:
+        return "--wait"
+
+    # If the old '--disable-factory' is supported we use it
+    terminal_out = subprocess.check_output(
+        [path, "--help"],
+        timeout=get_probe_timeout(),
+    ).decode("utf-8")
+    if "--disable-factory" in terminal_out:
+        return "--disable-factory"
+
+    return None
+
+
+def get_gnome_terminal_wait_option():
+    # type: () -> typing.Optional[str]
+    """
+    Return the option that makes gnome-terminal wait for its command to
+    exit, or None if it has none that we know of or isn't installed.
+
+    Asking gnome-terminal takes one or two subprocesses, so the answer is
+    cached per user, keyed on the path and modification time of the binary.
+    Only answers read from its help are cached: if it couldn't be asked,
+    which can be temporary, it is asked again next time.
+    """
+    path = shutil.which("gnome-terminal")
+
+    if path is None:
+        return None
+
+    key = {'path': path, 'stamp': file_stamp(os.path.realpath(path))}
+    cached = load_cache_file(TERMINAL_CACHE_FILE)
+
+    if isinstance(cached, dict) and cached.get('key') == key:
+        return cached.get('wait_option')
+
+    try:
+        wait_option = _probe_gnome_terminal_wait_option(path)
+    except (OSError, subprocess.CalledProcessError,
+            subprocess.TimeoutExpired) as e:
+        logger.debug('Unable to ask gnome-terminal for its options: %s', e)
+        return None
+
+    store_cache_file(
+        TERMINAL_CACHE_FILE, {'key': key, 'wait_option': wait_option},
+    )
+    return wait_option
+
+
+def get_terminal(
+    title       # type: str
+):
+    # type: (...) -> typing.List[str]
+    """
+    Function to find a useful terminal like xterm or compatible
+    """
+    if "DISPLAY" in os.environ:
+        gnome_wait_option = get_gnome_terminal_wait_option()
+
+        if gnome_wait_option is not None:
+            # If 'gnome-terminal' with the right options is available, we
+            # just use it
+            return ["gnome-terminal", gnome_wait_option, "-t", title, "--"]
+
+        programs = [
             ("konsole",
              ["konsole", "--nofork", "-p", "tabtitle=" + title, "-e"]),
             ("xterm",
@@ -459,263 +1863,2046 @@ def get_terminal(
             ("gnome-terminal",
              ["gnome-terminal", "--disable-factory", "-t", title, "--"]),
         ]
-        for (program, commandLine) in programs:
-            if subprocess.call(['which', program],
-                               stdout=subprocess.PIPE) == 0:
-                return commandLine
+        for (program, commandLine) in programs:
+            if shutil.which(program) is not None:
+                return commandLine
+
+    # Fallback if no GUI terminal program is available
+    return ['/usr/bin/env']
+
+
+def get_terminal_wait(
+    title       # type: str
+):
+    # type: (...) -> typing.List[str]
+    return get_terminal(title) + [
+        '/bin/sh', '-euc',
+        ('e=0; "$@" || e=$?;'
+         'printf \'\\nPress return to continue: \'; read line;'
+         'exit "$e"'),
+        'sh',
+    ]
+
+
+###
+def is_root():
+    return os.getuid() == 0
+
+
+###
+def get_apt_sources_files():
+    # type: () -> typing.List[str]
+    """
+    List the files that apt reads its repositories from, both one-line
+    style '.list' files and deb822 style '.sources' files
+    """
+    sources_list = sorted(
+        glob.glob(os.path.join(APT_SOURCES_PARTS, '*.list'))
+        + glob.glob(os.path.join(APT_SOURCES_PARTS, '*.sources'))
+    )
+    sources_list.append(APT_SOURCES_LIST)
+    return sources_list
+
+
+def _parse_deb822_sources_stanza(stanza):
+    # type: (str) -> typing.Dict[str, str]
+    fields = {}     # type: typing.Dict[str, str]
+    key = None
+
+    for line in stanza.splitlines():
+        if not line.strip() or line.startswith('#'):
+            continue
+
+        if line[0] in ' \t' and key is not None:
+            # Continuation of a multi-line field
+            fields[key] += ' ' + line.strip()
+        elif ':' in line:
+            key, value = line.split(':', 1)
+            key = key.strip().lower()
+            fields[key] = value.strip()
+
+    return fields
+
+
+def find_steam_source_entries():
+    # type: () -> typing.List[typing.Tuple[str, str]]
+    """
+    Find the enabled entries for the Steam repository in the apt sources.
+    Return a list of (format, text) tuples, where format is 'list' for a
+    one-line style entry and 'sources' for a deb822 style stanza.
+
+    Files that don't mention the Steam repository at all, which is most of
+    them, are skipped after a substring search without being parsed.
+    """
+    needle = STEAM_REPO_URI.split('://', 1)[1]
+    entries = []    # type: typing.List[typing.Tuple[str, str]]
+
+    for source in get_apt_sources_files():
+        try:
+            with open(source, encoding='utf-8', errors='replace') as f:
+                text = f.read()
+        except OSError as err:
+            print('Failed to open "{}": {}'.format(source, err))
+            continue
+
+        if needle not in text:
+            continue
+
+        if source.endswith('.sources'):
+            for stanza in re.split(r'\n\s*\n', text):
+                if needle not in stanza:
+                    continue
+
+                fields = _parse_deb822_sources_stanza(stanza)
+
+                if fields.get('enabled', 'yes').lower() == 'no':
+                    continue
+
+                if any(
+                    STEAM_REPO_URI in uri
+                    for uri in fields.get('uris', '').split()
+                ):
+                    entries.append(('sources', stanza.strip()))
+        else:
+            import_aptsources()
+
+            for line in text.splitlines():
+                if needle not in line:
+                    continue
+
+                entry = SourceEntry(line, source)
+                entry.parse(line)
+
+                if STEAM_REPO_URI in entry.uri and not entry.disabled:
+                    entries.append(('list', line.strip()))
+
+    return entries
+
+
+@profiled('check apt sync')
+def is_apt_out_of_sync():
+    """
+    Returns True if the apt policies are not in sync with what is listed
+    in the apt sources lists.
+    """
+    # The answer only changes when the sources or the lists change
+    key = {
+        'sources': [[p, file_stamp(p)] for p in get_apt_sources_files()],
+        'apt_lists': file_stamp(APT_LISTS_DIR),
+    }
+    cached = load_cache_file(APT_SYNC_CACHE_FILE)
+
+    if isinstance(cached, dict) and cached.get('key') == key:
+        return cached['out_of_sync']
+
+    out_of_sync = _is_apt_out_of_sync()
+    store_cache_file(
+        APT_SYNC_CACHE_FILE, {'key': key, 'out_of_sync': out_of_sync},
+    )
+    return out_of_sync
+
+
+def _is_apt_out_of_sync():
+    # type: () -> bool
+    if not find_steam_source_entries():
+        # Apparently we don't have the Steam repository, no need to update
+        # apt sources
+        return False
+
+    # The Steam repository is in the sources list. Only now is it worth
+    # asking apt whether it is also in the apt policies, which is slow on
+    # systems with many repositories
+    cp = run_subprocess(
+        ['apt-cache', 'policy'],
+        capture_output=True,
+        universal_newlines=True,
+        timeout=get_probe_timeout(),
+    )
+
+    # If it is not, we need to update apt sources
+    return STEAM_REPO_URI not in cp.stdout
+
+
+###
+def get_apt_update_ttl():
+    # type: () -> float
+    """
+    Return for how many seconds apt lists are considered fresh enough that
+    refreshing them can be skipped, 0 to always refresh
+    """
+    try:
+        return float(os.environ.get('STEAMDEPS_APT_UPDATE_TTL', '0'))
+    except ValueError:
+        logger.warning('Ignoring invalid STEAMDEPS_APT_UPDATE_TTL')
+        return 0
+
+
+def get_apt_lists_age(prefix=''):
+    # type: (str) -> typing.Optional[float]
+    """
+    Return how many seconds ago the oldest of the Release files whose name
+    starts with prefix was downloaded, or None if there are none
+    """
+    releases = glob.glob(os.path.join(APT_LISTS_DIR, prefix + '*Release'))
+
+    if not releases:
+        return None
+
+    oldest = min(os.path.getmtime(path) for path in releases)
+    return time.time() - oldest
+
+
+def format_size(size):
+    # type: (float) -> str
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if abs(size) < 1000 or unit == 'GB':
+            break
+
+        size /= 1000
+
+    return '%.1f %s' % (size, unit)
+
+
+def parse_fetched_size(line):
+    # type: (str) -> typing.Optional[float]
+    """
+    Parse the size from apt-get's "Fetched 12.3 MB in 4s (3075 kB/s)"
+    """
+    return _parse_apt_size(r"Fetched ", line)
+
+
+def parse_download_size(line):
+    # type: (str) -> typing.Optional[float]
+    """
+    Parse the size still to be downloaded from apt-get's
+    "Need to get 12.3 MB of archives" or "Need to get 1234 kB/40.0 MB of
+    archives"
+    """
+    return _parse_apt_size(r"Need to get ", line)
+
+
+def _parse_apt_size(prefix, line):
+    # type: (str, str) -> typing.Optional[float]
+    match = re.match(prefix + r"([\d.]+) ?([kMGT]?)B\b", line)
+
+    if match is None:
+        return None
+
+    scale = 1000 ** ' kMGT'.index(match.group(2) or ' ')
+    return float(match.group(1)) * scale
+
+
+def report_apt_update_savings(what, cost):
+    # type: (str, typing.Dict[str, float]) -> None
+    """
+    Compare cost, the bytes and seconds that what we did actually took,
+    with the last full update
+    """
+    stats = load_cache_file(APT_UPDATE_CACHE_FILE)
+
+    if not isinstance(stats, dict) or 'full' not in stats:
+        return
+
+    full = stats['full']
+    saved_bytes = full['bytes'] - cost['bytes']
+    saved_seconds = full['seconds'] - cost['seconds']
+
+    if saved_bytes > 0 or saved_seconds > 0:
+        logger.info(
+            '%s instead of refreshing every apt source saved about %s '
+            'and %.1f seconds',
+            what, format_size(max(0, saved_bytes)), max(0, saved_seconds),
+        )
+
+
+class AptProgress:
+    """
+    Progress of the apt-get commands that run at the same time, such as
+    refreshing the lists while packages are downloaded. Each command is a
+    stream, fed with what apt-get writes to its APT::Status-Fd and its
+    output, and reported as events with the items, bytes, download rate
+    and estimated time left: a status line on a terminal, or one JSON
+    object per line with --progress=json.
+    """
+
+    LABELS = {
+        'update': 'Refreshing package lists',
+        'download': 'Downloading packages',
+    }
+
+    def __init__(self, style=None):
+        # type: (typing.Optional[str]) -> None
+        # text, json or none
+        self.style = style or os.environ.get('STEAMDEPS_PROGRESS', 'text')
+        self._lock = threading.Lock()
+        # stream -> its latest event
+        self._events = {}   # type: typing.Dict[str, typing.Dict]
+        self._started = {}  # type: typing.Dict[str, float]
+        self._status_line = False
+
+    def start(self, stream, total_bytes=None):
+        # type: (str, typing.Optional[float]) -> None
+        """
+        Start reporting stream. total_bytes is how much it is expected to
+        download, if known in advance.
+        """
+        with self._lock:
+            self._started[stream] = time.monotonic()
+            self._events[stream] = {
+                'stream': stream,
+                'status': 'started',
+                'items': 0,
+                'total_items': None,
+                'percent': 0.0,
+                'bytes': 0.0 if total_bytes is not None else None,
+                'total_bytes': total_bytes,
+                'rate': None,
+                'eta': None,
+                # What apt-get says it fetched, once it is done
+                'fetched': None,
+            }
+            self._emit(self._events[stream])
+
+    def feed_status(self, stream, line):
+        # type: (str, str) -> None
+        """
+        Parse a line from APT::Status-Fd such as
+        "dlstatus:3:42.5:Retrieving file 3 of 10 (12s remaining)"
+        """
+        fields = line.rstrip('\n').split(':', 3)
+
+        if len(fields) != 4 or fields[0] != 'dlstatus':
+            return
+
+        try:
+            items = int(fields[1])
+            percent = float(fields[2])
+        except ValueError:
+            return
+
+        match = re.search(r"file \d+ of (\d+)", fields[3])
+
+        with self._lock:
+            event = self._events[stream]
+            event['status'] = 'progress'
+            event['items'] = items
+            event['percent'] = percent
+
+            if match is not None:
+                event['total_items'] = int(match.group(1))
+
+            self._update_rate(event)
+            self._emit(event)
+
+    def feed_output(self, stream, line):
+        # type: (str, str) -> None
+        """
+        Parse a line of apt-get's output for the sizes it announces
+        """
+        needed = parse_download_size(line)
+        fetched = parse_fetched_size(line)
+
+        with self._lock:
+            event = self._events[stream]
+
+            if needed is not None:
+                event['total_bytes'] = needed
+                event['bytes'] = 0.0
+
+            if fetched is not None:
+                event['fetched'] = fetched
+
+    def finish(self, stream, returncode):
+        # type: (str, int) -> typing.Dict[str, typing.Any]
+        """
+        Report that the command of stream exited, and return its last
+        event
+        """
+        with self._lock:
+            event = self._events[stream]
+            event['status'] = 'done'
+            event['returncode'] = returncode
+            event['eta'] = 0 if returncode == 0 else None
+
+            if returncode == 0:
+                event['percent'] = 100.0
+
+            if event['fetched'] is not None:
+                event['bytes'] = event['fetched']
+                event['total_bytes'] = event['fetched']
+
+            self._update_rate(event)
+            self._emit(event)
+            return dict(event)
+
+    def close(self):
+        # type: () -> None
+        """
+        End the status line, if there is one
+        """
+        with self._lock:
+            if self._status_line:
+                print('', flush=True)
+                self._status_line = False
+
+    def _update_rate(self, event):
+        # type: (typing.Dict[str, typing.Any]) -> None
+        elapsed = time.monotonic() - self._started[event['stream']]
+
+        if event['total_bytes'] and event['status'] == 'progress':
+            event['bytes'] = event['total_bytes'] * event['percent'] / 100
+
+        if not event['bytes'] or elapsed <= 0:
+            return
+
+        event['rate'] = event['bytes'] / elapsed
+
+        if event['total_bytes'] and event['status'] != 'done':
+            event['eta'] = max(
+                0, (event['total_bytes'] - event['bytes']) / event['rate'])
+
+    def _emit(self, event):
+        # type: (typing.Dict[str, typing.Any]) -> None
+        if self.style == 'json':
+            print(json.dumps(event, sort_keys=True), flush=True)
+        elif self.style == 'text' and sys.stdout.isatty():
+            width = shutil.get_terminal_size().columns - 1
+            line = ' | '.join(
+                self._describe(e) for e in self._events.values()
+                if e['status'] != 'done'
+            ) or self._describe(event)
+            print('\r' + line[:width].ljust(width), end='', flush=True)
+            self._status_line = True
+        elif self.style == 'text' and event['status'] == 'done':
+            print(self._describe(event), flush=True)
+
+    def _describe(self, event):
+        # type: (typing.Dict[str, typing.Any]) -> str
+        text = '%s: %d%%' % (
+            self.LABELS.get(event['stream'], event['stream']),
+            event['percent'],
+        )
+
+        if event['total_items']:
+            text += ' (%d/%d files)' % (event['items'], event['total_items'])
+
+        if event['bytes'] is not None and event['total_bytes']:
+            text += ', %s of %s' % (format_size(event['bytes']),
+                                    format_size(event['total_bytes']))
+
+        if event['rate']:
+            text += ', %s/s' % format_size(event['rate'])
+
+        if event['eta'] is not None and event['eta'] >= 1 \
+                and event['status'] != 'done':
+            text += ', %ds left' % event['eta']
+
+        if event['status'] == 'done' and event.get('returncode'):
+            text += ', failed'
+
+        return text
+
+
+def run_apt_get_with_progress(
+    argv,       # type: typing.List[str]
+    progress,   # type: AptProgress
+    stream,     # type: str
+    total_bytes=None,   # type: typing.Optional[float]
+):
+    # type: (...) -> typing.Dict[str, typing.Any]
+    """
+    Run an apt-get command with its APT::Status-Fd on a pipe, reporting
+    its progress as stream. Return the last event of the stream, which
+    has the exit status, the bytes fetched and the average rate.
+    """
+    progress.start(stream, total_bytes)
+    (status_reader, status_writer) = os.pipe()
+
+    try:
+        proc = subprocess.Popen(
+            argv + ['-o', 'APT::Status-Fd=%d' % status_writer],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            bufsize=1,
+            universal_newlines=True,
+            env=dict(os.environ, LC_ALL='C'),
+            pass_fds=(status_writer,),
+        )
+    except BaseException:
+        os.close(status_reader)
+        raise
+    finally:
+        os.close(status_writer)
+
+    def read_status():
+        # type: () -> None
+        with open(status_reader, errors='replace') as reader:
+            for line in reader:
+                progress.feed_status(stream, line)
+
+    reader_thread = threading.Thread(
+        target=read_status,
+        name='steamdeps-status-' + stream,
+        daemon=True,
+    )
+    reader_thread.start()
+
+    for line in proc.stdout:
+        progress.feed_output(stream, line)
+
+    proc.wait()
+    reader_thread.join()
+    return progress.finish(stream, proc.returncode)
+
+
+def forget_available_packages():
+    # type: () -> None
+    """
+    Forget what we learned from the lists of available packages and the
+    installed packages, after they changed
+    """
+    global _glvnd
+    global _remap_table
+
+    get_apt_session().invalidate()
+
+    with _glvnd_lock:
+        _glvnd = None
+
+    _remap_table = None
+
+    with _xdg_portal_backends_lock:
+        _xdg_portal_backends.clear()
+
+
+def forget_dpkg_state():
+    # type: () -> None
+    """
+    Forget what we learned from dpkg, after its database changed
+    """
+    global _arch
+    global _foreign_architectures
+
+    forget_available_packages()
+    _arch = None
+    _foreign_architectures = None
+
+
+@profiled('apt-get update')
+def update_apt(show_progress=True, only_steam=False, progress=None):
+    """
+    Refresh the lists of available packages. With only_steam, only the
+    Steam repository is refreshed, unless the i386 architecture was just
+    enabled and therefore every repository needs refreshing. Nothing is
+    refreshed if this run already did, or if the lists are younger than
+    $STEAMDEPS_APT_UPDATE_TTL seconds.
+
+    Progress is reported to progress, if given, for example to share a
+    status line with downloads that happen at the same time.
+    """
+    global _apt_lists_refreshed
+    global _i386_just_enabled
+
+    no_cost = {'bytes': 0, 'seconds': 0}     # type: typing.Dict[str, float]
+    steam_entries = []      # type: typing.List[typing.Tuple[str, str]]
+    prefix = ''
+
+    if _i386_just_enabled:
+        only_steam = False
+    elif _apt_lists_refreshed:
+        logger.debug('apt lists were already refreshed by this run')
+        report_apt_update_savings('Skipping the refresh', no_cost)
+        return
+
+    if only_steam:
+        steam_entries = find_steam_source_entries()
+        prefix = STEAM_REPO_URI.split('://', 1)[1].replace('/', '_') + '_'
+
+        if not steam_entries:
+            only_steam = False
+            prefix = ''
+
+    kind = 'the Steam repository' if only_steam else 'every apt source'
+    age = get_apt_lists_age(prefix)
+    ttl = get_apt_update_ttl()
+
+    if not _i386_just_enabled and age is not None and age < ttl:
+        logger.debug('apt lists for %s are %d seconds old, not refreshing',
+                     kind, age)
+        report_apt_update_savings('Skipping the refresh', no_cost)
+        return
+
+    logger.debug('Running apt-get update for %s...', kind)
+
+    # The lists are about to change, anything we learned from them so far
+    # is stale
+    forget_available_packages()
+
+    argv = ['apt-get', 'update']
+    sources_dir = None
+
+    if only_steam:
+        import tempfile
+
+        # A sources directory with nothing but the Steam entries. Keep the
+        # lists of every other repository instead of cleaning them up.
+        sources_dir = tempfile.mkdtemp(prefix='steamdeps-sources-')
+
+        for (source_format, text) in steam_entries:
+            path = os.path.join(sources_dir, 'steam.' + source_format)
+
+            with open(path, 'a', encoding='utf-8') as writer:
+                writer.write(text + '\n\n')
+
+        argv.extend([
+            '-o', 'Dir::Etc::sourcelist=/dev/null',
+            '-o', 'Dir::Etc::sourceparts=' + sources_dir,
+            '-o', 'APT::Get::List-Cleanup=0',
+        ])
+
+    own_progress = (progress is None)
+
+    if progress is None:
+        progress = AptProgress(None if show_progress else 'none')
+
+    stats = load_cache_file(APT_UPDATE_CACHE_FILE)
+    expected = None     # type: typing.Optional[float]
+
+    if not only_steam and isinstance(stats, dict) and 'full' in stats:
+        # The last full update is the best guess for this one
+        expected = stats['full']['bytes'] or None
+
+    start = time.monotonic()
+
+    try:
+        result = run_apt_get_with_progress(argv, progress, 'update', expected)
+    finally:
+        if own_progress:
+            progress.close()
+
+        if sources_dir is not None:
+            shutil.rmtree(sources_dir, ignore_errors=True)
+
+    if result['returncode'] != 0:
+        logger.warning('apt-get update exited with status %d',
+                       result['returncode'])
+
+    cost = {
+        'bytes': result['fetched'] or 0.0,
+        'seconds': time.monotonic() - start,
+    }
+    _apt_lists_refreshed = True
+    _i386_just_enabled = False
+
+    if only_steam:
+        report_apt_update_savings('Refreshing only the Steam repository',
+                                  cost)
+    else:
+        stats = load_cache_file(APT_UPDATE_CACHE_FILE)
+
+        if not isinstance(stats, dict):
+            stats = {}
+
+        stats['full'] = cost
+        store_cache_file(APT_UPDATE_CACHE_FILE, stats)
+
+
+def needs_i386():
+    # type: () -> bool
+    return (get_arch() == 'amd64'
+            and 'i386' not in get_foreign_architectures())
+
+
+def enable_i386():
+    # type: () -> bool
+
+    global _foreign_architectures
+    global _i386_just_enabled
+
+    if needs_i386():
+        # Check to make sure 64-bit systems can get 32-bit packages
+        logger.debug('Adding i386 architecture...')
+        cp = run_subprocess(['dpkg', '--add-architecture', 'i386'])
+        if cp.returncode != 0:
+            logger.warning(
+                'An error occurred while enabling 32-bit (i386) packages',
+            )
+            return False
+
+        # Every repository has to be refreshed to get the i386 lists
+        _i386_just_enabled = True
+
+    # invalidate cache
+    _foreign_architectures = None
+
+    return True
+
+
+def pass_through_environ(
+    argv,       # type: typing.List[str]
+):
+    # type: (...) -> None
+
+    for var in PASS_THROUGH_ENV_VARS:
+        if var in os.environ:
+            argv.append('--setenv={}={}'.format(var, os.environ[var]))
+
+
+def is_pipelined_install():
+    # type: () -> bool
+    return os.environ.get('STEAMDEPS_INSTALL_MODE') == 'pipelined'
+
+
+@profiled('apt-get download')
+def prefetch_packages(packages, progress):
+    # type: (typing.List[str], AptProgress) -> int
+    """
+    Download packages into apt's archive cache without installing them
+    """
+    try:
+        result = run_apt_get_with_progress(
+            [
+                'apt-get', 'install', '--download-only', '--no-remove',
+                '--yes', '--quiet',
+            ] + packages,
+            progress,
+            'download',
+        )
+    except OSError as e:
+        logger.debug('Unable to download packages in advance: %s', e)
+        return -1
+
+    if result['returncode'] != 0:
+        # Not a problem: apt-get install will download whatever is missing
+        logger.debug('Downloading packages in advance failed with status %d',
+                     result['returncode'])
+
+    return result['returncode']
+
+
+def start_prefetch(packages, progress):
+    # type: (typing.List[str], AptProgress) -> typing.Optional[typing.Any]
+    """
+    Start downloading those of packages that the current apt lists already
+    have a candidate for, so that the download overlaps with refreshing
+    the lists. Return a future for apt-get's exit status, or None if
+    there is nothing to download yet.
+    """
+    import concurrent.futures
+
+    # Packages of an architecture that was just enabled aren't known yet
+    known = [name for name in packages if is_package_available(name)]
+
+    if not known:
+        return None
+
+    logger.debug('Downloading while apt lists are refreshed: %s',
+                 ' '.join(known))
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1,
+        thread_name_prefix='steamdeps-prefetch',
+    )
+    future = executor.submit(prefetch_packages, known, progress)
+    executor.shutdown(wait=False)
+    return future
+
+
+###
+@profiled('apt-get install')
+def update_packages(packages, install_confirmation=True):
+    """
+    Function to install or update package dependencies, expected to be executed
+    in an interactive terminal.
+    Ideally we would call some sort of system UI that users were familiar with
+    to do this, but nothing that exists yet does what we need.
+    """
+
+    if install_confirmation:
+        print('\nSteam needs to install these additional packages:')
+        print(*packages)
+        input('\nPress return to proceed with the installation: ')
+    else:
+        logger.debug('Will install packages: %s', ' '.join(packages))
+
+    if not is_root():
+        # We don't have root privileges, call again this script with pkexec
+        logger.debug('Re-running steamdeps as root...')
+        argv = [
+            'pkexec',
+            os.path.abspath(__file__),
+            '--interactive',
+            # We already showed the confirmation once, no need to repeat it
+            '--no-install-confirmation',
+            '--install',
+            ' '.join(packages)
+        ]
+        pass_through_environ(argv)
+        cp = run_with_handoff_state(argv, to_install=packages)
+        return cp.returncode
+
+    if not enable_i386():
+        return 1
+
+    progress = AptProgress()
+    prefetch = None
+
+    if is_pipelined_install() and not _apt_lists_refreshed:
+        prefetch = start_prefetch(packages, progress)
+
+    try:
+        update_apt(progress=progress)
+
+        if prefetch is not None:
+            with profile_phase('wait for downloads'):
+                prefetch.result()
+    finally:
+        progress.close()
+
+    # Install the packages using the option "--no-remove" to avoid
+    # unexpected dependencies cycle that end up removing packages that are
+    # essential for the OS to run
+    logger.debug('Installing packages: %s...', ' '.join(packages))
+    cp = run_subprocess(
+        ['apt-get', 'install', '--no-remove'] + packages,
+        universal_newlines=True,
+    )
+
+    return cp.returncode
+
+
+###
+class ProbeScheduler:
+    """
+    Run the environment probes concurrently in worker threads. Most of
+    them are independent subprocesses or file reads, so there is no reason
+    to wait for each one before starting the next.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self._executor = None   # type: typing.Any
+        # name -> (future, start time, timeout, default)
+        self._probes = {}       # type: typing.Dict[str, typing.Tuple]
+
+    def start(
+        self,
+        name,           # type: str
+        function,       # type: typing.Callable[[], typing.Any]
+        timeout=None,   # type: typing.Optional[float]
+        default=None,   # type: typing.Any
+    ):
+        # type: (...) -> None
+        """
+        Start running function in the background. If timeout is not None
+        and the probe takes longer than that, result() gives up waiting
+        and returns default instead, and the subprocesses that the probe
+        started with get_probe_timeout() are killed.
+        """
+        if name in self._probes:
+            # Already started, or provided by the parent process
+            return
+
+        if self._executor is None:
+            import concurrent.futures
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=8,
+                thread_name_prefix='steamdeps-probe',
+            )
+
+        start_time = time.monotonic()
+        future = self._executor.submit(
+            self._run, name, function, start_time, timeout)
+        self._probes[name] = (future, start_time, timeout, default)
+
+    def __contains__(self, name):
+        # type: (str) -> bool
+        return name in self._probes
+
+    def provide(self, name, value):
+        # type: (str, typing.Any) -> None
+        """
+        Record a result that is already known, so that the probe doesn't
+        have to run at all
+        """
+        import concurrent.futures
+
+        future = concurrent.futures.Future()    # type: typing.Any
+        future.set_result(value)
+        self._probes[name] = (future, time.monotonic(), None, None)
+
+    def completed(self):
+        # type: () -> typing.Dict[str, typing.Any]
+        """
+        Return the results of the probes that finished successfully
+        """
+        results = {}
+
+        for (name, (future, _, _, _)) in self._probes.items():
+            if future.done() and future.exception() is None:
+                results[name] = future.result()
+
+        return results
+
+    def _run(self, name, function, start_time, timeout):
+        if timeout is not None:
+            _probe_deadline.value = start_time + timeout
+
+        try:
+            with profile_phase('probe:' + name):
+                return function()
+        finally:
+            _probe_deadline.value = None
+            logger.debug(
+                'Probe %s finished after %.1f ms',
+                name, (time.monotonic() - start_time) * 1000,
+            )
+
+    def result(self, name):
+        # type: (str) -> typing.Any
+        import concurrent.futures
+
+        future, start_time, timeout, default = self._probes[name]
+
+        if timeout is not None:
+            timeout = max(0, start_time + timeout - time.monotonic())
+
+        try:
+            return future.result(timeout)
+        except (concurrent.futures.TimeoutError, subprocess.TimeoutExpired):
+            # Either we gave up waiting, or the probe's subprocess was
+            # killed at the same deadline
+            logger.warning(
+                'Probe %s did not finish within %s seconds, assuming %r',
+                name, self._probes[name][2], default,
+            )
+            return default
+
+    def shutdown(self):
+        # type: () -> None
+        # Probes that were given up on may still be running, but not for
+        # longer than their timeout: their subprocesses get killed then,
+        # so the worker threads can be joined at exit
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+def get_probe_timeout():
+    # type: () -> float
+    """
+    Return how long a subprocess started by a probe function may take:
+    what is left of the timeout of the probe running in this thread, or
+    PROBE_TIMEOUT if the function was called directly
+    """
+    deadline = getattr(_probe_deadline, 'value', None)
+
+    if deadline is None:
+        return PROBE_TIMEOUT
+
+    return max(0.0, deadline - time.monotonic())
+
+
+###
+def check_config(path, config):
+    if "STEAM_RUNTIME" not in config:
+        sys.stderr.write(
+            "Missing STEAM_RUNTIME definition in %s\n" % path)
+        return False
+
+    if config["STEAM_RUNTIME"] not in SUPPORTED_STEAM_RUNTIME:
+        sys.stderr.write(
+            "Unsupported Steam runtime: %s\n" % config["STEAM_RUNTIME"])
+        return False
+
+    if "STEAM_DEPENDENCY_VERSION" not in config:
+        sys.stderr.write(
+            "Missing STEAM_DEPENDENCY_VERSION definition in %s\n" % path)
+        return False
+
+    if config["STEAM_DEPENDENCY_VERSION"]\
+            not in SUPPORTED_STEAM_DEPENDENCY_VERSION:
+        sys.stderr.write("Unsupported dependency version: %s\n" % config[
+            "STEAM_DEPENDENCY_VERSION"])
+        return False
+
+    # Make sure we can use dpkg on this system.
+    try:
+        subprocess.call(['dpkg', '--version'], stdout=subprocess.PIPE)
+    except FileNotFoundError:
+        sys.stderr.write("Couldn't find dpkg, please update steamdeps for "
+                         "your distribution.\n")
+        return False
+
+    return True
+
+
+def update_installed_packages(packages):
+    # Get the installed package versions
+    status = get_installed_packages()
+
+    for name, package in packages.items():
+        version = status.get_installed_version(name)
+
+        if version is not None:
+            package.set_installed(version)
+
+
+def is_installable(package, index):
+    # type: (Package, typing.Optional[AvailablePackagesIndex]) -> bool
+    """
+    Return True if a version of package that satisfies its version
+    conditions is available. Without an index, assume that it is.
+    """
+    if index is None:
+        return True
+
+    versions = index.get_versions(package.name)
+
+    if not versions:
+        # It might be a virtual package
+        return (
+            not package.version_conditions
+            and bool(index.get_providers(package.name.split(':', 1)[0]))
+        )
 
-    # Fallback if no GUI terminal program is available
-    return ['/usr/bin/env']
+    return any(
+        all(
+            check_version_condition(version, op, wanted)
+            for (op, wanted) in package.version_conditions
+        )
+        for (_, version) in versions
+    )
 
 
-def get_terminal_wait(
-    title       # type: str
+@profiled('resolve install set')
+def resolve_install_set(
+    dependencies,   # type: typing.List[typing.List[Package]]
+    free=(),        # type: typing.Iterable[str]
+    index=None,     # type: typing.Optional[AvailablePackagesIndex]
 ):
-    # type: (...) -> typing.List[str]
-    return get_terminal(title) + [
-        '/bin/sh', '-euc',
-        ('e=0; "$@" || e=$?;'
-         'printf \'\\nPress return to continue: \'; read line;'
-         'exit "$e"'),
-        'sh',
+    # type: (...) -> typing.Tuple[typing.List[Package], typing.List[str]]
+    """
+    Choose which packages to install so that every dependency row has an
+    alternative that is available, installing as few packages as
+    possible. Packages in free are installed anyway if anything is, so
+    they cost nothing.
+
+    Rows are considered together: greedily, the alternative that can be
+    installed and satisfies the most remaining rows is chosen first, and
+    ties go to the alternative listed first. A row where no alternative
+    can be installed falls back to its first alternative, so that apt
+    reports the problem.
+
+    Return the chosen packages and the reasoning behind each choice.
+    """
+    free = set(free)
+    chosen = {}     # type: typing.Dict[str, Package]
+    reasons = []    # type: typing.List[str]
+    installable = {}    # type: typing.Dict[int, bool]
+
+    def can_install(package):
+        # type: (Package) -> bool
+        if id(package) not in installable:
+            installable[id(package)] = is_installable(package, index)
+        return installable[id(package)]
+
+    def describe(row):
+        # type: (typing.List[Package]) -> str
+        return " | ".join(str(package) for package in row)
+
+    remaining = [
+        row for row in dependencies
+        if row and not any(dep.is_available() for dep in row)
     ]
+    # Rows whose choice was already reported
+    explained = set()   # type: typing.Set[int]
 
+    for row in remaining:
+        if not any(can_install(dep) for dep in row):
+            explained.add(id(row))
 
-###
-def is_root():
-    return os.getuid() == 0
+            if row[0].name in chosen:
+                continue
+
+            chosen[row[0].name] = row[0]
+
+            if len(row) > 1:
+                reasons.append(
+                    "%s: no alternative is available, choosing %s"
+                    % (describe(row), row[0].name))
+
+    while remaining:
+        unsatisfied = []
+
+        for row in remaining:
+            already = [dep.name for dep in row if dep.name in chosen]
+
+            if not already:
+                unsatisfied.append(row)
+            elif id(row) not in explained and len(row) > 1:
+                reasons.append("%s: %s is already being installed"
+                               % (describe(row), already[0]))
+
+        if not unsatisfied:
+            break
+
+        # Number of rows that each alternative would satisfy, and how
+        # early it is listed
+        coverage = {}   # type: typing.Dict[str, int]
+        position = {}   # type: typing.Dict[str, int]
+
+        for row in unsatisfied:
+            for (i, dep) in enumerate(row):
+                if can_install(dep):
+                    coverage[dep.name] = coverage.get(dep.name, 0) + 1
+                    position[dep.name] = min(position.get(dep.name, i), i)
+
+        best = max(
+            coverage,
+            key=lambda name: (
+                name in free, coverage[name], -position[name], name,
+            ),
+        )
+        row = next(
+            row for row in unsatisfied
+            if any(dep.name == best for dep in row)
+        )
+        package = next(dep for dep in row if dep.name == best)
+        chosen[best] = package
+        explained.add(id(row))
+
+        if len(row) > 1 or coverage[best] > 1:
+            details = []
+
+            if best in free:
+                details.append("installed anyway")
+            elif index is not None:
+                details.append("available")
+
+            if coverage[best] > 1:
+                details.append("satisfies %d dependencies" % coverage[best])
+
+            skipped = [dep.name for dep in row[:row.index(package)]]
+
+            if skipped:
+                details.append("preferred over %s" % ", ".join(skipped))
+
+            reasons.append("%s: choosing %s (%s)"
+                           % (describe(row), best, "; ".join(details)))
+
+        remaining = unsatisfied
+
+    return (list(chosen.values()), reasons)
 
 
 ###
-def is_apt_out_of_sync():
+def get_cache_dir():
+    # type: () -> str
+    cache_home = (
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    )
+    return os.path.join(cache_home, 'steamdeps')
+
+
+def load_cache_file(name):
+    # type: (str) -> typing.Any
+    path = os.path.join(get_cache_dir(), name)
+
+    try:
+        with open(path, 'r', encoding='utf-8') as reader:
+            return json.load(reader)
+    except (OSError, ValueError):
+        return None
+
+
+def store_cache_file(name, data):
+    # type: (str, typing.Any) -> None
+    cache_dir = get_cache_dir()
+    path = os.path.join(cache_dir, name)
+
+    import tempfile
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix=name + '.')
+
+        try:
+            with open(fd, 'w', encoding='utf-8') as writer:
+                json.dump(data, writer)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except OSError as e:
+        logger.debug('Unable to write %s: %s', path, e)
+
+
+def get_host_stamp():
+    # type: () -> typing.Dict[str, typing.Any]
     """
-    Returns True if the apt policies are not in sync with what is listed
-    in the apt sources lists.
+    Describe the state of the host that the architecture, os-release and
+    Nvidia probes depend on
+    """
+    return {
+        'steamdeps': file_stamp(os.path.abspath(__file__)),
+        # The native architecture is built into dpkg
+        'dpkg': file_stamp(shutil.which('dpkg') or 'dpkg'),
+        'dpkg_status': file_stamp(DPKG_STATUS_PATH),
+        'dpkg_arch': file_stamp(DPKG_ARCH_PATH),
+        'os_release': [file_stamp(p) for p in OS_RELEASE_PATHS],
+        'nvidia_version': get_nvidia_version(),
+        'desktop': os.environ.get('XDG_CURRENT_DESKTOP', ''),
+    }
+
+
+def get_apt_stamp():
+    # type: () -> typing.Dict[str, typing.Any]
     """
-    # We only care about the Steam repository
-    steam_uri = 'https://repo.steampowered.com/steam'
+    Describe the state of the apt sources and lists of available packages
+    """
+    sources = sorted(glob.glob(os.path.join(APT_SOURCES_PARTS, '*')))
+    sources.append(APT_SOURCES_LIST)
 
-    cp = run_subprocess(
-        ['apt-cache', 'policy'],
-        capture_output=True,
-        universal_newlines=True,
-    )
-    if steam_uri in cp.stdout:
-        # The Steam repository is already in the apt policies, no need
-        # to update apt sources
-        return False
+    return {
+        'apt_lists': file_stamp(APT_LISTS_DIR),
+        'apt_sources': [[p, file_stamp(p)] for p in sources],
+    }
 
-    # Technically, as explained in sources.list(5), also '.sources' files
-    # with the deb822 style are understood by apt but they cannot be
-    # parsed with python-apt. By default we expect to have the Steam
-    # repository in a '.list' file, so it should be safe to skip them.
-    # However if we decide to also parse the '.sources' files, we should
-    # probably use the python3-debian package.
-    sources_list = glob.glob('/etc/apt/sources.list.d/*.list')
-    sources_list.append('/etc/apt/sources.list')
 
-    for source in sources_list:
-        try:
-            with open(source) as f:
-                for line in f.readlines():
-                    entry = SourceEntry(line, f.name)
-                    entry.parse(line)
-                    if steam_uri in entry.uri and not entry.disabled:
-                        # The Steam repository is in the sources list but not
-                        # in the apt policies. We need to update apt sources
-                        return True
-        except OSError as err:
-            print('Failed to open "{}": {}'.format(source, err))
+def get_verdict_key(
+    path,           # type: str
+    host_key=None,  # type: typing.Optional[typing.Dict[str, typing.Any]]
+):
+    # type: (...) -> typing.Optional[typing.Dict[str, typing.Any]]
+    """
+    Describe everything that the verdict about the dependencies listed
+    in path depends on. If any of it changes, a cached verdict is stale.
 
-    # Apparently we don't have the Steam repository, no need to update
-    # apt sources
-    return False
+    host_key is the part that doesn't depend on path, as returned by
+    get_host_verdict_key(), when evaluating several files.
+    """
+    try:
+        with open(path, 'rb') as reader:
+            digest = hashlib.sha256(reader.read()).hexdigest()
+    except OSError as e:
+        logger.debug('Not using the verdict cache: %s', e)
+        return None
 
+    if host_key is None:
+        host_key = get_host_verdict_key()
 
-###
-def update_apt(show_progress=True):
-    logger.debug('Running apt-get update...')
+    key = {'dependencies': digest}
+    key.update(host_key)
+    return key
 
-    if show_progress:
-        stdout_dest = subprocess.PIPE
-    else:
-        stdout_dest = subprocess.DEVNULL
 
-    proc = subprocess.Popen(
-        ['apt-get', 'update'],
-        stdout=stdout_dest,
-        bufsize=1,
-        universal_newlines=True,
-    )
-    if show_progress:
-        for _ in proc.stdout:
-            print('.', end='', flush=True)
-        print('')
+def get_host_verdict_key():
+    # type: () -> typing.Dict[str, typing.Any]
+    # The architectures are not probed, so that a cache hit doesn't run
+    # dpkg: the stamps of the dpkg binary and of its list of foreign
+    # architectures in the host stamp change whenever they do
+    key = {
+        'version': VERDICT_CACHE_VERSION,
+    }   # type: typing.Dict[str, typing.Any]
+    key.update(get_host_stamp())
+    key.update(get_apt_stamp())
+    return key
 
 
-def needs_i386():
-    # type: () -> bool
-    return (get_arch() == 'amd64'
-            and 'i386' not in get_foreign_architectures())
+def load_cached_verdicts(
+    paths,      # type: typing.List[str]
+):
+    # type: (...) -> typing.Optional[typing.List[typing.Dict[str, typing.Any]]]
+    """
+    Return the verdicts of previous runs about the dependencies listed in
+    paths, if nothing they depend on has changed since. If any of them is
+    missing or stale, return None.
+    """
+    entries = load_cache_file(VERDICT_CACHE_FILE)
 
+    if not isinstance(entries, dict):
+        return None
 
-def enable_i386():
-    # type: () -> bool
+    host_key = get_host_verdict_key()
+    verdicts = []
+
+    for path in paths:
+        entry = entries.get(os.path.abspath(path))
+
+        if not isinstance(entry, dict):
+            return None
+
+        if entry.get('key') != get_verdict_key(path, host_key):
+            return None
+
+        verdicts.append(entry.get('verdict'))
+
+    return verdicts
+
+
+def store_verdicts(
+    verdicts,   # type: typing.List[typing.Tuple[str, dict]]
+):
+    # type: (...) -> None
+    host_key = get_host_verdict_key()
+    entries = load_cache_file(VERDICT_CACHE_FILE)
+
+    if not isinstance(entries, dict):
+        entries = {}
+
+    for (path, verdict) in verdicts:
+        key = get_verdict_key(path, host_key)
+
+        if key is not None:
+            entries[os.path.abspath(path)] = {'key': key, 'verdict': verdict}
+
+    store_cache_file(VERDICT_CACHE_FILE, entries)
 
+
+def invalidate_verdict_cache():
+    # type: () -> None
+    try:
+        os.unlink(os.path.join(get_cache_dir(), VERDICT_CACHE_FILE))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning('Unable to invalidate the verdict cache: %s', e)
+
+
+def write_handoff_state(
+    probes=None,        # type: typing.Optional[ProbeScheduler]
+    to_install=None,    # type: typing.Optional[typing.List[str]]
+):
+    # type: (...) -> typing.Optional[str]
+    """
+    Save what we know about the system to a temporary file, for a child
+    process that we are about to re-execute to trust instead of probing
+    everything again. Return the path, or None if it could not be written.
+    """
+    import tempfile
+
+    results = dict(_handoff_probes)
+
+    if probes is not None:
+        results.update(probes.completed())
+
+    host_probes = {}    # type: typing.Dict[str, typing.Any]
+    apt_probes = {}     # type: typing.Dict[str, typing.Any]
+
+    if _arch is not None:
+        host_probes['arch'] = _arch
+
+    if _foreign_architectures is not None:
+        host_probes['foreign_architectures'] = _foreign_architectures
+
+    if 'os_release' in results:
+        host_probes['os_release'] = results['os_release'].to_dict()
+
+    if 'nvidia_packages' in results:
+        host_probes['nvidia_packages'] = sorted(results['nvidia_packages'])
+
+    if _glvnd is not None:
+        apt_probes['glvnd'] = _glvnd
+
+    if 'xdg-desktop-portal-gtk' in _xdg_portal_backends:
+        apt_probes['xdg_portal_backend'] = \
+            _xdg_portal_backends['xdg-desktop-portal-gtk']
+
+    if 'apt_out_of_sync' in results:
+        apt_probes['apt_out_of_sync'] = results['apt_out_of_sync']
+
+    state = {
+        'version': HANDOFF_STATE_VERSION,
+        'host_stamp': get_host_stamp(),
+        'host_probes': host_probes,
+        'apt_stamp': get_apt_stamp(),
+        'apt_probes': apt_probes,
+        'to_install': to_install,
+    }
+
+    try:
+        fd, path = tempfile.mkstemp(prefix='steamdeps-state-', suffix='.json')
+
+        with open(fd, 'w', encoding='utf-8') as writer:
+            json.dump(state, writer)
+    except OSError as e:
+        logger.debug('Unable to save state for the child process: %s', e)
+        return None
+
+    return path
+
+
+def load_handoff_state(
+    path,               # type: str
+    to_install=None,    # type: typing.Optional[typing.List[str]]
+):
+    # type: (...) -> None
+    """
+    Trust the probe results saved by the process that re-executed us, as
+    long as the parts of the system they depend on didn't change since
+    """
+    global _arch
     global _foreign_architectures
+    global _glvnd
 
-    if needs_i386():
-        # Check to make sure 64-bit systems can get 32-bit packages
-        logger.debug('Adding i386 architecture...')
-        cp = run_subprocess(['dpkg', '--add-architecture', 'i386'])
-        if cp.returncode != 0:
-            logger.warning(
-                'An error occurred while enabling 32-bit (i386) packages',
+    try:
+        with open(path, 'r', encoding='utf-8') as reader:
+            state = json.load(reader)
+    except (OSError, ValueError) as e:
+        logger.debug('Ignoring state from the parent process: %s', e)
+        return
+
+    if (
+        not isinstance(state, dict)
+        or state.get('version') != HANDOFF_STATE_VERSION
+        or state.get('to_install') != to_install
+    ):
+        logger.debug('Ignoring state from the parent process: mismatch')
+        return
+
+    if state.get('host_stamp') == get_host_stamp():
+        probes = state['host_probes']
+
+        _arch = probes.get('arch', _arch)
+        _foreign_architectures = probes.get(
+            'foreign_architectures', _foreign_architectures,
+        )
+
+        if 'os_release' in probes:
+            _handoff_probes['os_release'] = OsRelease(probes['os_release'])
+
+        if 'nvidia_packages' in probes:
+            _handoff_probes['nvidia_packages'] = dict(
+                (name, Package(name, []))
+                for name in probes['nvidia_packages']
             )
-            return False
 
-    # invalidate cache
-    _foreign_architectures = None
+        logger.debug('Reusing host probes from the parent process: %s',
+                     ', '.join(sorted(probes)))
 
-    return True
+    if state.get('apt_stamp') == get_apt_stamp():
+        probes = state['apt_probes']
 
+        _glvnd = probes.get('glvnd', _glvnd)
 
-def pass_through_environ(
-    argv,       # type: typing.List[str]
+        if 'xdg_portal_backend' in probes:
+            _xdg_portal_backends['xdg-desktop-portal-gtk'] = \
+                probes['xdg_portal_backend']
+
+        if 'apt_out_of_sync' in probes:
+            _handoff_probes['apt_out_of_sync'] = probes['apt_out_of_sync']
+
+        logger.debug('Reusing apt probes from the parent process: %s',
+                     ', '.join(sorted(probes)))
+
+
+@profiled('re-execute')
+def run_with_handoff_state(
+    argv,               # type: typing.List[str]
+    probes=None,        # type: typing.Optional[ProbeScheduler]
+    to_install=None,    # type: typing.Optional[typing.List[str]]
 ):
-    # type: (...) -> None
+    # type: (...) -> typing.Any
+    """
+    Re-execute ourselves with argv, handing over what we already know
+    """
+    path = write_handoff_state(probes, to_install)
+
+    if path is not None:
+        argv = argv + ['--state-file=' + path]
+
+    try:
+        return run_subprocess(argv, universal_newlines=True)
+    finally:
+        if path is not None:
+            os.unlink(path)
+
+
+def report_verdict(verdict):
+    # type: (typing.Dict[str, typing.Any]) -> None
+    if verdict['missing']:
+        print("These packages are not available:\n")
+
+        for p in verdict['missing']:
+            print("- %s" % p)
+
+        print("\nThe Steam client may have limited functionality.")
+
+    for (name, installed, description) in verdict['needed']:
+        if installed:
+            print("Package %s is installed with version '%s' but doesn't "
+                  "match requirements: %s" % (name, installed, description),
+                  file=sys.stderr)
+        else:
+            print("Package %s needs to be installed" % name,
+                  file=sys.stderr)
+
+
+def merge_verdicts(
+    verdicts,   # type: typing.List[typing.Dict[str, typing.Any]]
+):
+    # type: (...) -> typing.Dict[str, typing.Any]
+    """
+    Combine the verdicts about several dependencies files into one, so
+    that everything they need is installed at once
+    """
+    needed = {}     # type: typing.Dict[str, typing.List[typing.Any]]
+    reasons = []    # type: typing.List[str]
+
+    for verdict in verdicts:
+        for entry in verdict['needed']:
+            needed.setdefault(entry[0], entry)
+
+        for reason in verdict['reasons']:
+            if reason not in reasons:
+                reasons.append(reason)
+
+    return {
+        'missing': sorted(set(p for v in verdicts for p in v['missing'])),
+        'needed': [needed[name] for name in sorted(needed)],
+        'to_install': sorted(
+            set(p for v in verdicts for p in v['to_install'])),
+        'reasons': reasons,
+    }
+
+
+def act_on_verdicts(
+    args,       # type: typing.Any
+    paths,      # type: typing.List[str]
+    verdicts,   # type: typing.List[typing.Dict[str, typing.Any]]
+):
+    # type: (...) -> int
+    """
+    Report the verdict about each dependencies file and install whatever
+    they say is missing, in a single apt-get install
+    """
+    if len(verdicts) == 1:
+        report_verdict(verdicts[0])
+        verdict = verdicts[0]
+    else:
+        for (path, verdict) in zip(paths, verdicts):
+            print("\n%s:" % path)
+
+            if not verdict['missing'] and not verdict['needed']:
+                print("All dependencies are satisfied")
+
+            report_verdict(verdict)
+            sys.stderr.flush()
+
+        verdict = merge_verdicts(verdicts)
+
+    # If we have anything to install, do it!
+    if not verdict['to_install']:
+        return 0
+
+    to_install = verdict['to_install']
+
+    if args.dry_run:
+        for reason in verdict['reasons']:
+            print('Resolved %s' % reason)
+
+        print(
+            'Would run: apt-get install --no-remove {}'.format(
+                ' '.join(to_install)
+            )
+        )
+        return 1
+
+    if args.interactive:
+        return update_packages(to_install, args.install_confirmation)
+
+    logger.debug(
+        'Re-running steamdeps in a terminal to install selected '
+        'packages',
+    )
+    argv = get_terminal_wait('Package Install') + [
+        os.path.abspath(__file__),
+        '--interactive',
+    ]
+    pass_through_environ(argv)
+
+    if not args.install_confirmation:
+        argv.append('--no-install-confirmation')
+
+    argv.extend([
+        '--install',
+        ' '.join(to_install),
+    ])
+
+    cp = run_with_handoff_state(argv, to_install=to_install)
+    return cp.returncode
+
+
+###
+class InotifyWatcher:
+    """
+    Watch directories with inotify(7), through ctypes so that it doesn't
+    need anything that isn't in the standard library. Watching the
+    directory rather than the file is what catches files that are
+    replaced by renaming, like dpkg does with its status file.
+    """
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = (
+        IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE
+    )
+
+    def __init__(self):
+        # type: () -> None
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True,
+        )
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        # watch descriptor -> [(tag, names or None for any)]
+        self._watches = {}  # type: typing.Dict[int, typing.List[typing.Any]]
+
+    def watch(self, path, tag, names=None):
+        # type: (str, str, typing.Optional[typing.Iterable[str]]) -> None
+        """
+        Report tag when something changes in the directory path, or only
+        when it happens to one of names if not None
+        """
+        import ctypes
+
+        wd = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(path), self.MASK,
+        )
+
+        if wd < 0:
+            errno = ctypes.get_errno()
+            logger.debug('Unable to watch %s: %s', path, os.strerror(errno))
+            return
+
+        watch = (tag, None if names is None else frozenset(names))
+
+        if watch not in self._watches.setdefault(wd, []):
+            self._watches[wd].append(watch)
+
+    def read(self):
+        # type: () -> typing.Set[str]
+        """
+        Return the tags of the watches that saw changes since last time
+        """
+        import struct
+
+        tags = set()    # type: typing.Set[str]
+
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+
+            while offset < len(data):
+                wd, _, _, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16:offset + 16 + length]
+                name = os.fsdecode(name.rstrip(b'\0'))
+                offset += 16 + length
+
+                for (tag, names) in self._watches.get(wd, []):
+                    if names is None or name in names:
+                        tags.add(tag)
+
+        return tags
+
+    def close(self):
+        # type: () -> None
+        os.close(self.fd)
+
+
+def get_daemon_socket_path():
+    # type: () -> str
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or get_cache_dir()
+    return os.path.join(runtime_dir, DAEMON_SOCKET_NAME)
+
+
+class SteamdepsDaemon:
+    """
+    Keep the dependencies rows, the dpkg status snapshot and the index
+    of available packages in memory, and answer whether the dependencies
+    are satisfied over a Unix socket.
+
+    Requests and responses are one line of JSON each. A request is
+    {"dependencies": [path, ...]}, where the paths default to the ones
+    the daemon was started with. The response is {"dependencies": [...],
+    "verdicts": [...], "apt_out_of_sync": bool}, or {"error": message,
+    "status": exit status}.
+
+    Changes to the dpkg database, the apt lists and sources and the
+    dependencies files are noticed with inotify, and only the verdicts
+    that depend on them are evaluated again, on the next query.
+    """
+
+    # Seconds a client has to send its request, or to take the response
+    REQUEST_TIMEOUT = 1
+    MAX_REQUEST_SIZE = 1024 * 1024
+
+    def __init__(self, socket_path, paths):
+        # type: (str, typing.List[str]) -> None
+        self.socket_path = socket_path
+        self.paths = [os.path.abspath(path) for path in paths]
+        # path -> load_dependencies(path)
+        self._loaded = {}       # type: typing.Dict[str, typing.Any]
+        # path -> verdict
+        self._verdicts = {}     # type: typing.Dict[str, typing.Any]
+        self._apt_out_of_sync = None    # type: typing.Optional[bool]
+        self._watcher = None    # type: typing.Optional[InotifyWatcher]
+
+        try:
+            self._watcher = InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            logger.warning('inotify is not available, re-checking '
+                           'everything on each query: %s', e)
+
+        if self._watcher is not None:
+            self._watcher.watch(
+                os.path.dirname(DPKG_STATUS_PATH), 'dpkg',
+                [os.path.basename(DPKG_STATUS_PATH),
+                 os.path.basename(DPKG_ARCH_PATH)],
+            )
+            self._watcher.watch(APT_LISTS_DIR, 'lists')
+            self._watcher.watch(
+                os.path.dirname(APT_SOURCES_LIST), 'sources',
+                [os.path.basename(APT_SOURCES_LIST)],
+            )
+            self._watcher.watch(APT_SOURCES_PARTS, 'sources')
+
+    def _watch_dependencies(self, path):
+        # type: (str) -> None
+        if self._watcher is not None:
+            self._watcher.watch(
+                os.path.dirname(path), 'dependencies:' + path,
+                [os.path.basename(path)],
+            )
+
+    def invalidate(self, tags):
+        # type: (typing.Iterable[str]) -> None
+        for tag in tags:
+            logger.debug('Change in %s', tag)
+
+            if tag == 'dpkg':
+                forget_dpkg_state()
+                self._verdicts.clear()
+            elif tag == 'lists':
+                forget_available_packages()
+                self._verdicts.clear()
+                self._apt_out_of_sync = None
+            elif tag == 'sources':
+                self._apt_out_of_sync = None
+            elif tag.startswith('dependencies:'):
+                path = tag.split(':', 1)[1]
+                self._loaded.pop(path, None)
+                self._verdicts.pop(path, None)
+
+    def query(self, request):
+        # type: (typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]
+        if self._watcher is None:
+            # Everything reloads only if its stamp changed anyway
+            self.invalidate(['dpkg', 'lists', 'sources'])
+            self._loaded.clear()
+
+        try:
+            paths = expand_dependencies_paths(
+                request.get('dependencies') or self.paths)
+        except OSError as e:
+            return {'error': str(e), 'status': 2}
+
+        paths = [os.path.abspath(path) for path in paths]
+        stale = [path for path in paths if path not in self._verdicts]
+
+        if stale:
+            probes = ProbeScheduler()
+
+            try:
+                start_host_probes(probes)
+                start_package_probes(probes)
+
+                for path in stale:
+                    if path not in self._loaded:
+                        self._watch_dependencies(path)
+
+                        try:
+                            self._loaded[path] = load_dependencies(path)
+                        except Exception as e:
+                            return {'error': "Couldn't open file: %s" % e,
+                                    'status': 2}
+
+                    (code, verdict) = evaluate_dependencies(
+                        path, probes, self._loaded[path])
+
+                    if verdict is None:
+                        return {'error': 'Unable to evaluate %s' % path,
+                                'status': code}
+
+                    self._verdicts[path] = verdict
+            finally:
+                probes.shutdown()
+
+        if self._apt_out_of_sync is None:
+            self._apt_out_of_sync = is_apt_out_of_sync()
+
+        return {
+            'dependencies': paths,
+            'verdicts': [self._verdicts[path] for path in paths],
+            'apt_out_of_sync': self._apt_out_of_sync,
+        }
+
+    def respond(self, line):
+        # type: (bytes) -> typing.Dict[str, typing.Any]
+        """
+        Return the response to the request line. Errors are reported to
+        the client rather than raised, so that one bad request or a
+        failing probe can't take the daemon down.
+        """
+        try:
+            request = json.loads(line.decode('utf-8') or '{}')
+
+            if not isinstance(request, dict):
+                raise ValueError('Expected a JSON object')
+
+            dependencies = request.get('dependencies')
+
+            if dependencies is not None and not (
+                isinstance(dependencies, list)
+                and all(isinstance(path, str) for path in dependencies)
+            ):
+                raise ValueError('"dependencies" must be a list of paths')
+        except ValueError as e:
+            return {'error': str(e), 'status': 2}
+
+        try:
+            return self.query(request)
+        except Exception as e:
+            logger.exception('Unable to answer %r', request)
+            return {'error': str(e) or type(e).__name__, 'status': 2}
+
+    def _handle(self, connection, line):
+        # type: (typing.Any, bytes) -> None
+        start_time = time.monotonic()
+        response = self.respond(line)
+
+        try:
+            # The response fits in the socket buffer unless the client
+            # asked about a huge number of files and isn't reading
+            connection.settimeout(self.REQUEST_TIMEOUT)
+            connection.sendall(json.dumps(response).encode('utf-8') + b'\n')
+        except OSError as e:
+            logger.debug('Dropping connection: %s', e)
+
+        logger.debug('Answered in %.1f ms',
+                     (time.monotonic() - start_time) * 1000)
+
+    def serve(self):
+        # type: () -> int
+        import selectors
+        import signal
+        import socket
+
+        if os.path.exists(self.socket_path):
+            # Only take over the socket if nothing is listening on it
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                os.unlink(self.socket_path)
+            else:
+                logger.error('Another steamdeps daemon is listening on %s',
+                             self.socket_path)
+                return 2
+            finally:
+                probe.close()
 
-    for var in PASS_THROUGH_ENV_VARS:
-        if var in os.environ:
-            argv.append('--setenv={}={}'.format(var, os.environ[var]))
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(16)
 
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ, 'connection')
 
-###
-def update_packages(packages, install_confirmation=True):
-    """
-    Function to install or update package dependencies, expected to be executed
-    in an interactive terminal.
-    Ideally we would call some sort of system UI that users were familiar with
-    to do this, but nothing that exists yet does what we need.
-    """
+        if self._watcher is not None:
+            selector.register(self._watcher.fd, selectors.EVENT_READ,
+                              'inotify')
 
-    if install_confirmation:
-        print('\nSteam needs to install these additional packages:')
-        print(*packages)
-        input('\nPress return to proceed with the installation: ')
-    else:
-        logger.debug('Will install packages: %s', ' '.join(packages))
+        # Load everything we know we'll be asked about
+        if self.paths:
+            response = self.respond(b'')
 
-    if not is_root():
-        # We don't have root privileges, call again this script with pkexec
-        logger.debug('Re-running steamdeps as root...')
-        argv = [
-            'pkexec',
-            os.path.abspath(__file__),
-            '--interactive',
-            # We already showed the confirmation once, no need to repeat it
-            '--no-install-confirmation',
-            '--install',
-            ' '.join(packages)
-        ]
-        pass_through_environ(argv)
-        cp = run_subprocess(argv, universal_newlines=True)
-        return cp.returncode
+            if 'error' in response:
+                logger.warning('%s', response['error'])
 
-    if not enable_i386():
-        return 1
+        logger.info('Listening on %s', self.socket_path)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
 
-    update_apt()
+        # Connections still sending their request -> [what they sent so
+        # far, when they have to be done]. Requests are read as they come,
+        # so that a slow or silent client doesn't hold up the others.
+        pending = {}    # type: typing.Dict[typing.Any, typing.List[typing.Any]]
 
-    # Install the packages using the option "--no-remove" to avoid
-    # unexpected dependencies cycle that end up removing packages that are
-    # essential for the OS to run
-    logger.debug('Installing packages: %s...', ' '.join(packages))
-    cp = run_subprocess(
-        ['apt-get', 'install', '--no-remove'] + packages,
-        universal_newlines=True,
-    )
+        def close(connection):
+            # type: (typing.Any) -> None
+            selector.unregister(connection)
+            del pending[connection]
+            connection.close()
 
-    return cp.returncode
+        try:
+            while True:
+                for (key, _) in selector.select(
+                    self.REQUEST_TIMEOUT if pending else None
+                ):
+                    if key.data == 'inotify':
+                        self.invalidate(self._watcher.read())
+                    elif key.data == 'connection':
+                        (connection, _) = server.accept()
+                        connection.setblocking(False)
+                        pending[connection] = [
+                            b'', time.monotonic() + self.REQUEST_TIMEOUT,
+                        ]
+                        selector.register(connection, selectors.EVENT_READ,
+                                          'request')
+                    else:
+                        connection = key.fileobj
+                        state = pending[connection]
+
+                        try:
+                            data = connection.recv(4096)
+                        except BlockingIOError:
+                            continue
+                        except OSError as e:
+                            logger.debug('Dropping connection: %s', e)
+                            close(connection)
+                            continue
 
+                        state[0] += data
 
-###
-def check_config(path, config):
-    if "STEAM_RUNTIME" not in config:
-        sys.stderr.write(
-            "Missing STEAM_RUNTIME definition in %s\n" % path)
-        return False
+                        if data and b'\n' not in state[0]:
+                            if len(state[0]) > self.MAX_REQUEST_SIZE:
+                                logger.debug('Dropping oversized request')
+                                close(connection)
 
-    if config["STEAM_RUNTIME"] not in SUPPORTED_STEAM_RUNTIME:
-        sys.stderr.write(
-            "Unsupported Steam runtime: %s\n" % config["STEAM_RUNTIME"])
-        return False
+                            continue
 
-    if "STEAM_DEPENDENCY_VERSION" not in config:
-        sys.stderr.write(
-            "Missing STEAM_DEPENDENCY_VERSION definition in %s\n" % path)
-        return False
+                        selector.unregister(connection)
+                        del pending[connection]
 
-    if config["STEAM_DEPENDENCY_VERSION"]\
-            not in SUPPORTED_STEAM_DEPENDENCY_VERSION:
-        sys.stderr.write("Unsupported dependency version: %s\n" % config[
-            "STEAM_DEPENDENCY_VERSION"])
-        return False
+                        with connection:
+                            self._handle(connection,
+                                         state[0].split(b'\n', 1)[0])
 
-    # Make sure we can use dpkg on this system.
-    try:
-        subprocess.call(['dpkg', '--version'], stdout=subprocess.PIPE)
-    except FileNotFoundError:
-        sys.stderr.write("Couldn't find dpkg, please update steamdeps for "
-                         "your distribution.\n")
-        return False
+                now = time.monotonic()
 
-    return True
+                for (connection, state) in list(pending.items()):
+                    if state[1] <= now:
+                        logger.debug('Dropping idle connection')
+                        close(connection)
+        except KeyboardInterrupt:
+            return 0
+        finally:
+            for connection in pending:
+                connection.close()
 
+            selector.close()
+            server.close()
+            os.unlink(self.socket_path)
 
-def update_installed_packages(packages):
-    # Get the installed package versions
-    # Make sure COLUMNS isn't set, or dpkg will truncate its output
-    if "COLUMNS" in os.environ:
-        del os.environ["COLUMNS"]
-
-    process = subprocess.Popen(['dpkg', '-l'] + list(packages.keys()),
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    # The regex first group is the package name, the second group is the
-    # version and the third is the architecture
-    installed_pattern = re.compile(r"^\Si\s+([^\s]+)\s+([^\s]+)\s+([^\s]+)")
-    for line in process.stdout:
-        line = line.decode("utf-8").strip()
-        match = re.match(installed_pattern, line)
-        if match is None:
-            continue
+            if self._watcher is not None:
+                self._watcher.close()
 
-        name = match.group(1)
-        if name not in packages:
-            name = name + ":" + match.group(3)
-        packages[name].set_installed(match.group(2))
 
+def query_daemon(
+    socket_path,    # type: str
+    paths,          # type: typing.List[str]
+):
+    # type: (...) -> typing.Optional[typing.Dict[str, typing.Any]]
+    """
+    Ask a steamdeps daemon about paths. Return None if there is no daemon
+    listening on socket_path.
+    """
+    import socket
+
+    request = {'dependencies': [os.path.abspath(path) for path in paths]}
 
-###
-def main():
-    logging.basicConfig()
-    logging.getLogger().setLevel(logging.INFO)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+
+            with client.makefile('rwb') as stream:
+                stream.write(json.dumps(request).encode('utf-8') + b'\n')
+                stream.flush()
+                return json.loads(stream.readline().decode('utf-8'))
+    except (OSError, ValueError) as e:
+        logger.debug('Unable to query the daemon on %s: %s', socket_path, e)
+        return None
 
-    config = {}
-    os_release = OsRelease()
-    missing_packages = []    # type: typing.List[str]
 
+###
+def build_argument_parser():
+    # type: () -> argparse.ArgumentParser
     parser = argparse.ArgumentParser(description='Install Steam dependencies')
     parser.add_argument(
         '--dry-run',
         action='store_true',
         help="Don't install anything, just report",
     )
+    parser.add_argument(
+        '--backend',
+        choices=('apt', 'lowmem'),
+        help="How to look up packages: 'apt' loads the whole python-apt "
+        "cache, 'lowmem' only reads the records it needs from an index "
+        "of the dpkg database and apt lists, keeping the peak memory use "
+        "below %d MiB (default: $STEAMDEPS_BACKEND or apt)"
+        % LOW_MEMORY_CEILING_MIB,
+    )
+    parser.add_argument(
+        '--install-mode',
+        choices=('sequential', 'pipelined'),
+        help="With 'pipelined', packages that the apt lists already know "
+        "about are downloaded while the lists are refreshed, before "
+        "installing (default: $STEAMDEPS_INSTALL_MODE or sequential)",
+    )
+    parser.add_argument(
+        '--progress',
+        choices=('text', 'json'),
+        help="How to report the progress of refreshing apt lists and "
+        "downloading packages: a status line, or one JSON object per line "
+        "with the items, bytes, rate and time left "
+        "(default: $STEAMDEPS_PROGRESS or text)",
+    )
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help="Keep running, and answer whether the dependencies are "
+        "satisfied over a Unix socket",
+    )
     parser.add_argument(
         '--debug-dump-os-release',
         action='store_true',
         help=argparse.SUPPRESS,
     )
+    parser.add_argument(
+        '--debug-check-version-comparison',
+        action='store_true',
+        help=argparse.SUPPRESS,
+    )
     parser.add_argument(
         '--interactive',
         action='store_true',
@@ -725,6 +3912,12 @@ def main():
         '--install',
         help="Whitespace separated list of packages to install",
     )
+    parser.add_argument(
+        '--invalidate-cache',
+        action='store_true',
+        help="Forget the verdicts of previous runs and evaluate the "
+        "dependencies again",
+    )
     parser.add_argument(
         '--no-install-confirmation',
         dest='install_confirmation',
@@ -732,11 +3925,43 @@ def main():
         help="Do not ask the user for a confirmation before attempting to "
         "install the dependencies",
     )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help="Print the wall time, subprocesses and growth of the peak "
+        "memory use of each phase on stderr",
+    )
+    parser.add_argument(
+        '--query',
+        action='store_true',
+        help="Ask a running --daemon instead of evaluating the dependencies, "
+        "and report like --dry-run",
+    )
+    parser.add_argument(
+        '--report',
+        choices=('json',),
+        help="Write the wall time, subprocesses and growth of the peak "
+        "memory use of each phase to --report-file",
+    )
+    parser.add_argument(
+        '--report-file',
+        help="Where to write --report, or - for stdout (default: "
+        "$XDG_CACHE_HOME/steamdeps/" + PROFILE_REPORT_FILE + ")",
+    )
     parser.add_argument(
         '--setenv',
         action='append',
         help=argparse.SUPPRESS,
     )
+    parser.add_argument(
+        '--socket',
+        help="Unix socket for --daemon and --query (default: "
+        "$XDG_RUNTIME_DIR/" + DAEMON_SOCKET_NAME + ")",
+    )
+    parser.add_argument(
+        '--state-file',
+        help=argparse.SUPPRESS,
+    )
     parser.add_argument(
         '--update-apt',
         action='store_true',
@@ -747,12 +3972,117 @@ def main():
     parser.add_argument(
         'dependencies',
         metavar='$HOME/.steam/root/steamdeps.txt',
-        nargs='?',
-        help='Path to steamdeps.txt',
+        nargs='*',
+        help=(
+            'Path to steamdeps.txt. If more than one file, or a directory '
+            'of *.txt files, is given, they are evaluated together and '
+            'installed at once'
+        ),
     )
     parser.set_defaults(install_confirmation=True)
+    return parser
+
+
+def expand_dependencies_paths(paths):
+    # type: (typing.List[str]) -> typing.List[str]
+    """
+    Replace directories in paths with the *.txt files they contain
+    """
+    expanded = []   # type: typing.List[str]
+
+    for path in paths:
+        if os.path.isdir(path):
+            found = sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.endswith('.txt') and not name.startswith('.')
+            )
+
+            if not found:
+                raise OSError('No dependencies files in %s' % path)
+
+            expanded.extend(found)
+        elif path not in expanded:
+            expanded.append(path)
+
+    return expanded
+
+
+def print_profile(report):
+    # type: (typing.Dict[str, typing.Any]) -> None
+    sys.stderr.write('%-44s %-20s %10s %5s %9s\n'
+                     % ('phase', 'thread', 'wall ms', 'procs', 'RSS +MiB'))
+
+    for phase in report['phases']:
+        sys.stderr.write('%-44s %-20s %10.1f %5d %9.1f\n' % (
+            '  ' * phase['depth'] + phase['name'],
+            phase['thread'][:20],
+            phase['wall_ms'],
+            sum(phase['subprocesses'].values()),
+            phase['peak_rss_growth_kib'] / 1024,
+        ))
+
+    sys.stderr.write('Total: %.1f ms, %d subprocesses (%s), peak RSS '
+                     '%.1f MiB, largest child %.1f MiB\n' % (
+                         report['wall_ms'],
+                         sum(report['subprocesses'].values()),
+                         ', '.join('%s: %d' % item for item in
+                                   sorted(report['subprocesses'].items())),
+                         report['peak_rss_kib'] / 1024,
+                         report['children_peak_rss_kib'] / 1024,
+                     ))
+
+
+def write_profile_report(args, status):
+    # type: (typing.Any, typing.Any) -> None
+    assert _profiler is not None
+    report = _profiler.report(sys.argv, status)
+
+    if args.profile:
+        print_profile(report)
+
+    if args.report == 'json':
+        # This runs on the way out: failing to write the report must not
+        # replace the exit status of the run
+        try:
+            if args.report_file == '-':
+                json.dump(report, sys.stdout, indent=2)
+                sys.stdout.write('\n')
+            elif args.report_file:
+                with open(args.report_file, 'w',
+                          encoding='utf-8') as writer:
+                    json.dump(report, writer, indent=2)
+            else:
+                store_cache_file(PROFILE_REPORT_FILE, report)
+        except OSError as e:
+            logger.error('Unable to write the profile report: %s', e)
+
+
+def main():
+    global _profiler
+
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = build_argument_parser()
     args = parser.parse_args()
 
+    if not args.profile and not args.report:
+        return run(parser, args)
+
+    _profiler = Profiler()
+    status = None
+
+    try:
+        with profile_phase('main'):
+            status = run(parser, args)
+
+        return status
+    finally:
+        write_profile_report(args, status)
+
+
+def run(parser, args):
+    # type: (argparse.ArgumentParser, typing.Any) -> int
     if args.setenv:
         for pair in args.setenv:
             if '=' not in pair:
@@ -762,6 +4092,51 @@ def main():
             var, val = pair.split('=', 1)
             os.environ[var] = val
 
+    # Re-executed children inherit these, or get them through --setenv
+    if args.backend:
+        os.environ['STEAMDEPS_BACKEND'] = args.backend
+
+    if args.install_mode:
+        os.environ['STEAMDEPS_INSTALL_MODE'] = args.install_mode
+
+    if args.progress:
+        os.environ['STEAMDEPS_PROGRESS'] = args.progress
+
+    if args.install and (args.daemon or args.query):
+        parser.print_usage(sys.stderr)
+        sys.stderr.write(
+            "--install cannot be used with --daemon or --query\n"
+        )
+        return 2
+    elif args.daemon:
+        if 'STEAM_LAUNCHER_VERBOSE' in os.environ:
+            logging.getLogger().setLevel(logging.DEBUG)
+
+        daemon = SteamdepsDaemon(
+            args.socket or get_daemon_socket_path(), args.dependencies,
+        )
+        return daemon.serve()
+    elif args.query:
+        response = query_daemon(
+            args.socket or get_daemon_socket_path(), args.dependencies,
+        )
+
+        if response is not None:
+            if 'error' in response:
+                sys.stderr.write("%s\n" % response['error'])
+                return response.get('status', 2)
+
+            if response['apt_out_of_sync']:
+                print('The packages cache seems to be out of date')
+
+            args.dry_run = True
+            return act_on_verdicts(
+                args, response['dependencies'], response['verdicts'],
+            )
+
+        # Without a daemon, do what it would have done
+        args.dry_run = True
+
     if args.install and args.dependencies:
         parser.print_usage(sys.stderr)
         sys.stderr.write(
@@ -781,9 +4156,20 @@ def main():
     logger.debug('Run as: %s', ' '.join([quote(a) for a in sys.argv]))
 
     if args.debug_dump_os_release:
-        os_release.dump()
+        OsRelease().dump()
         return 0
 
+    if args.debug_check_version_comparison:
+        return check_version_comparison()
+
+    install_packages = None     # type: typing.Optional[typing.List[str]]
+
+    if args.install:
+        install_packages = sorted(filter(None, args.install.split(' ')))
+
+    if args.state_file:
+        load_handoff_state(args.state_file, install_packages)
+
     if args.install:
         if args.dry_run:
             logger.debug('Not actually installing %r', args.install)
@@ -805,18 +4191,85 @@ def main():
                 'Re-running steamdeps in a terminal to install %r...',
                 args.install,
             )
-            cp = run_subprocess(
-                argv,
-                universal_newlines=True,
-            )
+            cp = run_with_handoff_state(argv, to_install=install_packages)
             return cp.returncode
 
-        packages = sorted(filter(None, args.install.split(' ')))
-        return update_packages(packages, args.install_confirmation)
+        return update_packages(install_packages, args.install_confirmation)
+
+    try:
+        args.dependencies = expand_dependencies_paths(args.dependencies)
+    except OSError as e:
+        sys.stderr.write("Couldn't open file: %s\n" % e)
+        return 2
+
+    if args.invalidate_cache:
+        invalidate_verdict_cache()
+    elif not args.update_apt:
+        with profile_phase('load cached verdicts'):
+            verdicts = load_cached_verdicts(args.dependencies)
+
+        if verdicts is not None:
+            logger.debug('Nothing changed since the last run, reusing its '
+                         'verdict')
+            return act_on_verdicts(args, args.dependencies, verdicts)
+
+    probes = ProbeScheduler()
+
+    try:
+        return evaluate_and_install(args, probes)
+    finally:
+        probes.shutdown()
+
+
+def start_host_probes(probes):
+    # type: (ProbeScheduler) -> None
+    # Steam only runs on amd64, so that is the least wrong guess
+    probes.start('arch', get_arch,
+                 timeout=PROBE_TIMEOUT, default='amd64')
+    probes.start('foreign_architectures', get_foreign_architectures,
+                 timeout=PROBE_TIMEOUT, default=[])
+    probes.start('os_release', OsRelease,
+                 timeout=PROBE_TIMEOUT, default=OsRelease({}))
+
+
+def start_package_probes(probes):
+    # type: (ProbeScheduler) -> None
+    probes.start('nvidia_packages', expected_nvidia_packages,
+                 timeout=PROBE_TIMEOUT, default={})
+    probes.start('xdg_portal_backend', choose_xdg_portal_backend,
+                 timeout=PROBE_TIMEOUT, default=None)
+    probes.start('glvnd', is_glvnd,
+                 timeout=PROBE_TIMEOUT, default=False)
+
+    if not is_low_memory_backend():
+        # Only opens the cache ahead of time: nothing waits for this
+        # probe's result, the cache is used through get_apt_session()
+        probes.start('apt_cache', lambda: get_apt_session().cache,
+                     timeout=PROBE_TIMEOUT, default=None)
+
+
+def evaluate_and_install(args, probes):
+    # type: (typing.Any, ProbeScheduler) -> int
+    """
+    Probe the system, evaluate the dependencies and install what is
+    missing, starting the independent probes in the background
+    """
+    for (name, value) in _handoff_probes.items():
+        probes.provide(name, value)
+
+    start_host_probes(probes)
+
+    if not args.dry_run and not args.update_apt:
+        probes.start('apt_out_of_sync', is_apt_out_of_sync,
+                     timeout=PROBE_TIMEOUT, default=False)
 
     if args.dry_run:
         logger.debug('Dry-run mode, avoiding side-effects')
-    elif args.update_apt or is_apt_out_of_sync() or needs_i386():
+    elif (
+        args.update_apt
+        or probes.result('apt_out_of_sync')
+        or needs_i386()
+    ):
         if not args.interactive:
             logger.debug(
                 'Re-running steamdeps in an interactive terminal to '
@@ -828,8 +4281,8 @@ def main():
                 '--update-apt',
             ]
             pass_through_environ(argv)
-            argv.append(os.path.abspath(args.dependencies))
-            cp = run_subprocess(argv, universal_newlines=True)
+            argv.extend(os.path.abspath(p) for p in args.dependencies)
+            cp = run_with_handoff_state(argv, probes)
             return cp.returncode
         elif not is_root():
             # We don't have root privileges, call again this script with pkexec
@@ -847,68 +4300,98 @@ def main():
                 '--update-apt',
             ]
             pass_through_environ(argv)
-            argv.append(os.path.abspath(args.dependencies))
-            cp = run_subprocess(argv, universal_newlines=True)
+            argv.extend(os.path.abspath(p) for p in args.dependencies)
+            cp = run_with_handoff_state(argv, probes)
 
             return cp.returncode
 
+        # Don't let the probe overwrite what enable_i386() changes
+        probes.result('foreign_architectures')
+
         if not enable_i386():
             return 1
 
-        update_apt()
+        probes.provide('foreign_architectures', get_foreign_architectures())
 
-    # Make sure we can open the file
+        # If we know that only the Steam repository is out of sync,
+        # there's no need to refresh the others
+        update_apt(
+            only_steam=(
+                'apt_out_of_sync' in probes
+                and probes.result('apt_out_of_sync')
+            ),
+        )
+
+    # These depend on the lists of available packages, so they can only
+    # start after apt was updated. They run while we parse the file.
+    start_package_probes(probes)
+
+    verdicts = []
+
+    # All the files are evaluated against the same snapshot of the system
+    for path in args.dependencies:
+        with profile_phase('evaluate ' + os.path.basename(path)):
+            (code, verdict) = evaluate_dependencies(path, probes)
+
+        if verdict is None:
+            return code
+
+        verdicts.append(verdict)
+
+    if not args.dry_run:
+        store_verdicts(list(zip(args.dependencies, verdicts)))
+
+    return act_on_verdicts(args, args.dependencies, verdicts)
+
+
+def evaluate_dependencies(
+    path,           # type: str
+    probes,         # type: ProbeScheduler
+    loaded=None,    # type: typing.Optional[typing.Tuple[dict, list]]
+):
+    # type: (...) -> typing.Tuple[int, typing.Optional[dict]]
+    """
+    Evaluate the dependencies listed in path, or the result of
+    load_dependencies(path) if already loaded. Return (0, verdict), or
+    an exit status and None if the file is not usable.
+    """
+    missing_packages = []    # type: typing.List[str]
+
+    # Make sure we can read the file
     try:
-        fp = open(args.dependencies)
+        config, rows = loaded or load_dependencies(path)
     except Exception as e:
         sys.stderr.write("Couldn't open file: %s\n" % e)
-        return 2
-
-    # Look for configuration variables
-    config_pattern = re.compile(r"(\w+)\s*=\s*(\w+)")
-    for line in fp:
-        line = line.strip()
-        if line == "" or line[0] == '#':
-            continue
-
-        match = re.match(config_pattern, line)
-        if match is not None:
-            config[match.group(1)] = match.group(2)
+        return (2, None)
 
     # Check to make sure we have a valid config
-    if not check_config(args.dependencies, config):
-        return 3
-
-    # Seek back to the beginning of the file
-    fp.seek(0)
+    if not check_config(path, config):
+        return (3, None)
 
     # Load the package dependency information
+    remap_table = get_remap_table()
+    arch = probes.result('arch')
     packages = {}
     dependencies = []
-    for line in fp:
-        line = line.strip()
-        if line == "" or line[0] == '#':
-            continue
-
-        match = re.match(config_pattern, line)
-        if match is not None:
-            continue
-
+    for alternatives in rows:
         row = []
-        for section in line.split("|"):
-            package = create_package(section)
-            if package is None:
+        for split in alternatives:
+            parsed = resolve_dependency(split, arch, remap_table)
+            if parsed is None:
                 continue
 
+            package = Package(*parsed)
             packages[package.name] = package
             row.append(package)
 
         dependencies.append(row)
 
     ensure_installed_packages = set()       # type: typing.Set[str]
-    archs = [get_arch()]
+    archs = [probes.result('arch')]
 
-    if archs[0] == 'amd64' and 'i386' in get_foreign_architectures():
+    if archs[0] == 'amd64' and 'i386' in probes.result(
+        'foreign_architectures'
+    ):
         archs.append('i386')
 
     for arch in archs:
@@ -919,7 +4402,7 @@ def main():
                 'libgl1-mesa-dri',
                 'libgl1-mesa-glx',
         ):
-            package = create_package(synthetic + ':' + arch)
+            package = create_package(synthetic + ':' + arch, remap_table)
 
             if package is not None:
                 if package.name not in packages:
@@ -935,7 +4418,7 @@ def main():
         'steam-libs-amd64:amd64',
         'steam-libs-i386:i386',
         'xdg-desktop-portal',
-        choose_xdg_portal_backend() or 'xdg-desktop-portal-gtk',
+        probes.result('xdg_portal_backend') or 'xdg-desktop-portal-gtk',
     ):
         if additional_pkg not in packages:
             if is_package_available(additional_pkg):
@@ -948,6 +4431,8 @@ def main():
     # The Steam container runtime (pressure-vessel) requires a setuid
     # bubblewrap executable on some kernel configurations. Steam is
     # unprivileged, so we have to get it from the host OS.
+    os_release = probes.result('os_release')
+
     if (
         # Debian's kernel doesn't allow unprivileged users to create
         # new namespaces (https://bugs.debian.org/898446) so we need the
@@ -962,7 +4447,7 @@ def main():
         packages[package.name] = package
         dependencies.append([package])
 
-    nvidia_packages = expected_nvidia_packages()
+    nvidia_packages = probes.result('nvidia_packages')
     for pkg_name in nvidia_packages:
         if pkg_name not in packages:
             if is_package_available(pkg_name):
@@ -971,14 +4456,6 @@ def main():
             else:
                 missing_packages.append(pkg_name)
 
-    if missing_packages:
-        print("These packages are not available:\n")
-
-        for p in sorted(missing_packages):
-            print("- %s" % p)
-
-        print("\nThe Steam client may have limited functionality.")
-
     # Print package dependency information for debug
     if logger.isEnabledFor(logging.DEBUG):
         for row in dependencies:
@@ -993,75 +4470,34 @@ def main():
     update_installed_packages(packages)
 
     # See which ones need to be installed
-    needed = set()
-    for row in dependencies:
-        if len(row) == 0:
-            continue
-
-        satisfied = False
-        for dep in row:
-            if dep.is_available():
-                satisfied = True
-                break
-        if not satisfied:
-            needed.add(row[0])
-
-    # If we have anything to install, do it!
-    if len(needed) > 0:
-        for package in sorted(needed, key=lambda x: x.name):
-            if package.installed:
-                print("Package %s is installed with version '%s' but doesn't "
-                      "match requirements: %s" % (
-                        package.name, package.installed, package),
-                      file=sys.stderr)
-            else:
-                print("Package %s needs to be installed" % package.name,
-                      file=sys.stderr)
-
-        # If we are going to install additional packages, we also add the
-        # ones listed in "ensure_installed_packages". If they were already
-        # installed, this forces apt to keep them into consideration when
-        # it evaluates the new packages dependencies.
-        to_install = set([package.name for package in needed])
-        to_install.update(ensure_installed_packages)
-
-        if args.dry_run:
-            print(
-                'Would run: apt-get install --no-remove {}'.format(
-                    ' '.join(sorted(to_install))
-                )
-            )
-            return 1
-        else:
-            if args.interactive:
-                pkgs_names = sorted(to_install)
-                return update_packages(pkgs_names, args.install_confirmation)
+    needed, reasons = resolve_install_set(
+        dependencies, ensure_installed_packages, get_available_index(),
+    )
 
-            logger.debug(
-                'Re-running steamdeps in a terminal to install selected '
-                'packages',
-            )
-            argv = get_terminal_wait('Package Install') + [
-                os.path.abspath(__file__),
-                '--interactive',
-            ]
-            pass_through_environ(argv)
+    for reason in reasons:
+        logger.debug('%s', reason)
 
-            if not args.install_confirmation:
-                argv.append('--no-install-confirmation')
+    # If we are going to install additional packages, we also add the
+    # ones listed in "ensure_installed_packages". If they were already
+    # installed, this forces apt to keep them into consideration when
+    # it evaluates the new packages dependencies.
+    to_install = set()      # type: typing.Set[str]
 
-            argv.extend([
-                '--install',
-                ' '.join(sorted(to_install)),
-            ])
+    if needed:
+        to_install.update(package.name for package in needed)
+        to_install.update(ensure_installed_packages)
 
-            cp = run_subprocess(
-                argv,
-                universal_newlines=True,
-            )
-            return cp.returncode
-    else:
-        return 0
+    verdict = {
+        'missing': sorted(missing_packages),
+        'needed': [
+            [package.name, package.installed, str(package)]
+            for package in sorted(needed, key=lambda x: x.name)
+        ],
+        'to_install': sorted(to_install),
+        'reasons': reasons,
+    }
+
+    return (0, verdict)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,900 @@
+#!/usr/bin/env python3
+"""
+    Benchmarks for steamdeps.py.
+
+    The startup benchmark measures, in a fresh interpreter for every
+    sample, how long importing steamdeps and parsing the command line take
+    for each entry mode, and which python-apt modules got imported on the
+    way. It fails if a mode exceeds its time budget or imports python-apt
+    when it has no reason to, so that import-time regressions are caught.
+
+    The parse benchmark measures parsing a synthetic dependencies file
+    with a fixed remapping table, without asking the host anything.
+
+    The hermetic benchmark runs steamdeps.py --dry-run end to end in a
+    generated system root with stand-in dpkg, apt-cache, apt-get and
+    pkexec executables and stand-in apt and aptsources modules, for
+    dependency files and dpkg databases of increasing size.
+    It reports latency, subprocesses and peak memory for each scenario,
+    from cold and warm caches, and can compare them with a saved run.
+
+    The memory benchmark runs the largest hermetic scenario with the
+    low-memory backend, with an additional apt list of realistic stanzas
+    as large as those of real distributions. It fails if the peak RSS
+    exceeds the ceiling that steamdeps.py documents, from cold caches,
+    warm caches, and when the index of packages is rebuilt after the
+    lists changed.
+
+    Usage: steamdeps_bench.py startup [--samples N] [--budget-ms MS]
+           steamdeps_bench.py parse [--rows N] [--samples N] [--budget-ms MS]
+           steamdeps_bench.py hermetic [--rows N,...] [--installed N,...]
+                                       [--samples N] [--backend B]
+                                       [--output FILE] [--baseline FILE]
+           steamdeps_bench.py memory [--rows N] [--installed N]
+                                     [--list-mib MIB] [--ceiling-mib MIB]
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import typing
+except ImportError:
+    pass
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that the entry modes below must not import
+PYTHON_APT_MODULES = ('apt', 'apt_pkg', 'aptsources')
+
+# (name, argv, whether main() can safely run to completion)
+STARTUP_MODES = (
+    ('usage-error', [], True),
+    ('conflicting-arguments', ['--install', 'foo', 'steamdeps.txt'], True),
+    ('debug-dump-os-release', ['--debug-dump-os-release'], True),
+    ('install-dry-run', ['--install', 'foo bar', '--dry-run'], True),
+    ('install', ['--install', 'foo bar'], False),
+    ('install-interactive',
+     ['--interactive', '--no-install-confirmation', '--install', 'foo'],
+     False),
+    ('dry-run', ['--dry-run', 'steamdeps.txt'], False),
+    ('evaluate', ['steamdeps.txt'], False),
+)
+
+# Runs in the child interpreter: time the import of steamdeps and the
+# argument parsing, optionally run main(), then report as JSON
+STARTUP_PROBE = r'''
+import sys, time
+here, argv, run_main, watched = sys.argv[1:]
+start = time.perf_counter()
+sys.path.insert(0, here)
+import steamdeps
+imported = time.perf_counter()
+import json
+argv = json.loads(argv)
+steamdeps.build_argument_parser().parse_args(argv)
+parsed = time.perf_counter()
+if run_main == '1':
+    import contextlib, io
+    sys.argv = ['steamdeps'] + argv
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        steamdeps.main()
+finished = time.perf_counter()
+print(json.dumps({
+    'import': imported - start,
+    'argparse': parsed - imported,
+    'main': finished - parsed,
+    'modules': [m for m in json.loads(watched) if m in sys.modules],
+}))
+'''
+
+
+def run_startup_sample(
+    argv,       # type: typing.List[str]
+    run_main,   # type: bool
+):
+    # type: (...) -> typing.Dict[str, typing.Any]
+    output = subprocess.check_output(
+        [
+            sys.executable, '-c', STARTUP_PROBE,
+            HERE,
+            json.dumps(argv),
+            '1' if run_main else '0',
+            json.dumps(PYTHON_APT_MODULES),
+        ],
+        universal_newlines=True,
+    )
+    return json.loads(output.splitlines()[-1])
+
+
+def benchmark_startup(args):
+    # type: (typing.Any) -> int
+    failures = 0
+
+    print('%-24s %10s %10s %10s  %s'
+          % ('mode', 'import ms', 'parse ms', 'main ms', 'python-apt'))
+
+    for (name, argv, run_main) in STARTUP_MODES:
+        samples = [
+            run_startup_sample(argv, run_main)
+            for _ in range(args.samples)
+        ]
+        import_ms = statistics.median(s['import'] for s in samples) * 1000
+        parse_ms = statistics.median(s['argparse'] for s in samples) * 1000
+        main_ms = statistics.median(s['main'] for s in samples) * 1000
+        modules = sorted(set(m for s in samples for m in s['modules']))
+
+        print('%-24s %10.2f %10.2f %10.2f  %s'
+              % (name, import_ms, parse_ms, main_ms,
+                 ', '.join(modules) or '-'))
+
+        if modules:
+            failures += 1
+            print('  FAIL: %s imported %s' % (name, ', '.join(modules)),
+                  file=sys.stderr)
+
+        if import_ms + parse_ms > args.budget_ms:
+            failures += 1
+            print('  FAIL: %s took %.2f ms, budget is %.2f ms'
+                  % (name, import_ms + parse_ms, args.budget_ms),
+                  file=sys.stderr)
+
+    if failures:
+        return 1
+
+    return 0
+
+
+# Alternatives that the synthetic dependencies file is made of
+PARSE_ALTERNATIVES = (
+    'libc6:i386 (>= 2.15)',
+    'libgl1-mesa-glx:i386',
+    'libegl1:amd64 (>= 1.0) (<< 2.0)',
+    'libgbm1 [amd64]',
+    'libudev0 [!amd64]',
+    'python-apt',
+    'zenity',
+    'xdg-desktop-portal-gtk (>= 1.14)',
+)
+
+
+def make_dependencies(rows, seed=0):
+    # type: (int, int) -> typing.List[str]
+    rng = random.Random(seed)
+    lines = []
+
+    for i in range(rows):
+        alternatives = rng.sample(PARSE_ALTERNATIVES, rng.randint(1, 3))
+        alternatives[0] = 'pkg%d:i386 (>= %d.0)' % (i, i % 7)
+        lines.append(' | '.join(alternatives))
+
+    return lines
+
+
+def benchmark_parse(args):
+    # type: (typing.Any) -> int
+    sys.path.insert(0, HERE)
+    import steamdeps
+
+    class FixedRemapTable(steamdeps.RemapTable):
+        def portal_backend(self, name):
+            return name
+
+    lines = make_dependencies(args.rows)
+    failures = 0
+
+    print('%-24s %10s %12s' % ('remapping', 'median ms', 'rows/s'))
+
+    for (name, table) in (
+        ('plain', FixedRemapTable()),
+        ('glvnd', FixedRemapTable(glvnd=True)),
+        ('lts', FixedRemapTable(lts='xenial', glvnd=True)),
+    ):
+        durations = []
+
+        for _ in range(args.samples):
+            start = time.perf_counter()
+
+            for (kind, alternatives, _) in steamdeps.iter_dependencies(lines):
+                for split in alternatives:
+                    steamdeps.resolve_dependency(split, 'amd64', table)
+
+            durations.append(time.perf_counter() - start)
+
+        median_ms = statistics.median(durations) * 1000
+        print('%-24s %10.2f %12.0f'
+              % (name, median_ms, args.rows / (median_ms / 1000)))
+
+        if median_ms > args.budget_ms:
+            failures += 1
+            print('  FAIL: %s took %.2f ms, budget is %.2f ms'
+                  % (name, median_ms, args.budget_ms), file=sys.stderr)
+
+    if failures:
+        return 1
+
+    return 0
+
+
+# Stand-in executables for the hermetic benchmark
+HERMETIC_EXECUTABLES = {
+    'dpkg': r'''#!/bin/sh
+case "$1" in
+    (--print-architecture)
+        head -n 1 "$STEAMDEPS_BENCH_SYSROOT/var/lib/dpkg/arch"
+        ;;
+    (--print-foreign-architectures)
+        tail -n +2 "$STEAMDEPS_BENCH_SYSROOT/var/lib/dpkg/arch"
+        ;;
+    (--version)
+        echo "dpkg stand-in for steamdeps_bench.py"
+        ;;
+    (--add-architecture)
+        ;;
+    (*)
+        echo "dpkg stand-in: unsupported: $*" >&2
+        exit 2
+        ;;
+esac
+''',
+    # Available packages come from the index of the generated lists, so
+    # apt-cache only has to exist
+    'apt-cache': r'''#!/bin/sh
+exit 0
+''',
+    'apt-get': r'''#!/bin/sh
+echo "apt-get stand-in: $*"
+''',
+    'pkexec': r'''#!/bin/sh
+exec "$@"
+''',
+}
+
+# Stand-in Python modules for the hermetic benchmark
+HERMETIC_MODULES = {
+    'apt/__init__.py': r'''
+# Stand-in for python-apt, reading the generated dpkg status database
+import os
+
+
+class _Version:
+    def __init__(self, provides):
+        self.provides_list = [(p, '', self) for p in provides]
+
+
+class _RawPackage:
+    has_versions = True
+
+    def __init__(self, name, architecture, provides):
+        self.name = name
+        self.architecture = architecture
+        self.current_ver = _Version(provides)
+
+
+class _RawCache:
+    def __init__(self, packages):
+        self.packages = packages
+        self.by_name = {p.name: p for p in packages}
+
+    def __getitem__(self, name):
+        # Purely virtual packages are unknown, as if they had no versions
+        return self.by_name[name.split(':')[0]]
+
+
+class _DepCache:
+    def get_candidate_ver(self, package):
+        return package.current_ver
+
+
+class _Package:
+    is_installed = True
+
+
+class Cache:
+    def __init__(self):
+        path = os.path.join(
+            os.environ['STEAMDEPS_BENCH_SYSROOT'], 'var/lib/dpkg/status')
+        packages = []
+
+        with open(path) as reader:
+            for stanza in reader.read().split('\n\n'):
+                fields = dict(
+                    line.split(': ', 1) for line in stanza.splitlines()
+                    if ': ' in line
+                )
+
+                if fields.get('Status', '').endswith(' installed'):
+                    packages.append(_RawPackage(
+                        fields['Package'],
+                        fields.get('Architecture', ''),
+                        [p.strip().split(' ')[0] for p in
+                         fields.get('Provides', '').split(',') if p.strip()],
+                    ))
+
+        self._cache = _RawCache(packages)
+        self._depcache = _DepCache()
+
+    def __contains__(self, name):
+        return name.split(':')[0] in self._cache.by_name
+
+    def __getitem__(self, name):
+        self._cache.by_name[name.split(':')[0]]
+        return _Package()
+''',
+    'aptsources/__init__.py': '',
+    'aptsources/sourceslist.py': r'''
+# Stand-in for python-apt's aptsources
+class SourceEntry:
+    def __init__(self, line, file=None):
+        self.line = line
+        self.file = file
+
+    def parse(self, line):
+        line = line.strip()
+        self.disabled = line.startswith('#')
+        words = line.lstrip('#').split()
+        self.uri = words[1] if len(words) > 1 else ''
+''',
+}
+
+# Only used if the real steam_launcher package can't be imported
+HERMETIC_STEAM_LAUNCHER = {
+    'steam_launcher/__init__.py': '',
+    'steam_launcher/launcherutils.py': r'''
+import subprocess
+
+
+def run_subprocess(args, **kwargs):
+    return subprocess.run(args, **kwargs)
+''',
+}
+
+# Runs steamdeps with the files it reads from the system looked up in the
+# generated root, given as the first argument, instead of /. Only the
+# benchmark does this: steamdeps itself can't be pointed at another root.
+HERMETIC_LAUNCHER = r'''
+import sys
+
+import steamdeps
+
+root = sys.argv.pop(1)
+
+for name in (
+    'APT_LISTS_DIR',
+    'APT_SOURCES_LIST',
+    'APT_SOURCES_PARTS',
+    'DPKG_ARCH_PATH',
+    'DPKG_STATUS_PATH',
+):
+    setattr(steamdeps, name, root + getattr(steamdeps, name))
+
+steamdeps.OS_RELEASE_PATHS = tuple(
+    root + path for path in steamdeps.OS_RELEASE_PATHS)
+sys.argv[0] = steamdeps.__file__
+sys.exit(steamdeps.main())
+'''
+
+HERMETIC_ROWS = (10, 100, 1000, 10000)
+HERMETIC_INSTALLED = (1000, 10000, 100000)
+
+# Size of the list of realistic stanzas added for the memory benchmark:
+# the main and universe lists of Ubuntu are 50 to 80 MB each
+MEMORY_LIST_MIB = 128
+
+# A stanza as apt downloads them, about 1.3 kB
+LARGE_LIST_STANZA = '''Package: big%(i)d
+Architecture: %(arch)s
+Version: 2.%(minor)d.%(i)d-1ubuntu1
+Priority: optional
+Section: universe/libs
+Source: big-source%(source)d
+Origin: Ubuntu
+Maintainer: Ubuntu Developers <ubuntu-devel-discuss@lists.ubuntu.com>
+Original-Maintainer: Debian Library Team <debian-libs@lists.debian.org>
+Bugs: https://bugs.launchpad.net/ubuntu/+filebug
+Installed-Size: %(size)d
+Provides: big-virtual%(source)d (= 2.%(minor)d.%(i)d-1ubuntu1)
+Depends: libc6 (>= 2.34), libgcc-s1 (>= 3.0), libstdc++6 (>= 12), \
+big%(dep)d (= 2.%(minor)d.%(i)d-1ubuntu1), zlib1g (>= 1:1.2.0)
+Breaks: big-old%(i)d (<< 2.0)
+Replaces: big-old%(i)d (<< 2.0)
+Filename: pool/universe/b/big-source%(source)d/big%(i)d_2.%(minor)d.%(i)d-1ubuntu1_%(arch)s.deb
+Size: %(size)d
+MD5sum: %(md5)s
+SHA1: %(sha1)s
+SHA256: %(sha256)s
+SHA512: %(sha512)s
+Homepage: https://big-source%(source)d.example.org/
+Description: synthetic library number %(i)d for steamdeps_bench.py
+ This package stands in for one of the tens of thousands of packages of
+ a real distribution, so that indexing the lists of available packages
+ reads as much data as it would on a real system. Its description is
+ about as long as a typical one, spread over a few lines like this, and
+ its checksums are as long as real ones.
+Task: big-desktop
+Description-md5: %(md5)s
+
+'''
+
+
+def write_files(root, files, mode=0o644):
+    # type: (str, typing.Dict[str, str], int) -> None
+    for (name, content) in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'w') as writer:
+            writer.write(content)
+
+        os.chmod(path, mode)
+
+
+def make_sysroot(root, installed):
+    # type: (str, int) -> None
+    """
+    Generate a dpkg database with installed packages, and apt lists with
+    those and as many more that are available but not installed
+    """
+    os.makedirs(os.path.join(root, 'var/lib/dpkg'))
+    os.makedirs(os.path.join(root, 'var/lib/apt/lists'))
+    os.makedirs(os.path.join(root, 'etc/apt/sources.list.d'))
+
+    write_files(root, {
+        'var/lib/dpkg/arch': 'amd64\ni386\n',
+        'etc/os-release': 'ID=debian\nVERSION_ID="12"\n',
+        'etc/apt/sources.list': 'deb http://deb.example/debian stable main\n',
+    })
+
+    status = os.path.join(root, 'var/lib/dpkg/status')
+    lists = os.path.join(
+        root, 'var/lib/apt/lists',
+        'deb.example_debian_dists_stable_main_binary-amd64_Packages')
+
+    with open(status, 'w') as status_writer, \
+            open(lists, 'w') as lists_writer:
+        for i in range(installed * 2):
+            stanza = (
+                'Package: pkg%d\n'
+                'Architecture: %s\n'
+                'Version: 1.%d-1\n'
+            ) % (i, ('amd64', 'i386', 'all')[i % 3], i % 10)
+
+            if i % 50 == 0:
+                stanza += 'Provides: virtual%d\n' % (i // 50)
+
+            lists_writer.write(stanza + '\n')
+
+            if i < installed:
+                status_writer.write(
+                    'Package: pkg%d\nStatus: install ok installed\n'
+                    % i + stanza.split('\n', 1)[1] + '\n')
+
+
+def make_hermetic_dependencies(path, rows, installed):
+    # type: (str, int, int) -> None
+    """
+    Generate rows that are satisfied, that need an upgrade, that need an
+    available package, and alternatives among those
+    """
+    rng = random.Random(rows)
+    lines = ['STEAM_RUNTIME=1', 'STEAM_DEPENDENCY_VERSION=1']
+
+    for i in range(rows):
+        kind = i % 4
+        n = rng.randrange(installed * 2)
+
+        if kind == 0:
+            lines.append('pkg%d' % rng.randrange(installed))
+        elif kind == 1:
+            lines.append('pkg%d (>= 1.%d)' % (n, rng.randrange(12)))
+        elif kind == 2:
+            lines.append('pkg%d | virtual%d' % (n, rng.randrange(installed)))
+        else:
+            lines.append('pkg%d [amd64] | pkg%d:i386 (<< 2)'
+                         % (n, rng.randrange(installed * 2)))
+
+    with open(path, 'w') as writer:
+        writer.write('\n'.join(lines) + '\n')
+
+
+def prepare_hermetic_workdir(workdir):
+    # type: (str) -> None
+    write_files(os.path.join(workdir, 'bin'), HERMETIC_EXECUTABLES, 0o755)
+    modules = dict(HERMETIC_MODULES)
+
+    try:
+        import steam_launcher.launcherutils     # noqa: F401
+    except ImportError:
+        modules.update(HERMETIC_STEAM_LAUNCHER)
+
+    write_files(os.path.join(workdir, 'python'), modules)
+
+
+def clear_hermetic_caches(workdir, dependencies):
+    # type: (str, str) -> None
+    shutil.rmtree(os.path.join(workdir, 'cache'), ignore_errors=True)
+    # The precompiled form of the dependencies is a cache too
+    precompiled = os.path.join(
+        workdir, '.' + os.path.basename(dependencies) + '.compiled.json')
+
+    if os.path.exists(precompiled):
+        os.unlink(precompiled)
+
+
+def run_hermetic_sample(
+    workdir,    # type: str
+    sysroot,    # type: str
+    dependencies,   # type: str
+    backend,    # type: str
+):
+    # type: (...) -> typing.Dict[str, typing.Any]
+    report = os.path.join(workdir, 'report.json')
+    cache = os.path.join(workdir, 'cache')
+    env = dict(os.environ)
+    env.pop('STEAM_LAUNCHER_VERBOSE', None)
+    env.update({
+        'PATH': os.path.join(workdir, 'bin') + os.pathsep + env['PATH'],
+        'PYTHONPATH': os.pathsep.join(
+            [os.path.join(workdir, 'python'), HERE]
+            + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p]
+        ),
+        # Read by the stand-in dpkg and apt
+        'STEAMDEPS_BENCH_SYSROOT': sysroot,
+        'XDG_CACHE_HOME': cache,
+        'XDG_RUNTIME_DIR': cache,
+        'XDG_CURRENT_DESKTOP': 'GNOME',
+    })
+    env.pop('DISPLAY', None)
+
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable, '-c', HERMETIC_LAUNCHER, sysroot,
+            '--dry-run', '--report=json', '--report-file', report,
+            '--backend', backend, dependencies,
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    wall = time.perf_counter() - start
+
+    with open(report) as reader:
+        data = json.load(reader)
+
+    return {
+        'wall_ms': wall * 1000,
+        'main_ms': data['wall_ms'],
+        'subprocesses': sum(data['subprocesses'].values()),
+        'peak_rss_mib': data['peak_rss_kib'] / 1024,
+        'apt_cache': any(p['name'] == 'apt.Cache' for p in data['phases']),
+    }
+
+
+def benchmark_hermetic(args):
+    # type: (typing.Any) -> int
+    workdir = tempfile.mkdtemp(prefix='steamdeps-bench-')
+    results = []    # type: typing.List[typing.Dict[str, typing.Any]]
+    baseline = {}   # type: typing.Dict[str, typing.Dict[str, typing.Any]]
+
+    if args.baseline:
+        with open(args.baseline) as reader:
+            for result in json.load(reader):
+                baseline[result['scenario']] = result
+
+    try:
+        prepare_hermetic_workdir(workdir)
+
+        print('%-22s %-5s %10s %10s %6s %8s  %s'
+              % ('scenario', 'cache', 'wall ms', 'main ms', 'procs',
+                 'RSS MiB', 'vs baseline'))
+
+        for installed in args.installed:
+            sysroot = os.path.join(workdir, 'root-%d' % installed)
+            make_sysroot(sysroot, installed)
+
+            for rows in args.rows:
+                dependencies = os.path.join(
+                    workdir, 'deps-%d-%d.txt' % (rows, installed))
+                make_hermetic_dependencies(dependencies, rows, installed)
+
+                for mode in ('cold', 'warm'):
+                    samples = []
+
+                    for _ in range(args.samples):
+                        if mode == 'cold':
+                            clear_hermetic_caches(workdir, dependencies)
+
+                        samples.append(run_hermetic_sample(
+                            workdir, sysroot, dependencies, args.backend))
+
+                    result = {
+                        'scenario': '%d rows/%d installed/%s/%s'
+                                    % (rows, installed, args.backend, mode),
+                        'rows': rows,
+                        'installed': installed,
+                        'backend': args.backend,
+                        'cache': mode,
+                    }
+
+                    for key in ('wall_ms', 'main_ms', 'subprocesses',
+                                'peak_rss_mib'):
+                        result[key] = statistics.median(
+                            s[key] for s in samples)
+
+                    results.append(result)
+                    compared = baseline.get(result['scenario'])
+                    delta = '-'
+
+                    if compared is not None and compared['wall_ms']:
+                        delta = '%+.0f%%' % (
+                            (result['wall_ms'] / compared['wall_ms'] - 1)
+                            * 100)
+
+                    print('%-22s %-5s %10.1f %10.1f %6d %8.1f  %s'
+                          % ('%d/%d %s' % (rows, installed, args.backend),
+                             mode,
+                             result['wall_ms'], result['main_ms'],
+                             result['subprocesses'], result['peak_rss_mib'],
+                             delta))
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as writer:
+            json.dump(results, writer, indent=2)
+
+    return 0
+
+
+def get_low_memory_ceiling():
+    # type: () -> int
+    """
+    Return LOW_MEMORY_CEILING_MIB from steamdeps.py without importing it,
+    since that would need steam_launcher.
+    """
+    with open(os.path.join(HERE, 'steamdeps.py')) as reader:
+        tree = ast.parse(reader.read())
+
+    for node in tree.body:
+        if (
+            isinstance(node, ast.Assign)
+            and len(node.targets) == 1
+            and isinstance(node.targets[0], ast.Name)
+            and node.targets[0].id == 'LOW_MEMORY_CEILING_MIB'
+        ):
+            return ast.literal_eval(node.value)
+
+    raise LookupError('LOW_MEMORY_CEILING_MIB not found in steamdeps.py')
+
+
+def make_large_list(root, mib):
+    # type: (str, int) -> str
+    """
+    Add an apt list of about mib MiB of realistic stanzas to the system
+    root, none of them installed, and return its path
+    """
+    path = os.path.join(
+        root, 'var/lib/apt/lists',
+        'deb.example_debian_dists_stable_universe_binary-amd64_Packages')
+    digest = hashlib.sha512(b'steamdeps_bench').hexdigest()
+    i = 0
+
+    with open(path, 'w') as writer:
+        while writer.tell() < mib * 2 ** 20:
+            writer.write(''.join(
+                LARGE_LIST_STANZA % {
+                    'i': j,
+                    'arch': ('amd64', 'i386', 'all')[j % 3],
+                    'minor': j % 7,
+                    'source': j // 4,
+                    'dep': j ^ 1,
+                    'size': 1000 + j % 9000,
+                    'md5': digest[:32],
+                    'sha1': digest[:40],
+                    'sha256': digest[:64],
+                    'sha512': digest,
+                }
+                for j in range(i, i + 1000)
+            ))
+            i += 1000
+
+    return path
+
+
+def benchmark_memory(args):
+    # type: (typing.Any) -> int
+    ceiling = args.ceiling_mib or get_low_memory_ceiling()
+    workdir = tempfile.mkdtemp(prefix='steamdeps-bench-')
+    failures = 0
+
+    try:
+        prepare_hermetic_workdir(workdir)
+        sysroot = os.path.join(workdir, 'root')
+        make_sysroot(sysroot, args.installed)
+        large_list = make_large_list(sysroot, args.list_mib)
+        dependencies = os.path.join(workdir, 'deps.txt')
+        make_hermetic_dependencies(dependencies, args.rows, args.installed)
+        clear_hermetic_caches(workdir, dependencies)
+
+        print('%-8s %-7s %8s %8s  %s'
+              % ('backend', 'cache', 'RSS MiB', 'ceiling', 'apt.Cache'))
+
+        for (backend, mode) in (
+            ('lowmem', 'cold'),
+            ('lowmem', 'warm'),
+            # The lists changed: the index is built again, with the other
+            # caches warm
+            ('lowmem', 'rebuild'),
+            ('apt', 'warm'),
+        ):
+            if mode == 'rebuild':
+                os.utime(large_list)
+
+            result = run_hermetic_sample(
+                workdir, sysroot, dependencies, backend)
+            checked = (backend == 'lowmem')
+
+            print('%-8s %-7s %8.1f %8s  %s'
+                  % (backend, mode, result['peak_rss_mib'],
+                     '%d' % ceiling if checked else '-',
+                     'opened' if result['apt_cache'] else '-'))
+
+            if checked and result['peak_rss_mib'] > ceiling:
+                failures += 1
+                print('  FAIL: peak RSS %.1f MiB exceeds %d MiB'
+                      % (result['peak_rss_mib'], ceiling), file=sys.stderr)
+
+            if checked and result['apt_cache']:
+                failures += 1
+                print('  FAIL: the low-memory backend opened apt.Cache',
+                      file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failures:
+        return 1
+
+    return 0
+
+
+def int_list(text):
+    # type: (str) -> typing.List[int]
+    return [int(n) for n in text.split(',')]
+
+
+def main():
+    # type: () -> int
+    parser = argparse.ArgumentParser(description='Benchmark steamdeps')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    startup = subparsers.add_parser(
+        'startup',
+        help="Measure import and argument parsing time of each entry mode",
+    )
+    startup.add_argument(
+        '--samples',
+        type=int,
+        default=5,
+        help="Number of fresh interpreters to sample per mode",
+    )
+    startup.add_argument(
+        '--budget-ms',
+        type=float,
+        default=100.0,
+        help="Fail if the median import and parsing time exceeds this",
+    )
+    startup.set_defaults(function=benchmark_startup)
+
+    parse = subparsers.add_parser(
+        'parse',
+        help="Measure parsing a synthetic dependencies file",
+    )
+    parse.add_argument(
+        '--rows',
+        type=int,
+        default=10000,
+        help="Number of dependency rows in the synthetic file",
+    )
+    parse.add_argument(
+        '--samples',
+        type=int,
+        default=5,
+        help="Number of times to parse the file",
+    )
+    parse.add_argument(
+        '--budget-ms',
+        type=float,
+        default=250.0,
+        help="Fail if the median parsing time exceeds this",
+    )
+    parse.set_defaults(function=benchmark_parse)
+
+    hermetic = subparsers.add_parser(
+        'hermetic',
+        help="Measure steamdeps.py end to end in a generated system root",
+    )
+    hermetic.add_argument(
+        '--rows',
+        type=int_list,
+        default=list(HERMETIC_ROWS),
+        help="Comma-separated numbers of dependency rows",
+    )
+    hermetic.add_argument(
+        '--installed',
+        type=int_list,
+        default=list(HERMETIC_INSTALLED),
+        help="Comma-separated numbers of installed packages",
+    )
+    hermetic.add_argument(
+        '--samples',
+        type=int,
+        default=3,
+        help="Number of runs per scenario and cache state",
+    )
+    hermetic.add_argument(
+        '--backend',
+        choices=('apt', 'lowmem'),
+        default='apt',
+        help="steamdeps.py --backend to measure",
+    )
+    hermetic.add_argument(
+        '--output',
+        help="Save the results as JSON, e.g. to use as a --baseline later",
+    )
+    hermetic.add_argument(
+        '--baseline',
+        help="Compare the wall time with results saved by --output",
+    )
+    hermetic.set_defaults(function=benchmark_hermetic)
+
+    memory = subparsers.add_parser(
+        'memory',
+        help="Check the peak memory use of the low-memory backend",
+    )
+    memory.add_argument(
+        '--rows',
+        type=int,
+        default=max(HERMETIC_ROWS),
+        help="Number of dependency rows",
+    )
+    memory.add_argument(
+        '--installed',
+        type=int,
+        default=max(HERMETIC_INSTALLED),
+        help="Number of installed packages",
+    )
+    memory.add_argument(
+        '--list-mib',
+        type=int,
+        default=MEMORY_LIST_MIB,
+        help="Size of the additional list of realistic stanzas to index",
+    )
+    memory.add_argument(
+        '--ceiling-mib',
+        type=int,
+        help="Fail above this peak RSS (default: the documented ceiling)",
+    )
+    memory.set_defaults(function=benchmark_memory)
+
+    args = parser.parse_args()
+    return args.function(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())